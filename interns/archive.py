@@ -0,0 +1,501 @@
+"""Columnar archive of old tweets
+
+Tweets older than interns_settings.archive_after_days are moved out of the
+text_source/twitter_source tables into compressed columnar segment files, so
+the hot tables stay small and scans over the archive only read and decompress
+the columns they use.
+
+A segment file holds one column after another, each zlib compressed:
+
+- tweet_id: 64 bit ints, delta encoded (rows are in tweet id order)
+- time_posted: 64 bit seconds since the epoch, -1 when unknown
+- user_name: dictionary encoded, the distinct names then a 32 bit code a row
+- retweet_of: tweet id of the retweeted original, 0 for other tweets
+- text: 32 bit byte lengths then the utf-8 text of every row (a string heap)
+- hashtags, user_mentions, urls: 32 bit counts a row then a string heap
+
+Run the compaction with: python -m interns.archive [--help]
+"""
+import os
+import sys
+import zlib
+import struct
+import calendar
+import argparse
+import datetime
+
+from sqlalchemy import select, and_, func
+
+from interns.settings import interns_settings
+from interns.utils import get_logger
+
+logger = get_logger(__name__)
+
+segment_magic = b'IARC'
+segment_version = 1
+segment_suffix = '.iarc'
+
+segment_header = struct.Struct('<4sBIH')
+column_header = struct.Struct('<HBI')
+
+kind_ints = 0
+kind_delta_ints = 1
+kind_strings = 2
+kind_dictionary = 3
+kind_string_lists = 4
+
+segment_columns = (
+    ('tweet_id', kind_delta_ints),
+    ('time_posted', kind_ints),
+    ('user_name', kind_dictionary),
+    ('retweet_of', kind_ints),
+    ('text', kind_strings),
+    ('hashtags', kind_string_lists),
+    ('user_mentions', kind_string_lists),
+    ('urls', kind_string_lists),
+)
+
+
+def _pack_ints(values, size_format='q'):
+    return struct.pack('<{0}{1}'.format(len(values), size_format), *values)
+
+
+def _unpack_ints(data, count, offset=0, size_format='q'):
+    int_format = '<{0}{1}'.format(count, size_format)
+    end = offset + struct.calcsize(int_format)
+    return list(struct.unpack(int_format, data[offset:end])), end
+
+
+def _pack_strings(values):
+    encoded = [value.encode('utf-8') for value in values]
+    return (
+        struct.pack('<I', len(encoded)) +
+        _pack_ints([len(value) for value in encoded], 'I') +
+        b''.join(encoded)
+    )
+
+
+def _unpack_strings(data, offset=0):
+    count = struct.unpack('<I', data[offset:offset + 4])[0]
+    lengths, offset = _unpack_ints(data, count, offset + 4, 'I')
+    values = []
+    for length in lengths:
+        end = offset + length
+        values.append(data[offset:end].decode('utf-8'))
+        offset = end
+    return values, offset
+
+
+def encode_column(kind, values):
+    """
+    Return the uncompressed bytes of a column of values
+    """
+    if kind == kind_ints:
+        return _pack_ints(values)
+    if kind == kind_delta_ints:
+        previous = 0
+        deltas = []
+        for value in values:
+            deltas.append(value - previous)
+            previous = value
+        return _pack_ints(deltas)
+    if kind == kind_strings:
+        return _pack_strings(values)
+    if kind == kind_dictionary:
+        codes = {}
+        for value in values:
+            codes.setdefault(value, len(codes))
+        distinct = sorted(codes, key=codes.get)
+        return _pack_strings(distinct) + _pack_ints(
+            [codes[value] for value in values], 'I'
+        )
+    if kind == kind_string_lists:
+        return _pack_ints([len(value) for value in values], 'I') + (
+            _pack_strings([item for value in values for item in value])
+        )
+    raise ValueError('Unknown archive column kind {0}'.format(kind))
+
+
+def decode_column(kind, data, count):
+    """
+    Return the list of count values of a column from its uncompressed bytes
+    """
+    if kind == kind_ints:
+        return _unpack_ints(data, count)[0]
+    if kind == kind_delta_ints:
+        deltas = _unpack_ints(data, count)[0]
+        values = []
+        previous = 0
+        for delta in deltas:
+            previous += delta
+            values.append(previous)
+        return values
+    if kind == kind_strings:
+        return _unpack_strings(data)[0]
+    if kind == kind_dictionary:
+        distinct, offset = _unpack_strings(data)
+        codes = _unpack_ints(data, count, offset, 'I')[0]
+        return [distinct[code] for code in codes]
+    if kind == kind_string_lists:
+        lengths, offset = _unpack_ints(data, count, 0, 'I')
+        items = _unpack_strings(data, offset)[0]
+        values = []
+        start = 0
+        for length in lengths:
+            values.append(items[start:start + length])
+            start += length
+        return values
+    raise ValueError('Unknown archive column kind {0}'.format(kind))
+
+
+def write_segment(path, rows):
+    """
+    Write rows (dicts with a key for every column in segment_columns, in tweet
+    id order) to a segment file at path. The file is written under a temporary
+    name and renamed once it is on disk, so a reader never sees part of one
+    """
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as segment:
+        segment.write(segment_header.pack(
+            segment_magic, segment_version, len(rows), len(segment_columns)
+        ))
+        for name, kind in segment_columns:
+            compressed = zlib.compress(
+                encode_column(kind, [row[name] for row in rows])
+            )
+            encoded_name = name.encode('utf-8')
+            segment.write(
+                column_header.pack(len(encoded_name), kind, len(compressed))
+            )
+            segment.write(encoded_name)
+            segment.write(compressed)
+        segment.flush()
+        os.fsync(segment.fileno())
+    os.rename(temp_path, path)
+
+
+class ArchiveSegment(object):
+    """A segment file of archived tweets
+
+    Only the columns that are asked for are decompressed, e.g.:
+
+    segment = ArchiveSegment(path)
+    for tweet_id, user_name in segment.scan(['tweet_id', 'user_name']):
+        ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as segment:
+            self.data = segment.read()
+        magic, version, self.row_count, column_count = (
+            segment_header.unpack(self.data[:segment_header.size])
+        )
+        if magic != segment_magic:
+            raise ValueError('{0} is not an archive segment'.format(path))
+        if version != segment_version:
+            raise ValueError(
+                'Unsupported archive segment version {0}'.format(version)
+            )
+        self.column_locations = {}
+        offset = segment_header.size
+        for _ in range(column_count):
+            name_length, kind, data_length = column_header.unpack(
+                self.data[offset:offset + column_header.size]
+            )
+            offset += column_header.size
+            name = self.data[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+            self.column_locations[name] = (kind, offset, data_length)
+            offset += data_length
+        self.decoded = {}
+
+    def __len__(self):
+        return self.row_count
+
+    @property
+    def column_names(self):
+        return [name for name, _ in segment_columns
+                if name in self.column_locations]
+
+    def column(self, name):
+        """
+        Return the list of values of column name
+        """
+        if name not in self.decoded:
+            kind, offset, data_length = self.column_locations[name]
+            data = zlib.decompress(self.data[offset:offset + data_length])
+            self.decoded[name] = decode_column(kind, data, self.row_count)
+        return self.decoded[name]
+
+    def scan(self, columns=None):
+        """
+        Yield a tuple of the values of columns (all of them by default) for
+        every row
+        """
+        if columns is None:
+            columns = self.column_names
+        return zip(*[self.column(name) for name in columns])
+
+
+def segment_paths(archive_dir=None):
+    """
+    Return the paths of the segment files in archive_dir, oldest tweets first
+    """
+    if archive_dir is None:
+        archive_dir = interns_settings.archive_dir
+    if not os.path.exists(archive_dir):
+        return []
+    return [
+        os.path.join(archive_dir, file_name)
+        for file_name in sorted(os.listdir(archive_dir))
+        if file_name.endswith(segment_suffix)
+    ]
+
+
+def scan_archive(columns=None, archive_dir=None):
+    """
+    Yield a tuple of the values of columns for every archived tweet
+    """
+    for path in segment_paths(archive_dir):
+        for row in ArchiveSegment(path).scan(columns):
+            yield row
+
+
+def _epoch(time_posted):
+    if time_posted is None:
+        return -1
+    return calendar.timegm(time_posted.utctimetuple())
+
+
+def _chunks(items, chunk_size):
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+class TweetCompactor(object):
+    """Moves tweets posted before a cutoff from the database to segments
+
+    Each batch of up to segment_rows tweets is deleted from the database in
+    the same transaction it was read in and written to one segment file just
+    before that commits. Two kinds of tweets stay in the database: the newest
+    tweet of every user, which their last tweet id is read from, and
+    originals that a retweet staying in the database points at. A failed
+    delete writes no segment, and a failed commit after the segment is
+    written leaves those tweets in both places, they are never lost.
+    """
+
+    def __init__(self, db_engine, archive_dir, segment_rows, chunk_size):
+        self.engine = db_engine
+        self.archive_dir = archive_dir
+        self.segment_rows = segment_rows
+        self.chunk_size = chunk_size
+
+    def compact(self, cutoff):
+        """
+        Archive every tweet posted before the datetime cutoff, returns the
+        number archived
+        """
+        if not os.path.exists(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        archived = 0
+        while True:
+            # Originals skipped for a retweet in a later batch are archived by
+            # the next pass
+            pass_archived = self._compact_pass(cutoff)
+            if not pass_archived:
+                return archived
+            archived += pass_archived
+
+    def _compact_pass(self, cutoff):
+        archived = 0
+        after_id = 0
+        while True:
+            with self.engine.begin() as conn:
+                batch_archived, after_id = self._compact_batch(
+                    conn, cutoff, after_id
+                )
+            if after_id is None:
+                return archived
+            archived += batch_archived
+
+    def _select_in(self, conn, query, column, values):
+        rows = []
+        for chunk in _chunks(list(values), self.chunk_size):
+            rows.extend(conn.execute(query.where(column.in_(chunk))))
+        return rows
+
+    def _delete_in(self, conn, table, column, values):
+        for chunk in _chunks(list(values), self.chunk_size):
+            conn.execute(table.delete().where(column.in_(chunk)))
+
+    def _compact_batch(self, conn, cutoff, after_id):
+        """
+        Archive the next batch of tweets with a twitter_source id above
+        after_id, returns the number archived and the id to continue after (or
+        None once there are no more)
+        """
+        # Imported here so reading the archive doesn't need the database
+        from interns.clients import db_client
+
+        twitter_source = db_client.twitter_source_table
+        text_source = db_client.text_source_table
+        candidates = conn.execute(
+            select([
+                twitter_source.c.id,
+                twitter_source.c.tweet_id,
+                twitter_source.c.tweeter_user_name,
+                twitter_source.c.retweet_source_id,
+                twitter_source.c.text_source_id,
+                text_source.c.written_text,
+                text_source.c.time_posted
+            ]).select_from(
+                twitter_source.join(
+                    text_source,
+                    twitter_source.c.text_source_id == text_source.c.id
+                )
+            ).where(
+                and_(
+                    text_source.c.time_posted < cutoff,
+                    twitter_source.c.id > after_id
+                )
+            ).order_by(twitter_source.c.id).limit(self.segment_rows)
+        ).fetchall()
+        if not candidates:
+            return 0, None
+        next_after_id = candidates[-1][0]
+        candidate_ids = set(row[0] for row in candidates)
+
+        newest_ids = set(
+            newest_id for _, newest_id in self._select_in(
+                conn,
+                select([
+                    twitter_source.c.tweeter_user_name,
+                    func.max(twitter_source.c.tweet_id)
+                ]).group_by(twitter_source.c.tweeter_user_name),
+                twitter_source.c.tweeter_user_name,
+                set(row[2] for row in candidates)
+            )
+        )
+        referencing = self._select_in(
+            conn,
+            select([twitter_source.c.id, twitter_source.c.retweet_source_id]),
+            twitter_source.c.retweet_source_id,
+            candidate_ids
+        )
+        # Originals stay while anything that stays retweets them, including
+        # candidates kept back, which can in turn keep back more candidates
+        kept_ids = set(row[0] for row in candidates if row[1] in newest_ids)
+        while True:
+            still_referenced = set(
+                retweet_source_id
+                for row_id, retweet_source_id in referencing
+                if row_id not in candidate_ids or row_id in kept_ids
+            )
+            newly_kept = (still_referenced & candidate_ids) - kept_ids
+            if not newly_kept:
+                break
+            kept_ids |= newly_kept
+        rows = [row for row in candidates if row[0] not in kept_ids]
+        if not rows:
+            return 0, next_after_id
+        source_ids = [row[0] for row in rows]
+
+        original_tweet_ids = dict(self._select_in(
+            conn,
+            select([twitter_source.c.id, twitter_source.c.tweet_id]),
+            twitter_source.c.id,
+            set(row[3] for row in rows if row[3] is not None)
+        ))
+        entities = {}
+        for name, table, value_column in (
+                ('hashtags', db_client.hashtags_table,
+                 db_client.hashtag_table.c.hashtag),
+                ('user_mentions', db_client.mentions_table,
+                 db_client.user_name_table.c.user_name),
+                ('urls', db_client.urls_table, None)):
+            values = {}
+            if value_column is None:
+                query = select([table.c.twitter_source_id, table.c.url])
+            else:
+                dictionary = value_column.table
+                query = select([table.c.twitter_source_id, value_column])
+                query = query.select_from(table.join(dictionary))
+            for source_id, value in self._select_in(
+                    conn, query, table.c.twitter_source_id, source_ids):
+                values.setdefault(source_id, []).append(value)
+            entities[name] = values
+
+        segment_rows = []
+        for row in sorted(rows, key=lambda row: row[1]):
+            segment_rows.append({
+                'tweet_id': row[1],
+                'time_posted': _epoch(row[6]),
+                'user_name': row[2] or u'',
+                'retweet_of': original_tweet_ids.get(row[3], 0),
+                'text': row[5] or u'',
+                'hashtags': entities['hashtags'].get(row[0], []),
+                'user_mentions': entities['user_mentions'].get(row[0], []),
+                'urls': entities['urls'].get(row[0], [])
+            })
+        for table in (db_client.hashtags_table, db_client.mentions_table,
+                      db_client.urls_table):
+            self._delete_in(
+                conn, table, table.c.twitter_source_id, source_ids
+            )
+        # Retweets go before the originals they point at
+        for retweets in (True, False):
+            self._delete_in(
+                conn,
+                twitter_source,
+                twitter_source.c.id,
+                [row[0] for row in rows if (row[3] is not None) == retweets]
+            )
+        self._delete_in(
+            conn, text_source, text_source.c.id, [row[4] for row in rows]
+        )
+        # Only written once the deletes have gone through, a failed write
+        # rolls them back
+        path = os.path.join(
+            self.archive_dir,
+            'tweets-{0:020d}-{1:020d}{2}'.format(
+                segment_rows[0]['tweet_id'],
+                segment_rows[-1]['tweet_id'],
+                segment_suffix
+            )
+        )
+        write_segment(path, segment_rows)
+        logger.info('Archived %s tweets to %s', len(segment_rows), path)
+        return len(segment_rows), next_after_id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Move old tweets from the database to the archive'
+    )
+    parser.add_argument(
+        '--older-than-days', type=float,
+        default=interns_settings.archive_after_days
+    )
+    parser.add_argument(
+        '--archive-dir', default=interns_settings.archive_dir
+    )
+    args = parser.parse_args(argv)
+
+    from interns.clients import db_client
+
+    compactor = TweetCompactor(
+        db_client.engine,
+        args.archive_dir,
+        interns_settings.archive_segment_rows,
+        interns_settings.db_write_chunk_size
+    )
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        days=args.older_than_days
+    )
+    archived = compactor.compact(cutoff)
+    print('Archived {0} tweets posted before {1}'.format(archived, cutoff))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,368 @@
+"""In-process stand-ins for the services interns talks to"""
+import sys
+import time
+import types
+import random
+import logging
+import logging.handlers
+
+
+class FakeUser(object):
+    """Twitter user with the fields interns reads"""
+
+    def __init__(self, screen_name):
+        self.screen_name = screen_name
+
+
+class FakeHashtag(object):
+    """Twitter hashtag with the fields interns reads"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeUrl(object):
+    """Twitter url with the fields interns reads"""
+
+    def __init__(self, expanded_url):
+        self.expanded_url = expanded_url
+
+
+class FakeTweet(object):
+    """Tweet shaped like python-twitter's Status for the fields interns
+    reads"""
+
+    def __init__(self, tweet_id, screen_name, text, created_at,
+                 user_mentions=(), hashtags=(), urls=(),
+                 retweeted_status=None):
+        self.id = tweet_id
+        self.id_str = str(tweet_id)
+        self.user = FakeUser(screen_name)
+        self.text = text
+        self.created_at = created_at
+        self.user_mentions = [FakeUser(name) for name in user_mentions]
+        self.hashtags = [FakeHashtag(tag) for tag in hashtags]
+        self.urls = [FakeUrl(url) for url in urls]
+        self.retweeted_status = retweeted_status
+
+
+def make_fake_tweets(count, screen_name='interns_bench', first_id=None,
+                     retweet_ratio=0.2, seed=0):
+    """
+    Build count fake tweets for screen_name, newest first, with a realistic
+    mix of mentions, hashtags, urls and retweets
+    """
+    rand = random.Random(seed)
+    if first_id is None:
+        first_id = 800000000000000000
+    created = 1476800000
+    tweets = []
+    for index in range(count):
+        tweet_id = first_id - index * 1000
+        created_at = time.strftime(
+            '%a %b %d %H:%M:%S +0000 %Y', time.gmtime(created - index * 60)
+        )
+        text = ' '.join(
+            rand.choice(('data', 'space', 'launch', 'orbit', 'mission'))
+            for _ in range(rand.randint(5, 25))
+        )
+        user_mentions = [
+            'user{0}'.format(rand.randint(0, 500))
+            for _ in range(rand.randint(0, 3))
+        ]
+        hashtags = [
+            'tag{0}'.format(rand.randint(0, 100))
+            for _ in range(rand.randint(0, 3))
+        ]
+        urls = [
+            'https://example.com/{0}'.format(rand.randint(0, 10 ** 6))
+            for _ in range(rand.randint(0, 2))
+        ]
+        retweeted_status = None
+        if rand.random() < retweet_ratio:
+            retweeted_status = FakeTweet(
+                tweet_id - 500,
+                'user{0}'.format(rand.randint(0, 500)),
+                text,
+                created_at,
+                user_mentions,
+                hashtags,
+                urls
+            )
+        tweets.append(
+            FakeTweet(
+                tweet_id, screen_name, text, created_at, user_mentions,
+                hashtags, urls, retweeted_status
+            )
+        )
+    return tweets
+
+
+class FakeServiceError(Exception):
+    """Raised by fake services to simulate a failed call"""
+
+
+class FakeService(object):
+    """Base for fake services, every call waits latency_secs and fails with
+    probability error_rate"""
+
+    def __init__(self, latency_secs=0, error_rate=0, seed=0):
+        self.latency_secs = latency_secs
+        self.error_rate = error_rate
+        self.calls = 0
+        self.rand = random.Random(seed)
+
+    def simulate_call(self):
+        """Count a call and apply the configured latency and errors"""
+        self.calls += 1
+        if self.latency_secs:
+            time.sleep(self.latency_secs)
+        if self.error_rate and self.rand.random() < self.error_rate:
+            raise FakeServiceError('Simulated {0} failure'.format(
+                self.__class__.__name__
+            ))
+
+
+class FakeMemcacheClient(FakeService):
+    """Dict backed stand-in for pymemcache's Client"""
+
+    def __init__(self, server=None, latency_secs=0, error_rate=0, seed=0):
+        super(FakeMemcacheClient, self).__init__(
+            latency_secs, error_rate, seed
+        )
+        self.server = server
+        self.values = {}
+
+    def _live(self, key):
+        value = self.values.get(key)
+        if value is None:
+            return None
+        if value[1] and value[1] <= time.time():
+            del self.values[key]
+            return None
+        return value
+
+    def _expires(self, expire):
+        if expire:
+            return time.time() + expire
+        return None
+
+    def get(self, key):
+        self.simulate_call()
+        value = self._live(key)
+        return None if value is None else value[0]
+
+    def get_many(self, keys):
+        self.simulate_call()
+        found = {}
+        for key in keys:
+            value = self._live(key)
+            if value is not None:
+                found[key] = value[0]
+        return found
+
+    def set(self, key, value, expire=0, noreply=True):
+        self.simulate_call()
+        self.values[key] = (str(value), self._expires(expire))
+        return True
+
+    def set_many(self, values, expire=0, noreply=True):
+        self.simulate_call()
+        expires = self._expires(expire)
+        for key, value in values.items():
+            self.values[key] = (str(value), expires)
+        return []
+
+    def add(self, key, value, expire=0, noreply=True):
+        self.simulate_call()
+        if self._live(key) is not None:
+            return False
+        self.values[key] = (str(value), self._expires(expire))
+        return True
+
+    def incr(self, key, value, noreply=False):
+        self.simulate_call()
+        current = self._live(key)
+        if current is None:
+            return None
+        new_value = int(current[0]) + value
+        self.values[key] = (str(new_value), current[1])
+        return new_value
+
+    def decr(self, key, value, noreply=False):
+        self.simulate_call()
+        current = self._live(key)
+        if current is None:
+            return None
+        new_value = max(0, int(current[0]) - value)
+        self.values[key] = (str(new_value), current[1])
+        return new_value
+
+    def delete(self, key, noreply=True):
+        self.simulate_call()
+        return self.values.pop(key, None) is not None
+
+
+class FakeRateLimit(object):
+    """Rate limit status as returned by AquaticTwitter"""
+
+    def __init__(self, limit, remaining, reset):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+
+
+class FakeAquaticTwitter(FakeService):
+    """Stand-in for aquatic_twitter's AquaticTwitter"""
+
+    def __init__(self, consumer_key=None, consumer_secret=None,
+                 access_token_key=None, access_token_secret=None,
+                 write_to_memcache=False):
+        super(FakeAquaticTwitter, self).__init__()
+
+    def get_user_timeline_rate_limit(self):
+        self.simulate_call()
+        return FakeRateLimit(180, 180, int(time.time()) + 900)
+
+
+class FakeResponse(object):
+    """HTTP response with the fields interns reads"""
+
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class FakeTwitterApi(FakeService):
+    """Stand-in for python-twitter's Api serving every user a fake timeline
+    of timeline_length tweets. Every request goes through _RequestUrl, whose
+    response carries x-rate-limit headers counting down from 180"""
+
+    # Shared by every instance so the fake can be configured before the
+    # interns client module builds its clients
+    latency_secs = 0
+    error_rate = 0
+    timeline_length = 3200
+    newest_id = 800000000000000000
+    base_url = 'https://api.twitter.com/1.1'
+
+    def __init__(self, consumer_key=None, consumer_secret=None,
+                 access_token_key=None, access_token_secret=None, **kwargs):
+        # pylint: disable=unused-argument
+        super(FakeTwitterApi, self).__init__(
+            FakeTwitterApi.latency_secs, FakeTwitterApi.error_rate
+        )
+        self.rate_limit_reset = int(time.time()) + 900
+
+    def _RequestUrl(self, url, verb, data=None, json=None):
+        # pylint: disable=invalid-name,unused-argument
+        self.simulate_call()
+        return FakeResponse({
+            'x-rate-limit-remaining': str(max(0, 180 - self.calls)),
+            'x-rate-limit-reset': str(self.rate_limit_reset)
+        })
+
+    def GetUserTimeline(self, user_id=None, screen_name=None, since_id=None,
+                        max_id=None, count=None, **kwargs):
+        # pylint: disable=invalid-name,unused-argument
+        self._RequestUrl(
+            self.base_url + '/statuses/user_timeline.json', 'GET'
+        )
+        count = count or 20
+        if since_id is not None:
+            # Always a full page of new tweets
+            return make_fake_tweets(
+                count, screen_name, first_id=int(since_id) + count * 1000
+            )
+        # The timeline's tweet ids are 1000 apart counting down from newest_id
+        skipped = 0
+        if max_id is not None:
+            skipped = max(0, -((int(max_id) - self.newest_id) // 1000))
+        available = max(0, self.timeline_length - skipped)
+        return make_fake_tweets(
+            min(count, available),
+            screen_name,
+            first_id=self.newest_id - skipped * 1000
+        )
+
+
+class FakeEleanorTwitter(FakeService):
+    """Stand-in for eleanor_client.endpoints.twitter keeping tweets in
+    memory"""
+
+    def __init__(self, tracked_users=(), latency_secs=0, error_rate=0,
+                 seed=0):
+        super(FakeEleanorTwitter, self).__init__(
+            latency_secs, error_rate, seed
+        )
+        self.tracked_users = list(tracked_users)
+        self.tweets = {}
+
+    def get_tracked_twitter_users(self):
+        self.simulate_call()
+        return list(self.tracked_users)
+
+    def track_new_twitter_user(self, username):
+        self.simulate_call()
+        if username not in self.tracked_users:
+            self.tracked_users.append(username)
+
+    def get_username_last_tweet_id(self, screen_name):
+        self.simulate_call()
+        tweet_ids = [
+            int(tweet_id) for tweet_id, tweet_data in self.tweets.items()
+            if tweet_data['user_name'] == screen_name
+        ]
+        return max(tweet_ids) if tweet_ids else None
+
+    def add_tweet_data(self, tweet_data):
+        self.simulate_call()
+        self.tweets[tweet_data['tweet_id']] = tweet_data
+
+
+def _install_module(name, **attributes):
+    module = types.ModuleType(name)
+    for attribute, value in attributes.items():
+        setattr(module, attribute, value)
+    sys.modules[name] = module
+    return module
+
+
+def install_fakes(eleanor_twitter, memcache_client_class=FakeMemcacheClient):
+    """
+    Put the fake twitter, eleanor and memcache clients (and dev twitter and
+    rabbit credentials) in place of the real ones. Must be called before any
+    interns.clients or interns.tasks module is imported. Celery itself is not
+    faked, it only needs to be installed
+    """
+    _install_module('twitter', Api=FakeTwitterApi)
+    _install_module(
+        'aquatic_twitter.client', AquaticTwitter=FakeAquaticTwitter
+    )
+    _install_module(
+        'aquatic_twitter', client=sys.modules['aquatic_twitter.client']
+    )
+    sys.modules['eleanor_client.endpoints.twitter'] = eleanor_twitter
+    _install_module('eleanor_client.endpoints', twitter=eleanor_twitter)
+    _install_module(
+        'eleanor_client', endpoints=sys.modules['eleanor_client.endpoints']
+    )
+    _install_module(
+        'pymemcache.client.base', Client=memcache_client_class
+    )
+    _install_module(
+        'pymemcache.client', base=sys.modules['pymemcache.client.base']
+    )
+    _install_module('pymemcache', client=sys.modules['pymemcache.client'])
+    _install_module(
+        'interns.creds.config',
+        rabbit_uname='bench',
+        rabbit_pwd='bench',
+        twitter_consumer_key='bench',
+        twitter_consumer_secret='bench',
+        twitter_access_token_key='bench',
+        twitter_access_token_secret='bench'
+    )
+    # Keep benchmark runs from needing or writing the service log files
+    logging.handlers.TimedRotatingFileHandler = (
+        lambda *args, **kwargs: logging.NullHandler()
+    )
@@ -0,0 +1,191 @@
+"""Offline benchmarks of the interns hot paths against fake services
+
+Measures scheduler dispatch rate, tweet ingest throughput and log drain
+throughput with in-process fakes of twitter, eleanor and memcache, so it needs
+no network access. Celery has to be installed but no broker is used.
+
+eleanor_client adds one tweet per call, so both ingest figures make one eleanor
+call per tweet. They differ by what ingest_timeline_tweets adds on top (record
+conversion, the seen tweet filter and per tweet failure handling).
+
+Run with: python -m interns.benchmarks.hot_paths [--help]
+"""
+import sys
+import time
+import logging
+import argparse
+import multiprocessing
+
+from interns.benchmarks import fakes
+
+
+class RecordingTask(object):
+    """Stands in for a celery task on the scheduler side, counting the jobs
+    that would have been queued"""
+
+    def __init__(self):
+        self.queued = 0
+
+    def apply_async(self, args=None, kwargs=None, countdown=None):
+        self.queued += 1
+
+
+class CountingHandler(logging.Handler):
+    """Logging handler that only counts records"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = 0
+
+    def emit(self, record):
+        self.records += 1
+
+
+def bench_scheduler_dispatch(number_of_jobs):
+    """
+    Time TwitterJobs.execute_next_job with an unlimited request budget, returns
+    jobs queued per second
+    """
+    import Queue
+    from interns.tasks_scheduling.twitter import jobs
+
+    recording_tasks = RecordingTask()
+    jobs.intern_tasks = type(
+        'RecordingTasks',
+        (object,),
+        {
+            'get_user_timeline_tweets': recording_tasks,
+            'get_users_timeline_tweets': recording_tasks
+        }
+    )
+    twitter_jobs = jobs.TwitterJobs(Queue.Queue(), Queue.Queue(), run=False)
+    start = time.time()
+    while recording_tasks.queued < number_of_jobs:
+        twitter_jobs.execute_next_job()
+    elapsed = time.time() - start
+    return recording_tasks.queued / elapsed
+
+
+def bench_ingest(number_of_tweets, eleanor_twitter):
+    """
+    Time storing a timeline with insert_tweet_data and through
+    ingest_timeline_tweets, returns tweets stored per second for each
+    """
+    from interns.clients.twitter import client, utils as twitter_utils
+
+    logger = logging.getLogger('interns.benchmarks.ingest')
+    logger.addHandler(logging.NullHandler())
+    timeline_tweets = fakes.make_fake_tweets(number_of_tweets)
+
+    start = time.time()
+    for tweet in timeline_tweets:
+        try:
+            twitter_utils.insert_tweet_data(tweet)
+        except fakes.FakeServiceError:
+            pass
+    single_rate = number_of_tweets / (time.time() - start)
+
+    eleanor_twitter.tweets.clear()
+    start = time.time()
+    client.ingest_timeline_tweets('interns_bench', timeline_tweets, logger)
+    ingest_rate = number_of_tweets / (time.time() - start)
+    return single_rate, ingest_rate
+
+
+def bench_log_drain(number_of_messages):
+    """
+    Time draining log messages put on a multiprocessing queue by another
+    process, returns messages written per second and messages dropped
+    """
+    from interns import utils
+
+    handler = CountingHandler()
+    logger = logging.getLogger('interns.benchmarks.log_drain')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    log_queue = multiprocessing.Queue()
+    writer = utils.MultiProcessLogger(log_queue, logger)
+
+    producer = multiprocessing.Process(
+        target=produce_log_messages, args=(log_queue, number_of_messages)
+    )
+    start = time.time()
+    writer.start_listener()
+    producer.start()
+    producer.join()
+    writer.stop_listener()
+    elapsed = time.time() - start
+    return handler.records / elapsed, writer.dropped_messages
+
+
+def produce_log_messages(log_queue, number_of_messages):
+    """Put number_of_messages debug messages on log_queue"""
+    from interns import utils
+
+    producer_logger = utils.MultiProcessLogger(log_queue)
+    for index in range(number_of_messages):
+        producer_logger.debug(__name__, 'Benchmark message {0}'.format(index))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--jobs', type=int, default=20000)
+    parser.add_argument('--tweets', type=int, default=2000)
+    parser.add_argument('--log-messages', type=int, default=100000)
+    parser.add_argument(
+        '--twitter-latency-ms', type=float, default=0,
+        help='Latency added to every fake twitter call'
+    )
+    parser.add_argument(
+        '--eleanor-latency-ms', type=float, default=1,
+        help='Latency added to every fake eleanor call'
+    )
+    parser.add_argument(
+        '--memcache-latency-ms', type=float, default=0,
+        help='Latency added to every fake memcache call'
+    )
+    parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='Fraction of fake eleanor calls that fail'
+    )
+    args = parser.parse_args(argv)
+
+    usernames = ['bench_user_{0}'.format(index) for index in range(args.users)]
+    eleanor_twitter = fakes.FakeEleanorTwitter(
+        usernames, args.eleanor_latency_ms / 1000.0, args.error_rate
+    )
+    fakes.FakeTwitterApi.latency_secs = args.twitter_latency_ms / 1000.0
+    memcache_latency_secs = args.memcache_latency_ms / 1000.0
+
+    def memcache_client(server=None):
+        return fakes.FakeMemcacheClient(server, memcache_latency_secs)
+
+    fakes.install_fakes(eleanor_twitter, memcache_client)
+
+    from interns.settings import interns_settings
+    # Measure the scheduler's own cost rather than the twitter API pacing
+    interns_settings.twitter_timeline_requests = 10 ** 9
+    interns_settings.twitter_user_min_poll_secs = 0
+    # Time sending to eleanor rather than appending to the tweet spool
+    interns_settings.spool_enabled = False
+
+    print('Scheduler dispatch: {0:.0f} jobs/s over {1} users'.format(
+        bench_scheduler_dispatch(args.jobs), args.users
+    ))
+    single_rate, ingest_rate = bench_ingest(args.tweets, eleanor_twitter)
+    print('Ingest with insert_tweet_data: {0:.0f} tweets/s'.format(
+        single_rate
+    ))
+    print('Ingest with ingest_timeline_tweets: {0:.0f} tweets/s'.format(
+        ingest_rate
+    ))
+    drain_rate, dropped = bench_log_drain(args.log_messages)
+    print('Log drain: {0:.0f} messages/s, {1} dropped'.format(
+        drain_rate, dropped
+    ))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
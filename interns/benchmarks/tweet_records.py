@@ -0,0 +1,72 @@
+"""Compare tweet dicts with packed TweetRecords
+
+Run with: python -m interns.benchmarks.tweet_records [number_of_tweets]
+"""
+import sys
+import json
+import pickle
+import timeit
+
+from interns.benchmarks.fakes import make_fake_tweets
+from interns.clients.twitter import records
+
+
+def tweet_dicts_json(tweet_dicts):
+    """Encode tweet dicts the way they are sent to eleanor today"""
+    return json.dumps(tweet_dicts).encode('utf-8')
+
+
+def run(number_of_tweets=1000, repeat=5):
+    """
+    Print bytes per tweet and encode/decode tweets per second for each format
+    """
+    tweets = make_fake_tweets(number_of_tweets)
+    tweet_records = [records.TweetRecord.from_tweet(tweet) for tweet in tweets]
+    tweet_dicts = [record.to_tweet_data() for record in tweet_records]
+
+    formats = [
+        (
+            'json dicts',
+            lambda: tweet_dicts_json(tweet_dicts),
+            lambda data: json.loads(data.decode('utf-8'))
+        ),
+        (
+            'pickled dicts',
+            lambda: pickle.dumps(tweet_dicts, 2),
+            pickle.loads
+        ),
+        (
+            'packed records',
+            lambda: records.pack_records(tweet_records),
+            records.unpack_records
+        ),
+        (
+            'packed records + zlib',
+            lambda: records.pack_records(tweet_records, compress=True),
+            records.unpack_records
+        )
+    ]
+
+    print('{0} tweets'.format(number_of_tweets))
+    print('{0:<24}{1:>12}{2:>16}{3:>16}'.format(
+        'format', 'bytes/tweet', 'encode tweets/s', 'decode tweets/s'
+    ))
+    for name, encode, decode in formats:
+        encoded = encode()
+        encode_secs = min(timeit.repeat(encode, number=1, repeat=repeat))
+        decode_secs = min(
+            timeit.repeat(lambda: decode(encoded), number=1, repeat=repeat)
+        )
+        print('{0:<24}{1:>12.1f}{2:>16.0f}{3:>16.0f}'.format(
+            name,
+            len(encoded) / float(number_of_tweets),
+            number_of_tweets / encode_secs,
+            number_of_tweets / decode_secs
+        ))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+    else:
+        run()
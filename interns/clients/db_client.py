@@ -0,0 +1,366 @@
+"""Client for writing tweets straight to the interns database
+
+BulkTweetWriter stores batches of TweetRecords with their hashtags, urls and
+mentions through SQLAlchemy Core. On Postgres the ids of new rows are taken
+from their sequences up front so every foreign key is known before anything is
+inserted, and each table is then written with one executemany per chunk (or a
+COPY with psycopg2) instead of a flush per row. Other databases assign the ids
+of text_source, twitter_source and dictionary rows one insert at a time.
+Hashtags and mentioned user names are stored once each in their dictionary
+tables.
+"""
+import io
+import datetime
+
+from sqlalchemy import create_engine, select, func
+from sqlalchemy.exc import IntegrityError
+
+from interns.settings import interns_settings
+from interns.creds import creds
+from interns.models.models import AllowedSources, TextSource
+from interns.models.twitter_models import (
+    TwitterSource, Hashtag, TwitterUserName, TweetHashtags, TweetURLs,
+    TweetUserMentions
+)
+from interns.clients.twitter.records import (
+    base_twitter_url, created_at_to_epoch
+)
+
+database_url = creds.database_url or interns_settings.database_url
+
+engine = create_engine(database_url)
+
+text_source_table = TextSource.__table__
+twitter_source_table = TwitterSource.__table__
+hashtag_table = Hashtag.__table__
+user_name_table = TwitterUserName.__table__
+hashtags_table = TweetHashtags.__table__
+urls_table = TweetURLs.__table__
+mentions_table = TweetUserMentions.__table__
+
+
+def _chunks(items, chunk_size):
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+def _time_posted(created_at):
+    epoch = created_at_to_epoch(created_at)
+    if epoch is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(epoch)
+
+
+def _copy_value(value):
+    """Format a value for the Postgres COPY text format"""
+    if value is None:
+        return u'\\N'
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    elif not isinstance(value, type(u'')):
+        value = u'{0}'.format(value)
+    return (
+        value.replace(u'\\', u'\\\\')
+        .replace(u'\t', u'\\t')
+        .replace(u'\n', u'\\n')
+        .replace(u'\r', u'\\r')
+    )
+
+
+class BulkTweetWriter(object):
+    """Writes batches of TweetRecords to the interns database
+
+    The original of a retweet is stored as its own twitter_source row (once)
+    which the retweet's retweet_source_id points at, and the hashtags, urls and
+    mentions of a retweet belong to the original. Tweets already in the
+    database are skipped. With use_copy tables are loaded with COPY when the
+    engine is Postgres through psycopg2.
+
+    Writers running at the same time can both find a tweet (or hashtag or
+    user name) missing and try to add it, the unique constraints refuse the
+    second and its write is tried again, up to attempts times, finding the
+    first writer's rows.
+    """
+
+    def __init__(self, db_engine, chunk_size=None, use_copy=True,
+                 attempts=None):
+        if chunk_size is None:
+            chunk_size = interns_settings.db_write_chunk_size
+        if attempts is None:
+            attempts = interns_settings.db_write_attempts
+        self.engine = db_engine
+        self.chunk_size = chunk_size
+        self.attempts = attempts
+        self.use_copy = use_copy and (
+            db_engine.dialect.name == 'postgresql' and
+            db_engine.dialect.driver == 'psycopg2'
+        )
+
+    def write_records(self, records):
+        """
+        Store records and their retweeted originals in one transaction,
+        returns the number of twitter_source rows added
+        """
+        attempt = 1
+        while True:
+            try:
+                with self.engine.begin() as conn:
+                    return self._write_records(conn, records)
+            except IntegrityError:
+                if attempt >= self.attempts:
+                    raise
+                attempt += 1
+
+    def _write_records(self, conn, records):
+        tweets, source_ids = self._new_tweets(conn, records)
+        if not tweets:
+            return 0
+        text_source_ids = self._insert_returning_ids(
+            conn,
+            text_source_table,
+            [
+                {
+                    'source_key': AllowedSources.twitter.name,
+                    'source_url': base_twitter_url.format(
+                        tweet['user_name'], tweet['tweet_id']
+                    ),
+                    'written_text': tweet['tweet_text'],
+                    'time_posted': _time_posted(tweet['tweet_created'])
+                }
+                for tweet in tweets
+            ]
+        )
+        for tweet, text_source_id in zip(tweets, text_source_ids):
+            tweet['text_source_id'] = text_source_id
+
+        # Originals first so the ids retweets refer to are known
+        originals = [tweet for tweet in tweets if tweet['retweet_of'] is None]
+        retweets = [
+            tweet for tweet in tweets if tweet['retweet_of'] is not None
+        ]
+        for group in (originals, retweets):
+            twitter_source_ids = self._insert_returning_ids(
+                conn,
+                twitter_source_table,
+                [
+                    {
+                        'text_source_id': tweet['text_source_id'],
+                        'retweet_source_id': (
+                            source_ids[tweet['retweet_of']]
+                            if tweet['retweet_of'] is not None else None
+                        ),
+                        'tweeter_user_name': tweet['user_name'],
+                        'tweet_id': tweet['tweet_id'],
+                        'is_retweet': tweet['retweet_of'] is not None
+                    }
+                    for tweet in group
+                ]
+            )
+            for tweet, twitter_source_id in zip(group, twitter_source_ids):
+                tweet['twitter_source_id'] = twitter_source_id
+                source_ids[tweet['tweet_id']] = twitter_source_id
+
+        hashtag_rows = []
+        url_rows = []
+        mention_rows = []
+        for tweet in tweets:
+            twitter_source_id = tweet['twitter_source_id']
+            hashtag_rows.extend(
+                {'twitter_source_id': twitter_source_id, 'hashtag': hashtag}
+                for hashtag in tweet['hashtags']
+            )
+            url_rows.extend(
+                {'twitter_source_id': twitter_source_id, 'url': url}
+                for url in tweet['tweet_urls']
+            )
+            mention_rows.extend(
+                {'twitter_source_id': twitter_source_id, 'user_name': name}
+                for name in tweet['user_mentions']
+            )
+        hashtag_ids = self._dictionary_ids(
+            conn,
+            hashtag_table.c.hashtag,
+            set(row['hashtag'] for row in hashtag_rows)
+        )
+        for row in hashtag_rows:
+            row['hashtag_id'] = hashtag_ids[row.pop('hashtag')]
+        user_name_ids = self._dictionary_ids(
+            conn,
+            user_name_table.c.user_name,
+            set(row['user_name'] for row in mention_rows)
+        )
+        for row in mention_rows:
+            row['user_name_id'] = user_name_ids[row.pop('user_name')]
+
+        self._insert(conn, hashtags_table, hashtag_rows)
+        self._insert(conn, urls_table, url_rows)
+        self._insert(conn, mentions_table, mention_rows)
+        return len(tweets)
+
+    def _new_tweets(self, conn, records):
+        """
+        Flatten records and their originals into one dict per tweet that isn't
+        in the database yet, originals first. Returns those and a dict of tweet
+        id to twitter_source id for the tweets that are
+        """
+        tweets = {}
+        originals = []
+        retweets = []
+        for record in records:
+            entities = {
+                'user_mentions': record.user_mentions,
+                'hashtags': record.hashtags,
+                'tweet_urls': record.tweet_urls
+            }
+            if record.retweeted is not None:
+                retweeted = record.retweeted
+                original = dict(
+                    user_name=retweeted.user_name,
+                    tweet_id=retweeted.tweet_id,
+                    tweet_text=retweeted.tweet_text,
+                    tweet_created=retweeted.tweet_created,
+                    retweet_of=None,
+                    **entities
+                )
+                if original['tweet_id'] not in tweets:
+                    tweets[original['tweet_id']] = original
+                    originals.append(original)
+                entities = {
+                    'user_mentions': [], 'hashtags': [], 'tweet_urls': []
+                }
+            tweet = dict(
+                user_name=record.user_name,
+                tweet_id=record.tweet_id,
+                tweet_text=record.tweet_text,
+                tweet_created=record.tweet_created,
+                retweet_of=(
+                    record.retweeted.tweet_id
+                    if record.retweeted is not None else None
+                ),
+                **entities
+            )
+            if tweet['tweet_id'] in tweets:
+                continue
+            tweets[tweet['tweet_id']] = tweet
+            if tweet['retweet_of'] is None:
+                originals.append(tweet)
+            else:
+                retweets.append(tweet)
+
+        source_ids = self._existing_source_ids(conn, list(tweets))
+        new_tweets = [
+            tweet for tweet in originals + retweets
+            if tweet['tweet_id'] not in source_ids
+        ]
+        return new_tweets, source_ids
+
+    def _existing_source_ids(self, conn, tweet_ids):
+        """
+        Return a dict of tweet id to twitter_source id for those of tweet_ids
+        already stored
+        """
+        existing = {}
+        for chunk in _chunks(tweet_ids, self.chunk_size):
+            rows = conn.execute(
+                select([
+                    twitter_source_table.c.tweet_id,
+                    twitter_source_table.c.id
+                ]).where(twitter_source_table.c.tweet_id.in_(chunk))
+            )
+            existing.update((tweet_id, row_id) for tweet_id, row_id in rows)
+        return existing
+
+    def _dictionary_ids(self, conn, column, values):
+        """
+        Return a dict of value to the id of its row in the dictionary table of
+        column, adding rows for values that don't have one
+        """
+        table = column.table
+        ids = {}
+        values = list(values)
+        for chunk in _chunks(values, self.chunk_size):
+            rows = conn.execute(
+                select([column, table.c.id]).where(column.in_(chunk))
+            )
+            ids.update((value, row_id) for value, row_id in rows)
+        missing = [value for value in values if value not in ids]
+        if missing:
+            new_ids = self._insert_returning_ids(
+                conn, table, [{column.name: value} for value in missing]
+            )
+            ids.update(zip(missing, new_ids))
+        return ids
+
+    def _insert_returning_ids(self, conn, table, rows):
+        """
+        Insert rows into table and return their new primary keys in order. On
+        Postgres the keys are taken from the table's sequence so the rows can
+        be written in bulk, otherwise each row is inserted on its own for the
+        database to assign its key
+        """
+        if not rows:
+            return []
+        if self.engine.dialect.name != 'postgresql':
+            return [
+                conn.execute(table.insert(), row).inserted_primary_key[0]
+                for row in rows
+            ]
+        sequence_name = '{0}_id_seq'.format(table.name)
+        new_ids = [
+            row[0] for row in conn.execute(
+                select([func.nextval(sequence_name)]).select_from(
+                    func.generate_series(1, len(rows))
+                )
+            )
+        ]
+        for row, new_id in zip(rows, new_ids):
+            row['id'] = new_id
+        self._insert(conn, table, rows)
+        return new_ids
+
+    def _insert(self, conn, table, rows):
+        if not rows:
+            return
+        if self.use_copy:
+            self._copy(conn, table, rows)
+            return
+        for chunk in _chunks(rows, self.chunk_size):
+            conn.execute(table.insert(), chunk)
+
+    def _copy(self, conn, table, rows):
+        """
+        Load rows into table with a Postgres COPY in the transaction of conn
+        """
+        columns = sorted(rows[0])
+        lines = []
+        for row in rows:
+            lines.append(
+                u'\t'.join(_copy_value(row[column]) for column in columns)
+            )
+        data = io.BytesIO((u'\n'.join(lines) + u'\n').encode('utf-8'))
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY {0} ({1}) FROM STDIN'.format(
+                    table.name, ', '.join(columns)
+                ),
+                data
+            )
+        finally:
+            cursor.close()
+
+
+def get_username_last_tweet_id(screen_name):
+    """
+    Returns the latest stored tweet id of screen_name otherwise returns None,
+    read from the user name and tweet id index alone
+    """
+    with engine.connect() as conn:
+        return conn.execute(
+            select([func.max(twitter_source_table.c.tweet_id)]).where(
+                twitter_source_table.c.tweeter_user_name == screen_name
+            )
+        ).scalar()
+
+
+tweet_writer = BulkTweetWriter(engine)
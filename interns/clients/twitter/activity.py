@@ -0,0 +1,126 @@
+"""Estimates of how often each tracked twitter user tweets
+
+Workers fold the tweets returned by every poll of a user into an exponentially
+weighted moving average of the user's tweet rate, kept in memcache, and the
+scheduler reads the rates to poll active users more often than quiet ones.
+"""
+import json
+import time
+
+from interns.settings import interns_settings
+from interns.utils import get_celery_logger
+from interns.clients.twitter.records import created_at_to_epoch
+
+logger = get_celery_logger(__name__)
+
+
+def created_at_rate(timeline_tweets):
+    """
+    Return the tweets per second implied by the gaps between the created_at
+    times of timeline_tweets, None if fewer than two of them are dated
+    """
+    times = sorted(
+        epoch for epoch in (
+            created_at_to_epoch(tweet.created_at) for tweet in timeline_tweets
+        )
+        if epoch is not None
+    )
+    if len(times) < 2:
+        return None
+    return (len(times) - 1) / float(max(times[-1] - times[0], 1))
+
+
+class UserActivity(object):
+    """Tweet rate (tweets per second) per twitter user
+
+    A poll observes the tweets it returned over the time since the previous
+    poll, which is weighted in by how long that was against halflife_secs. A
+    user's first poll has nothing to measure from so the gaps between the
+    returned tweets' created_at times are used instead. With fewer than two
+    dated tweets that says nothing either, so only the poll's time is kept
+    and the user has no rate until the next poll measures one.
+    """
+
+    memcache_key_prefix = 'interns_user_activity:'
+
+    def __init__(self, memcache_client, halflife_secs, ttl_secs):
+        self.memcacheClient = memcache_client
+        self.halflife_secs = halflife_secs
+        self.ttl_secs = ttl_secs
+
+    def _memcache_key(self, screen_name):
+        return self.memcache_key_prefix + screen_name
+
+    def updated_rate(self, previous, timeline_tweets, now):
+        """
+        Return the rate of a user with the previous {'rate', 'polled_at'}
+        estimate (None if there is none, and without a rate if it could not
+        be measured) after a poll at now returned timeline_tweets. Returns
+        None if the rate still cannot be measured
+        """
+        if previous is None:
+            return created_at_rate(timeline_tweets)
+        elapsed = max(now - previous['polled_at'], 1)
+        observed = len(timeline_tweets) / float(elapsed)
+        if previous.get('rate') is None:
+            return observed
+        weight = 1 - 0.5 ** (elapsed / float(self.halflife_secs))
+        return previous['rate'] + weight * (observed - previous['rate'])
+
+    def record_poll(self, screen_name, timeline_tweets, now=None):
+        """
+        Fold the tweets returned by a poll of screen_name into its rate
+        """
+        if now is None:
+            now = time.time()
+        key = self._memcache_key(screen_name)
+        try:
+            # A racing poll of the same user is rare (its jobs are spaced by
+            # the poll interval) and only loses one observation
+            cached = self.memcacheClient.get(key)
+            previous = json.loads(cached) if cached is not None else None
+            rate = self.updated_rate(previous, timeline_tweets, now)
+            estimate = {'polled_at': now}
+            if rate is not None:
+                estimate['rate'] = rate
+            self.memcacheClient.set(
+                key, json.dumps(estimate), expire=self.ttl_secs
+            )
+        except Exception as e:
+            logger.warning('User activity update failed: %s', e)
+
+    def rates(self, screen_names, chunk_size=500):
+        """
+        Return a dict of screen_name to tweet rate for those of screen_names
+        with a measured rate
+        """
+        rates = {}
+        prefix_length = len(self.memcache_key_prefix)
+        for start in range(0, len(screen_names), chunk_size):
+            chunk = screen_names[start:start + chunk_size]
+            try:
+                cached = self.memcacheClient.get_many(
+                    [self._memcache_key(name) for name in chunk]
+                )
+            except Exception as e:
+                logger.warning('User activity lookup failed: %s', e)
+                return rates
+            for key, value in cached.items():
+                rate = json.loads(value).get('rate')
+                if rate is not None:
+                    rates[key[prefix_length:]] = rate
+        return rates
+
+
+def build_user_activity(memcache_client):
+    """
+    Build the UserActivity configured in interns_settings, returns None if
+    adaptive polling is disabled
+    """
+    if not interns_settings.twitter_adaptive_polling_enabled:
+        return None
+    return UserActivity(
+        memcache_client,
+        interns_settings.twitter_activity_halflife_secs,
+        interns_settings.twitter_activity_ttl_secs
+    )
@@ -2,57 +2,341 @@
 import sys
 
 from interns.settings import interns_settings
-from interns.clients.twitter import utils as twitter_utils
+from interns.clients.twitter import (
+    utils as twitter_utils,
+    records as twitter_records,
+    spool as twitter_spool
+)
 from interns.creds import creds
+from interns import rate_limiting, metrics, feedback
 
+import twitter
 from aquatic_twitter import client as twitter_client
 
 write_to_memcache = True
 if interns_settings.debug:
     write_to_memcache = False
 
-twitterClient = twitter_client.AquaticTwitter(
-    creds.twitter_consumer_key,
-    creds.twitter_consumer_secret,
-    creds.twitter_access_token_key,
-    creds.twitter_access_token_secret,
-    write_to_memcache
-)
 
+class TimelineApi(twitter.Api):
+    """python-twitter Api keeping the x-rate-limit headers of its last user
+    timeline response, including a response refusing the request as over the
+    limit, as timeline_rate_limit: a (remaining, reset) pair"""
+
+    timeline_path = '/statuses/user_timeline.json'
+
+    def __init__(self, *args, **kwargs):
+        super(TimelineApi, self).__init__(*args, **kwargs)
+        self.timeline_rate_limit = None
+
+    def _RequestUrl(self, url, verb, data=None, json=None):
+        # pylint: disable=invalid-name
+        response = super(TimelineApi, self)._RequestUrl(
+            url, verb, data=data, json=json
+        )
+        headers = getattr(response, 'headers', None) or {}
+        if (url.endswith(self.timeline_path) and
+                'x-rate-limit-remaining' in headers):
+            self.timeline_rate_limit = (
+                int(headers['x-rate-limit-remaining']),
+                int(headers['x-rate-limit-reset'])
+            )
+        return response
+
+
+class TwitterClientPool(object):
+    """A TimelineApi client for the timeline requests of each
+    configured twitter credential set, each with its own shared timeline
+    request budget. Adding credential sets adds their request limits to the
+    pool. An AquaticTwitter client of the first credential set is kept for
+    everything else"""
+
+    def __init__(self, credentials, write_to_memcache):
+        self.clients = {}
+        buckets = []
+        for credential in credentials:
+            bucket_name = 'twitter_timeline:{0}'.format(credential['name'])
+            self.clients[bucket_name] = TimelineApi(
+                consumer_key=credential['consumer_key'],
+                consumer_secret=credential['consumer_secret'],
+                access_token_key=credential['access_token_key'],
+                access_token_secret=credential['access_token_secret']
+            )
+            buckets.append(
+                rate_limiting.get_token_bucket(
+                    bucket_name,
+                    interns_settings.twitter_timeline_requests,
+                    interns_settings.twitter_timeline_window_secs
+                )
+            )
+        self.default_client = self.clients[buckets[0].name]
+        self.aquatic_client = twitter_client.AquaticTwitter(
+            credentials[0]['consumer_key'],
+            credentials[0]['consumer_secret'],
+            credentials[0]['access_token_key'],
+            credentials[0]['access_token_secret'],
+            write_to_memcache
+        )
+        self.buckets = dict((bucket.name, bucket) for bucket in buckets)
+        self.timeline_buckets = rate_limiting.TokenBucketPool(buckets)
+
+    def get_client(self, credential_name=None):
+        """
+        Return the timeline client for credential_name (the name of the
+        timeline bucket a request was taken from) or the default one
+        """
+        if credential_name is None:
+            return self.default_client
+        return self.clients[credential_name]
+
+    def acquire_timeline_client(self):
+        """
+        Take a timeline request from the least used credential set and return
+        (credential_name, client), returns (None, None) when every credential
+        set has used up its requests
+        """
+        bucket = self.timeline_buckets.try_acquire()
+        if bucket is None:
+            return None, None
+        return bucket.name, self.clients[bucket.name]
+
+    def try_acquire_timeline_request(self, credential_name=None):
+        """
+        Take another timeline request for the client of credential_name,
+        returns False if that credential set has none left
+        """
+        if credential_name is None:
+            credential_name = self.timeline_buckets.buckets[0].name
+        return self.buckets[credential_name].try_acquire()
+
+
+client_pool = TwitterClientPool(creds.twitter_credentials, write_to_memcache)
+
+twitterClient = client_pool.aquatic_client
 
-def get_new_user_timeline_tweets(screen_name, logger):
+timeline_rate_bucket = client_pool.timeline_buckets
+
+
+def is_rate_limit_error(error):
+    """
+    Check to see if error is twitter refusing a request as over the rate
+    limit, python-twitter raises a TwitterError carrying error code 88
+    """
+    details = getattr(error, 'message', None)
+    if details is None and error.args:
+        details = error.args[0]
+    if isinstance(details, list):
+        return any(
+            isinstance(detail, dict) and detail.get('code') == 88
+            for detail in details
+        )
+    return 'Rate limit exceeded' in str(error)
+
+
+def timeline_rate_limit_report(credential_name, api_client,
+                               rate_limited=False):
     """
-    Pull as many tweets as possible for a newly added user
+    Return a feedback report of the timeline budget of credential_name as of
+    the x-rate-limit headers of api_client's last timeline response, so no
+    request is made
+    """
+    remaining = None
+    reset = None
+    if api_client.timeline_rate_limit is not None:
+        remaining, reset = api_client.timeline_rate_limit
+    return feedback.make_report(
+        credential_name, remaining, reset, rate_limited
+    )
+
+
+def new_tweet_batch():
+    """
+    Return a TweetDataBatch using the seen tweet filter
+    """
+    return twitter_utils.TweetDataBatch(
+        seen_filter=twitter_utils.seen_tweet_filter,
+        retweet_references=interns_settings.retweet_references_enabled
+    )
+
+
+def send_tweet_records(records):
+    """
+    Send TweetRecords to eleanor, returns (tweet_id, error) failures. Records
+    the seen tweet filter has already had sent are skipped, they are left in
+    a spool frame whose replay was cut short after eleanor accepted them
+    """
+    seen_filter = twitter_utils.seen_tweet_filter
+    if seen_filter is not None:
+        seen_ids = seen_filter.seen_ids(
+            [record.tweet_id for record in records]
+        )
+        records = [
+            record for record in records if record.tweet_id not in seen_ids
+        ]
+    tweet_batch = new_tweet_batch()
+    failures = []
+    for record in records:
+        failures.extend(tweet_batch.add_record(record))
+    failures.extend(tweet_batch.flush())
+    return failures
+
+
+def spool_timeline_tweets(timeline_tweets, logger):
+    """
+    Convert timeline tweets and append them to the tweet spool, returns
+    (tweet_id, error) failures from conversion or None if the spool could not
+    be written
+    """
+    records = []
+    failures = []
+    for tweet in timeline_tweets:
+        try:
+            records.append(twitter_records.TweetRecord.from_tweet(tweet))
+        except Exception as e:
+            failures.append((getattr(tweet, 'id_str', None), e))
+    try:
+        twitter_utils.tweet_spool.append(records)
+    except (IOError, OSError) as e:
+        logger.warning('Unable to spool tweets, sending directly: %s', e)
+        return None
+    return failures
+
+
+def ingest_timeline_tweets(screen_name, timeline_tweets, logger,
+                           update_last_tweet_id=True):
+    """
+    Send timeline tweets to eleanor, through the tweet spool if it is enabled
+    otherwise directly in batches, logging any tweets that could not be added
+    without failing the rest of the batch. Tweets the seen tweet filter has
+    already had sent are skipped, and retweets of originals it has seen are
+    sent as references. With update_last_tweet_id the newest added tweet id
+    is recorded as the user's last tweet id
+    """
+    seen_filter = twitter_utils.seen_tweet_filter
+    unseen_tweets = timeline_tweets
+    if seen_filter is not None:
+        unseen_tweets = seen_filter.unseen(timeline_tweets)
+        if len(unseen_tweets) < len(timeline_tweets):
+            logger.debug(
+                'Skipping %s already added tweets of twitter user %s',
+                len(timeline_tweets) - len(unseen_tweets),
+                screen_name
+            )
+    failures = None
+    if twitter_utils.tweet_spool is not None:
+        failures = spool_timeline_tweets(unseen_tweets, logger)
+    if failures is None:
+        tweet_batch = new_tweet_batch()
+        failures = []
+        for tweet in unseen_tweets:
+            failures.extend(tweet_batch.add(tweet))
+        failures.extend(tweet_batch.flush())
+    failed_ids = set(tweet_id for tweet_id, _ in failures)
+    ingested_ids = [
+        tweet.id for tweet in timeline_tweets if tweet.id_str not in failed_ids
+    ]
+    if ingested_ids and update_last_tweet_id:
+        twitter_utils.last_tweet_id_cache.update(
+            screen_name, max(ingested_ids)
+        )
+    for tweet_id, e in failures:
+        logger.error(
+            (
+                'Error attempting to add twitter user %s '
+                'timeline tweet %s: %s'
+            ),
+            screen_name,
+            tweet_id,
+            e
+        )
+
+
+def get_timeline_page(api_client, screen_name, since_id=None, max_id=None):
+    """
+    Request one page of screen_name's timeline tweets, newest first, newer
+    than since_id and no newer than max_id if given
+    """
+    with metrics.timed_twitter_call('get_user_timeline'):
+        return api_client.GetUserTimeline(
+            screen_name=screen_name,
+            since_id=since_id,
+            max_id=max_id,
+            count=interns_settings.twitter_timeline_page_size
+        )
+
+
+def get_new_user_timeline_tweets(screen_name, logger, api_client=None,
+                                 credential_name=None):
+    """
+    Pull as many tweets as possible for a newly added user, using api_client
+    if given otherwise the default timeline client, paging back until an
+    empty page (the API only serves the most recent 3200 tweets). Pages are
+    stored as they arrive and the oldest stored tweet id is checkpointed so an
+    interrupted backfill resumes where it stopped. Every page after the first
+    takes another request from credential_name's timeline budget just before
+    it is requested, when that runs out the backfill stops and is resumed by
+    a later poll. The user's last tweet id is only recorded once a fresh
+    backfill completes, until then polls find the checkpoint
     """
     # pylint: disable=expression-not-assigned
     logger.debug(
         'Getting timeline tweets for twitter user: %s',
         screen_name
     )
-    logger.info('Making twitter timeline request')
-    timeline_tweets = twitterClient.get_timeline_tweets(screen_name)
-    if not interns_settings.debug:
-        for tweet in timeline_tweets:
-            try:
-                twitter_utils.insert_tweet_data(tweet)
-            except Exception as e:
-                logger.error(
-                    (
-                        'Error attempting to get twitter user %s '
-                        'timeline tweets %s'
-                    ),
-                    screen_name,
-                    e
+    if api_client is None:
+        api_client = client_pool.default_client
+    max_id = twitter_utils.get_backfill_checkpoint(screen_name)
+    if max_id is not None:
+        logger.info(
+            'Resuming twitter user %s backfill from tweet id %s',
+            screen_name,
+            max_id
+        )
+    # Only the newest page of a fresh backfill says how often the user tweets
+    # and what its newest tweet is
+    fresh_backfill = max_id is None
+    newest_id = None
+    while True:
+        logger.info('Making twitter timeline request')
+        timeline_tweets = get_timeline_page(
+            api_client, screen_name, max_id=max_id
+        )
+        if not timeline_tweets:
+            break
+        if fresh_backfill and newest_id is None:
+            newest_id = max(tweet.id for tweet in timeline_tweets)
+            if twitter_utils.user_activity is not None:
+                twitter_utils.user_activity.record_poll(
+                    screen_name, timeline_tweets
                 )
-                continue
-
-    else:
-        [sys.stdout.write(str(tweet.id) + '\n') for tweet in timeline_tweets]
+        if not interns_settings.debug:
+            ingest_timeline_tweets(
+                screen_name, timeline_tweets, logger,
+                update_last_tweet_id=False
+            )
+        else:
+            [
+                sys.stdout.write(str(tweet.id) + '\n')
+                for tweet in timeline_tweets
+            ]
+        max_id = min(tweet.id for tweet in timeline_tweets) - 1
+        twitter_utils.set_backfill_checkpoint(screen_name, max_id)
+        if not client_pool.try_acquire_timeline_request(credential_name):
+            logger.info(
+                'Twitter timeline budget used up, pausing user %s backfill',
+                screen_name
+            )
+            return
+    twitter_utils.clear_backfill_checkpoint(screen_name)
+    if newest_id is not None:
+        twitter_utils.last_tweet_id_cache.update(screen_name, newest_id)
 
 
-def get_user_timeline_tweets(screen_name, last_tweet_id, logger):
+def get_user_timeline_tweets(screen_name, last_tweet_id, logger,
+                             api_client=None):
     """
-    Pull tweets for a user that already has entries in the database
+    Pull tweets for a user that already has entries in the database, using
+    api_client if given otherwise the default timeline client
     """
     # pylint: disable=expression-not-assigned
     logger.debug(
@@ -63,25 +347,26 @@ def get_user_timeline_tweets(screen_name, last_tweet_id, logger):
         screen_name,
         last_tweet_id
     )
+    if api_client is None:
+        api_client = client_pool.default_client
     logger.info('Making twitter timeline request')
-    timeline_tweets = twitterClient.get_timeline_tweets_since_id(
-        screen_name,
-        last_tweet_id
+    timeline_tweets = get_timeline_page(
+        api_client, screen_name, since_id=last_tweet_id
     )
     if not interns_settings.debug:
-        for tweet in timeline_tweets:
-            try:
-                twitter_utils.insert_tweet_data(tweet)
-            except Exception as e:
-                logger.error(
-                    (
-                        'Error attempting to get twitter user %s '
-                        'timeline tweets %s'
-                    ),
-                    screen_name,
-                    e
-                )
-                continue
-
+        ingest_timeline_tweets(screen_name, timeline_tweets, logger)
     else:
         [sys.stdout.write(str(tweet.id) + '\n') for tweet in timeline_tweets]
+    if twitter_utils.user_activity is not None:
+        twitter_utils.user_activity.record_poll(screen_name, timeline_tweets)
+
+
+spool_replayer = None
+if twitter_utils.tweet_spool is not None:
+    spool_replayer = twitter_spool.SpoolReplayer(
+        twitter_utils.tweet_spool,
+        send_tweet_records,
+        interns_settings.spool_replay_poll_secs,
+        interns_settings.spool_replay_backoff_secs,
+        interns_settings.spool_replay_max_backoff_secs
+    )
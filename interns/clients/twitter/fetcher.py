@@ -0,0 +1,51 @@
+"""Concurrent polling of twitter user timelines"""
+import threading
+import Queue
+
+
+class ConcurrentTimelineFetcher(object):
+    """Polls many twitter users at once from a single process
+
+    The twitter and eleanor clients block on network calls, so each poll runs
+    on one of up to max_in_flight threads and a worker process keeps that many
+    requests in flight instead of one. poll_user is called with a username and
+    can be swapped for a stub to exercise the fetcher against fake services.
+    """
+
+    def __init__(self, poll_user, max_in_flight):
+        self.poll_user = poll_user
+        self.max_in_flight = max_in_flight
+
+    def fetch(self, usernames):
+        """
+        Call poll_user for every username. Returns a (results, errors) tuple
+        of dicts mapping username to poll_user's return value or to the
+        exception it raised
+        """
+        pending_usernames = Queue.Queue()
+        for username in usernames:
+            pending_usernames.put(username)
+        results = {}
+        errors = {}
+
+        def poll_pending_users():
+            while True:
+                try:
+                    username = pending_usernames.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[username] = self.poll_user(username)
+                except Exception as e:
+                    errors[username] = e
+
+        threads = [
+            threading.Thread(target=poll_pending_users)
+            for _ in range(min(self.max_in_flight, len(usernames)))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
@@ -0,0 +1,352 @@
+"""Compact tweet records and their binary wire format"""
+import struct
+import calendar
+import time
+import zlib
+
+
+base_twitter_url = 'https://twitter.com/{0}/status/{1}'
+
+format_version = 1
+
+packed_raw = b'R'
+packed_zlib = b'Z'
+
+flag_retweet = 0x01
+flag_created_epoch = 0x02
+flag_retweet_created_epoch = 0x04
+
+created_at_days = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+created_at_months = (
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'
+)
+
+tweet_id_struct = struct.Struct('>Q')
+epoch_struct = struct.Struct('>I')
+
+
+def created_at_to_epoch(created_at):
+    """
+    Convert a twitter created_at string ('Wed Oct 10 20:19:24 +0000 2018') to
+    seconds since the epoch, returns None if it isn't in that format
+    """
+    parts = created_at.split(' ')
+    if len(parts) != 6 or parts[4] != '+0000':
+        return None
+    try:
+        month = created_at_months.index(parts[1]) + 1
+        hour, minute, second = [int(part) for part in parts[3].split(':')]
+        epoch = calendar.timegm(
+            (int(parts[5]), month, int(parts[2]), hour, minute, second)
+        )
+    except ValueError:
+        return None
+    if epoch_to_created_at(epoch) != created_at:
+        return None
+    return epoch
+
+
+def epoch_to_created_at(epoch):
+    """
+    Convert seconds since the epoch to a twitter created_at string
+    """
+    utc = time.gmtime(epoch)
+    return '{0} {1} {2:02d} {3:02d}:{4:02d}:{5:02d} +0000 {6}'.format(
+        created_at_days[utc.tm_wday],
+        created_at_months[utc.tm_mon - 1],
+        utc.tm_mday,
+        utc.tm_hour,
+        utc.tm_min,
+        utc.tm_sec,
+        utc.tm_year
+    )
+
+
+class RetweetedRecord(object):
+    """The original tweet of a retweet, its mentions, hashtags and urls are
+    kept on the retweeting TweetRecord"""
+
+    __slots__ = ('user_name', 'tweet_id', 'tweet_text', 'tweet_created')
+
+    def __init__(self, user_name, tweet_id, tweet_text, tweet_created):
+        self.user_name = user_name
+        self.tweet_id = tweet_id
+        self.tweet_text = tweet_text
+        self.tweet_created = tweet_created
+
+
+class TweetRecord(object):
+    """A single tweet with only the fields interns stores
+
+    Urls are rebuilt from the user name and tweet id rather than kept, and for
+    a retweet the mentions, hashtags and urls are the original tweet's (as
+    eleanor has always been sent them) so they are kept once.
+    """
+
+    __slots__ = (
+        'user_name', 'tweet_id', 'tweet_text', 'tweet_created',
+        'user_mentions', 'hashtags', 'tweet_urls', 'retweeted'
+    )
+
+    def __init__(self, user_name, tweet_id, tweet_text, tweet_created,
+                 user_mentions, hashtags, tweet_urls, retweeted=None):
+        self.user_name = user_name
+        self.tweet_id = tweet_id
+        self.tweet_text = tweet_text
+        self.tweet_created = tweet_created
+        self.user_mentions = user_mentions
+        self.hashtags = hashtags
+        self.tweet_urls = tweet_urls
+        self.retweeted = retweeted
+
+    @classmethod
+    def from_tweet(cls, tweet):
+        """
+        Build a record from a tweet object pulled from the twitter library
+        """
+        retweeted = None
+        entities = tweet
+        if tweet.retweeted_status is not None:
+            retweet = tweet.retweeted_status
+            retweeted = RetweetedRecord(
+                retweet.user.screen_name,
+                int(retweet.id_str),
+                retweet.text,
+                retweet.created_at
+            )
+            entities = retweet
+        return cls(
+            tweet.user.screen_name,
+            int(tweet.id_str),
+            tweet.text,
+            tweet.created_at,
+            [user.screen_name for user in entities.user_mentions],
+            [hashtag.text for hashtag in entities.hashtags],
+            [url.expanded_url for url in entities.urls],
+            retweeted
+        )
+
+    def to_tweet_data(self, retweet_reference=False):
+        """
+        Return the dict that eleanor expects for tweet data. With
+        retweet_reference the original of a retweet is only referred to by its
+        tweet id, for originals eleanor already has, and its text, mentions,
+        hashtags and urls are left out
+        """
+        tweet_id_str = str(self.tweet_id)
+        retweet_data = {}
+        if self.retweeted is not None and retweet_reference:
+            retweet_id_str = str(self.retweeted.tweet_id)
+            return {
+                "user_name": self.user_name,
+                "tweet_id": tweet_id_str,
+                "url": base_twitter_url.format(self.user_name, tweet_id_str),
+                "tweet_text": self.tweet_text,
+                "tweet_created": self.tweet_created,
+                "is_retweet": True,
+                "user_mentions": [],
+                "hashtags": [],
+                "tweet_urls": [],
+                "retweet_data": {
+                    "user_name": self.retweeted.user_name,
+                    "tweet_id": retweet_id_str,
+                    "url": base_twitter_url.format(
+                        self.retweeted.user_name,
+                        retweet_id_str
+                    ),
+                    "is_reference": True
+                }
+            }
+        if self.retweeted is not None:
+            retweet_id_str = str(self.retweeted.tweet_id)
+            retweet_data = {
+                "user_name": self.retweeted.user_name,
+                "tweet_id": retweet_id_str,
+                "url": base_twitter_url.format(
+                    self.retweeted.user_name,
+                    retweet_id_str
+                ),
+                "tweet_text": self.retweeted.tweet_text,
+                "tweet_created": self.retweeted.tweet_created,
+                "is_retweet": False,
+                "user_mentions": list(self.user_mentions),
+                "hashtags": list(self.hashtags),
+                "tweet_urls": list(self.tweet_urls)
+            }
+        return {
+            "user_name": self.user_name,
+            "tweet_id": tweet_id_str,
+            "url": base_twitter_url.format(self.user_name, tweet_id_str),
+            "tweet_text": self.tweet_text,
+            "tweet_created": self.tweet_created,
+            "is_retweet": self.retweeted is not None,
+            "user_mentions": self.user_mentions,
+            "hashtags": self.hashtags,
+            "tweet_urls": self.tweet_urls,
+            "retweet_data": retweet_data
+        }
+
+
+def _pack_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _unpack_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _pack_text(out, text):
+    encoded = text.encode('utf-8')
+    _pack_varint(out, len(encoded))
+    out.extend(encoded)
+
+
+def _unpack_text(data, offset):
+    length, offset = _unpack_varint(data, offset)
+    end = offset + length
+    return bytes(data[offset:end]).decode('utf-8'), end
+
+
+def _pack_texts(out, texts):
+    _pack_varint(out, len(texts))
+    for text in texts:
+        _pack_text(out, text)
+
+
+def _unpack_texts(data, offset):
+    count, offset = _unpack_varint(data, offset)
+    texts = []
+    for _ in range(count):
+        text, offset = _unpack_text(data, offset)
+        texts.append(text)
+    return texts, offset
+
+
+def _pack_created(out, created_at):
+    epoch = created_at_to_epoch(created_at)
+    if epoch is None:
+        _pack_text(out, created_at)
+        return False
+    out.extend(epoch_struct.pack(epoch))
+    return True
+
+
+def _unpack_created(data, offset, as_epoch):
+    if not as_epoch:
+        return _unpack_text(data, offset)
+    end = offset + epoch_struct.size
+    epoch = epoch_struct.unpack(bytes(data[offset:end]))[0]
+    return epoch_to_created_at(epoch), end
+
+
+def pack_record(out, record):
+    """
+    Append the binary form of record to the bytearray out
+    """
+    flags_offset = len(out)
+    flags = 0
+    out.append(0)
+    out.extend(tweet_id_struct.pack(record.tweet_id))
+    _pack_text(out, record.user_name)
+    _pack_text(out, record.tweet_text)
+    if _pack_created(out, record.tweet_created):
+        flags |= flag_created_epoch
+    _pack_texts(out, record.user_mentions)
+    _pack_texts(out, record.hashtags)
+    _pack_texts(out, record.tweet_urls)
+    if record.retweeted is not None:
+        flags |= flag_retweet
+        retweeted = record.retweeted
+        out.extend(tweet_id_struct.pack(retweeted.tweet_id))
+        _pack_text(out, retweeted.user_name)
+        _pack_text(out, retweeted.tweet_text)
+        if _pack_created(out, retweeted.tweet_created):
+            flags |= flag_retweet_created_epoch
+    out[flags_offset] = flags
+
+
+def unpack_record(data, offset):
+    """
+    Read a record from the bytearray data starting at offset, returns the
+    record and the offset following it
+    """
+    flags = data[offset]
+    offset += 1
+    end = offset + tweet_id_struct.size
+    tweet_id = tweet_id_struct.unpack(bytes(data[offset:end]))[0]
+    user_name, offset = _unpack_text(data, end)
+    tweet_text, offset = _unpack_text(data, offset)
+    tweet_created, offset = _unpack_created(
+        data, offset, flags & flag_created_epoch
+    )
+    user_mentions, offset = _unpack_texts(data, offset)
+    hashtags, offset = _unpack_texts(data, offset)
+    tweet_urls, offset = _unpack_texts(data, offset)
+    retweeted = None
+    if flags & flag_retweet:
+        end = offset + tweet_id_struct.size
+        retweet_id = tweet_id_struct.unpack(bytes(data[offset:end]))[0]
+        retweet_user_name, offset = _unpack_text(data, end)
+        retweet_text, offset = _unpack_text(data, offset)
+        retweet_created, offset = _unpack_created(
+            data, offset, flags & flag_retweet_created_epoch
+        )
+        retweeted = RetweetedRecord(
+            retweet_user_name, retweet_id, retweet_text, retweet_created
+        )
+    record = TweetRecord(
+        user_name, tweet_id, tweet_text, tweet_created, user_mentions,
+        hashtags, tweet_urls, retweeted
+    )
+    return record, offset
+
+
+def pack_records(records, compress=False):
+    """
+    Serialize records to bytes, zlib compressing the body if compress is True
+    """
+    body = bytearray()
+    body.append(format_version)
+    _pack_varint(body, len(records))
+    for record in records:
+        pack_record(body, record)
+    if compress:
+        return packed_zlib + zlib.compress(bytes(body))
+    return packed_raw + bytes(body)
+
+
+def unpack_records(packed):
+    """
+    Deserialize bytes made by pack_records back into a list of records
+    """
+    kind = packed[:1]
+    if kind == packed_zlib:
+        body = bytearray(zlib.decompress(packed[1:]))
+    elif kind == packed_raw:
+        body = bytearray(packed[1:])
+    else:
+        raise ValueError(
+            'Unknown packed tweet records type {0!r}'.format(kind)
+        )
+    if body[0] != format_version:
+        raise ValueError(
+            'Unsupported packed tweet records version {0}'.format(body[0])
+        )
+    count, offset = _unpack_varint(body, 1)
+    records = []
+    for _ in range(count):
+        record, offset = unpack_record(body, offset)
+        records.append(record)
+    return records
@@ -0,0 +1,186 @@
+"""Filter for tweets that have already been sent to eleanor"""
+import math
+import threading
+
+from interns.settings import interns_settings
+from interns.utils import get_celery_logger
+
+logger = get_celery_logger(__name__)
+
+mask_64 = (1 << 64) - 1
+
+
+def _mix_64(value):
+    """splitmix64 finalizer, spreads tweet ids over all 64 bits"""
+    value = (value + 0x9e3779b97f4a7c15) & mask_64
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & mask_64
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & mask_64
+    return value ^ (value >> 31)
+
+
+class BloomFilter(object):
+    """Bloom filter of integer ids sized for capacity ids at error_rate false
+    positives"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.number_of_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        )))
+        self.number_of_hashes = max(1, int(round(
+            self.number_of_bits / float(capacity) * math.log(2)
+        )))
+        self.bits = bytearray((self.number_of_bits + 7) // 8)
+        self.count = 0
+
+    @classmethod
+    def for_memory(cls, memory_bytes, error_rate):
+        """
+        Build the filter holding the most ids at error_rate in memory_bytes
+        """
+        capacity = int(
+            memory_bytes * 8 * (math.log(2) ** 2) / -math.log(error_rate)
+        )
+        return cls(max(1, capacity), error_rate)
+
+    def _bit_indexes(self, item_id):
+        first_hash = _mix_64(item_id)
+        second_hash = _mix_64(first_hash) | 1
+        for index in range(self.number_of_hashes):
+            yield (first_hash + index * second_hash) % self.number_of_bits
+
+    def add(self, item_id):
+        """Add item_id to the filter"""
+        for bit_index in self._bit_indexes(item_id):
+            self.bits[bit_index >> 3] |= 1 << (bit_index & 7)
+        self.count += 1
+
+    def __contains__(self, item_id):
+        for bit_index in self._bit_indexes(item_id):
+            if not self.bits[bit_index >> 3] & (1 << (bit_index & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        """Check to see if the filter holds its capacity"""
+        return self.count >= self.capacity
+
+
+class SeenTweetFilter(object):
+    """Tweet ids already sent to eleanor
+
+    Ids are kept in two generations of bloom filters that split the memory
+    budget; when the newer one is full the older one is dropped, so memory
+    stays fixed and the oldest ids are forgotten first. A tweet the local
+    filters have not seen is also looked up in memcache (if a client is given)
+    where every worker records the ids it sends, so duplicates across workers
+    are caught too. A bloom filter false positive skips a new tweet, at the
+    configured error_rate.
+    """
+
+    memcache_key_prefix = 'interns_seen_tweet:'
+
+    def __init__(self, memory_bytes, error_rate, memcache_client=None,
+                 memcache_ttl_secs=0):
+        self.memory_bytes = memory_bytes
+        self.error_rate = error_rate
+        self.memcacheClient = memcache_client
+        self.memcache_ttl_secs = memcache_ttl_secs
+        self.current = self._new_generation()
+        self.previous = None
+        self.lock = threading.Lock()
+
+    def _new_generation(self):
+        return BloomFilter.for_memory(self.memory_bytes // 2, self.error_rate)
+
+    def _memcache_key(self, tweet_id):
+        return '{0}{1}'.format(self.memcache_key_prefix, tweet_id)
+
+    def _seen_locally(self, tweet_id):
+        if tweet_id in self.current:
+            return True
+        return self.previous is not None and tweet_id in self.previous
+
+    def _add_locally(self, tweet_id):
+        if self.current.is_full():
+            self.previous = self.current
+            self.current = self._new_generation()
+        self.current.add(tweet_id)
+
+    def seen_ids(self, tweet_ids):
+        """
+        Return the set of tweet_ids that have been marked seen
+        """
+        with self.lock:
+            seen = set(
+                tweet_id for tweet_id in tweet_ids
+                if self._seen_locally(tweet_id)
+            )
+        unknown_ids = [
+            tweet_id for tweet_id in tweet_ids if tweet_id not in seen
+        ]
+        if not unknown_ids or self.memcacheClient is None:
+            return seen
+        try:
+            shared_seen = self.memcacheClient.get_many(
+                [self._memcache_key(tweet_id) for tweet_id in unknown_ids]
+            )
+        except Exception as e:
+            logger.warning(
+                'Seen tweets memcache lookup failed, using local: %s', e
+            )
+            return seen
+        with self.lock:
+            for tweet_id in unknown_ids:
+                if self._memcache_key(tweet_id) in shared_seen:
+                    self._add_locally(tweet_id)
+                    seen.add(tweet_id)
+        return seen
+
+    def unseen(self, tweets):
+        """
+        Return the tweets from tweets whose ids have not been marked seen
+        """
+        seen = self.seen_ids([tweet.id for tweet in tweets])
+        return [tweet for tweet in tweets if tweet.id not in seen]
+
+    def mark_seen(self, tweet_ids):
+        """
+        Record that the tweets with tweet_ids have been sent to eleanor
+        """
+        tweet_ids = list(tweet_ids)
+        with self.lock:
+            for tweet_id in tweet_ids:
+                self._add_locally(tweet_id)
+        if not tweet_ids or self.memcacheClient is None:
+            return
+        try:
+            self.memcacheClient.set_many(
+                dict(
+                    (self._memcache_key(tweet_id), '1')
+                    for tweet_id in tweet_ids
+                ),
+                expire=self.memcache_ttl_secs
+            )
+        except Exception as e:
+            # The local filters still hold the ids, other workers may send
+            # them again which eleanor tolerates
+            logger.warning('Seen tweets memcache update failed: %s', e)
+
+
+def build_seen_tweet_filter(memcache_client):
+    """
+    Build the SeenTweetFilter configured in interns_settings, returns None if
+    the filter is disabled
+    """
+    if not interns_settings.seen_tweets_filter_enabled:
+        return None
+    if not interns_settings.seen_tweets_shared:
+        memcache_client = None
+    return SeenTweetFilter(
+        interns_settings.seen_tweets_memory_bytes,
+        interns_settings.seen_tweets_error_rate,
+        memcache_client,
+        interns_settings.seen_tweets_ttl_secs
+    )
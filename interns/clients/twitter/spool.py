@@ -0,0 +1,458 @@
+"""On disk write-ahead spool of tweets waiting to be sent to eleanor
+
+Workers append converted tweets to the spool as soon as they are fetched and a
+replayer thread in each worker process sends them on to eleanor in bulk, so a
+slow or unavailable eleanor neither stalls polling nor loses tweets.
+
+The spool is a directory of append-only segment files, each a sequence of
+frames of a length, a crc32 and a pack_records body. A process writes to its
+own <start>-<pid>-<seq>.open segment and renames it to .seg once it is big or
+old enough. A replayer claims a sealed segment by renaming it to
+.seg.<pid>.claim, sends its frames and then deletes it. The offset after the
+last frame sent is kept in a .seg.sent file beside it, so a segment handed
+back part way through, because eleanor went down or its replayer died, is
+resumed after that frame. Segments left open or claimed by processes that have
+died are sealed again so another replayer picks them up. Tweets eleanor
+rejects are moved to dead/ so one bad tweet cannot block a segment, only
+failing to reach eleanor holds a segment back.
+"""
+import os
+import mmap
+import time
+import zlib
+import errno
+import socket
+import struct
+import threading
+
+from interns.settings import interns_settings
+from interns.utils import get_celery_logger
+from interns.clients.twitter.records import pack_records, unpack_records
+
+logger = get_celery_logger(__name__)
+
+frame_header = struct.Struct('>II')
+
+open_suffix = '.open'
+sealed_suffix = '.seg'
+claim_suffix = '.claim'
+progress_suffix = '.sent'
+dead_dir_name = 'dead'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _segment_pid(file_name):
+    """Return the pid of the writer of a segment file name"""
+    return int(file_name.split('-')[1])
+
+
+def _claim_pid(file_name):
+    """Return the pid of the replayer of a claimed segment file name"""
+    return int(file_name[:-len(claim_suffix)].rsplit('.', 1)[1])
+
+
+def _sealed_path(path):
+    """Return the sealed path of a sealed or claimed segment path"""
+    return path[:path.rindex(sealed_suffix) + len(sealed_suffix)]
+
+
+def pack_frame(records, compress=False):
+    """
+    Serialize records to a spool frame
+    """
+    body = pack_records(records, compress)
+    return frame_header.pack(len(body), zlib.crc32(body) & 0xffffffff) + body
+
+
+def iter_frames(data, offset=0):
+    """
+    Yield (end offset, records) for each complete frame in data from offset.
+    Stops at the first truncated or corrupt frame, which is what a crash part
+    way through an append leaves at the end of a segment
+    """
+    while offset + frame_header.size <= len(data):
+        length, crc = frame_header.unpack(
+            data[offset:offset + frame_header.size]
+        )
+        start = offset + frame_header.size
+        body = data[start:start + length]
+        if len(body) < length or zlib.crc32(body) & 0xffffffff != crc:
+            logger.warning(
+                'Spool segment frame at %s is truncated or corrupt', offset
+            )
+            return
+        offset = start + length
+        yield offset, unpack_records(body)
+
+
+class TweetSpool(object):
+    """A directory of append-only tweet segment files
+
+    Segments are sealed once they hold segment_max_bytes or are
+    segment_max_age_secs old. With fsync every append is flushed to disk
+    before returning, otherwise only to the operating system.
+    """
+
+    def __init__(self, directory, segment_max_bytes, segment_max_age_secs,
+                 fsync=False, compress=False, mmap_reads=False):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age_secs = segment_max_age_secs
+        self.fsync = fsync
+        self.compress = compress
+        self.mmap_reads = mmap_reads
+        self.dead_directory = os.path.join(directory, dead_dir_name)
+        self.segment = None
+        self.segment_path = None
+        self.segment_opened = None
+        self.segment_pid = None
+        self.segment_seq = 0
+        self.lock = threading.Lock()
+
+    def _ensure_directories(self):
+        for path in (self.directory, self.dead_directory):
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def _open_segment(self):
+        self._ensure_directories()
+        self.segment_seq += 1
+        self.segment_path = os.path.join(
+            self.directory,
+            '{0:013d}-{1}-{2}{3}'.format(
+                int(time.time() * 1000),
+                os.getpid(),
+                self.segment_seq,
+                open_suffix
+            )
+        )
+        self.segment = open(self.segment_path, 'ab')
+        self.segment_opened = time.time()
+        self.segment_pid = os.getpid()
+
+    def _seal_segment(self):
+        self.segment.close()
+        os.rename(
+            self.segment_path,
+            self.segment_path[:-len(open_suffix)] + sealed_suffix
+        )
+        self.segment = None
+        self.segment_path = None
+        self.segment_opened = None
+
+    def _segment_due(self):
+        if self.segment is None:
+            return False
+        if self.segment.tell() >= self.segment_max_bytes:
+            return True
+        segment_age = time.time() - self.segment_opened
+        return segment_age >= self.segment_max_age_secs
+
+    def append(self, records):
+        """
+        Write records to the current segment of this process
+        """
+        if not records:
+            return
+        frame = pack_frame(records, self.compress)
+        with self.lock:
+            if self.segment is not None and self.segment_pid != os.getpid():
+                # Forked since the segment was opened, it is the parent's
+                self.segment = None
+            if self.segment is None:
+                self._open_segment()
+            self.segment.write(frame)
+            self.segment.flush()
+            if self.fsync:
+                os.fsync(self.segment.fileno())
+            if self._segment_due():
+                self._seal_segment()
+
+    def seal_if_due(self):
+        """
+        Seal the current segment if it is big or old enough to be replayed
+        """
+        with self.lock:
+            if self._segment_due():
+                self._seal_segment()
+
+    def close(self):
+        """
+        Seal the current segment, whatever its size
+        """
+        with self.lock:
+            if self.segment is not None:
+                self._seal_segment()
+
+    def recover_abandoned(self):
+        """
+        Seal segments left open or claimed by processes that are not running
+        """
+        self._ensure_directories()
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            try:
+                if file_name.endswith(open_suffix):
+                    if not _pid_alive(_segment_pid(file_name)):
+                        os.rename(
+                            path, path[:-len(open_suffix)] + sealed_suffix
+                        )
+                elif file_name.endswith(claim_suffix):
+                    if not _pid_alive(_claim_pid(file_name)):
+                        os.rename(path, _sealed_path(path))
+            except (OSError, ValueError, IndexError) as e:
+                logger.warning(
+                    'Unable to recover spool segment %s: %s', file_name, e
+                )
+
+    def sealed_segments(self):
+        """
+        Return the paths of the sealed segments, oldest first
+        """
+        return [
+            os.path.join(self.directory, file_name)
+            for file_name in sorted(os.listdir(self.directory))
+            if file_name.endswith(sealed_suffix)
+        ]
+
+    def claim(self, segment_path):
+        """
+        Claim a sealed segment for replay, returns the claimed path or None if
+        another replayer got it first
+        """
+        claimed_path = '{0}.{1}{2}'.format(
+            segment_path, os.getpid(), claim_suffix
+        )
+        try:
+            os.rename(segment_path, claimed_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return claimed_path
+
+    def read_segment(self, segment_path, offset=0):
+        """
+        Return a list of (end offset, records) for each frame of a segment
+        from offset
+        """
+        with open(segment_path, 'rb') as segment:
+            if not self.mmap_reads:
+                segment.seek(offset)
+                return [
+                    (offset + end_offset, records)
+                    for end_offset, records in iter_frames(segment.read())
+                ]
+            if os.fstat(segment.fileno()).st_size <= offset:
+                return []
+            mapped = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return list(iter_frames(mapped, offset))
+            finally:
+                mapped.close()
+
+    def progress_path(self, segment_path):
+        """
+        Return the path of the file recording how much of a sealed or claimed
+        segment was sent
+        """
+        return _sealed_path(segment_path) + progress_suffix
+
+    def sent_offset(self, segment_path):
+        """
+        Return the offset after the last frame of a sealed or claimed segment
+        that was sent, 0 if none were
+        """
+        try:
+            with open(self.progress_path(segment_path)) as progress:
+                return int(progress.read())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def record_sent(self, segment_path, offset):
+        """
+        Record that the frames of a claimed segment up to offset were sent
+        """
+        with open(self.progress_path(segment_path), 'w') as progress:
+            progress.write(str(offset))
+
+    def remove_segment(self, segment_path):
+        """
+        Delete a claimed segment once all of its frames were sent
+        """
+        # Nothing would remove a progress file left without its segment
+        try:
+            os.remove(self.progress_path(segment_path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        os.remove(segment_path)
+
+    def write_dead(self, records):
+        """
+        Keep records eleanor would not accept in the dead directory
+        """
+        self._ensure_directories()
+        dead_path = os.path.join(
+            self.dead_directory, '{0}.seg'.format(os.getpid())
+        )
+        with open(dead_path, 'ab') as dead_segment:
+            dead_segment.write(pack_frame(records, self.compress))
+
+
+class EleanorUnavailable(Exception):
+    """Raised when a spooled frame could not be sent because eleanor is down"""
+
+
+def is_unavailable_error(error):
+    """
+    Check to see if error means eleanor could not take a tweet at all (a
+    connection failure, timeout or 5xx response) rather than eleanor
+    rejecting that tweet
+    """
+    response = getattr(error, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    if status_code is not None:
+        return status_code >= 500
+    return isinstance(error, (IOError, OSError, socket.error))
+
+
+class SpoolReplayer(object):
+    """Sends spooled tweets on to eleanor
+
+    send_records is called with a list of TweetRecords and returns
+    (tweet_id, error) failures for the ones eleanor did not accept. When it
+    raises, or a failure is eleanor being unreachable (see
+    is_unavailable_error), eleanor is taken to be down and the replayer backs
+    off, doubling its wait from backoff_secs up to max_backoff_secs, before
+    trying the segment again. Other failures are eleanor rejecting those
+    tweets, which are moved to the dead directory however many there are.
+    """
+
+    def __init__(self, spool, send_records, poll_secs, backoff_secs,
+                 max_backoff_secs):
+        self.spool = spool
+        self.send_records = send_records
+        self.poll_secs = poll_secs
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self.current_backoff = 0
+        self.thread = None
+
+    def replay_segment(self, claimed_path):
+        """
+        Send the frames of a claimed segment after the last one sent to eleanor
+        and delete it. Raises EleanorUnavailable, leaving the segment claimed
+        and its frames up to the failing one recorded as sent, if eleanor is
+        down
+        """
+        frames = self.spool.read_segment(
+            claimed_path, self.spool.sent_offset(claimed_path)
+        )
+        for end_offset, records in frames:
+            try:
+                failures = self.send_records(records)
+            except Exception as e:
+                raise EleanorUnavailable(str(e))
+            if failures:
+                self.reject(records, failures)
+            self.spool.record_sent(claimed_path, end_offset)
+        self.spool.remove_segment(claimed_path)
+
+    def reject(self, records, failures):
+        """
+        Move the records of failures to the dead directory, raises
+        EleanorUnavailable instead if any failure is eleanor being down
+        """
+        for _, error in failures:
+            if is_unavailable_error(error):
+                raise EleanorUnavailable(str(error))
+        failed_ids = set(tweet_id for tweet_id, _ in failures)
+        logger.error(
+            'Eleanor rejected %s spooled tweets, moving them to %s: %s',
+            len(failures),
+            self.spool.dead_directory,
+            failures[0][1]
+        )
+        self.spool.write_dead([
+            record for record in records
+            if str(record.tweet_id) in failed_ids
+        ])
+
+    def replay_once(self):
+        """
+        Replay every sealed segment, returns the number replayed
+        """
+        self.spool.seal_if_due()
+        self.spool.recover_abandoned()
+        replayed = 0
+        for segment_path in self.spool.sealed_segments():
+            claimed_path = self.spool.claim(segment_path)
+            if claimed_path is None:
+                continue
+            try:
+                self.replay_segment(claimed_path)
+            except EleanorUnavailable:
+                os.rename(claimed_path, segment_path)
+                raise
+            replayed += 1
+        return replayed
+
+    def run(self):
+        """
+        Replay segments every poll_secs until the process exits
+        """
+        while True:
+            try:
+                self.replay_once()
+                self.current_backoff = 0
+            except EleanorUnavailable as e:
+                self.current_backoff = min(
+                    max(self.current_backoff * 2, self.backoff_secs),
+                    self.max_backoff_secs
+                )
+                logger.warning(
+                    'Eleanor unavailable, replaying spool in %s seconds: %s',
+                    self.current_backoff,
+                    e
+                )
+            except Exception as e:
+                logger.error('Error replaying tweet spool: %s', e)
+            time.sleep(max(self.poll_secs, self.current_backoff))
+
+    def start(self):
+        """
+        Start replaying on a daemon thread, does nothing if already started in
+        this process
+        """
+        pid = os.getpid()
+        if self.thread is not None and self.thread[0] == pid:
+            return
+        replay_thread = threading.Thread(target=self.run)
+        replay_thread.daemon = True
+        replay_thread.start()
+        self.thread = (pid, replay_thread)
+
+
+def build_tweet_spool():
+    """
+    Build the TweetSpool configured in interns_settings, returns None if the
+    spool is disabled
+    """
+    if not interns_settings.spool_enabled:
+        return None
+    return TweetSpool(
+        interns_settings.spool_dir,
+        interns_settings.spool_segment_max_bytes,
+        interns_settings.spool_segment_max_age_secs,
+        interns_settings.spool_fsync,
+        interns_settings.spool_compress,
+        interns_settings.spool_mmap_reads
+    )
@@ -1,7 +1,20 @@
 """Utilities for interns twitter client"""
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from pymemcache.client.base import Client as MemCacheClient
+
 from eleanor_client.endpoints import twitter as eleanor_twitter
 
-from interns.utils import get_celery_logger
+from interns.settings import interns_settings
+from interns import metrics
+from interns.utils import get_celery_logger, LockedMemcacheClient
+from interns.clients.twitter.records import TweetRecord
+from interns.clients.twitter.seen import build_seen_tweet_filter
+from interns.clients.twitter.spool import build_tweet_spool
+from interns.clients.twitter.activity import build_user_activity
 
 # logger = get_logger(__name__)
 logger = get_celery_logger(__name__)
@@ -12,10 +25,172 @@ def get_tracked_twitter_tl_users():
     Pull the list of twitter users that is being polled by the interns
     """
     logger.debug('Getting listing of tracked twitter users')
-    tracked_users = eleanor_twitter.get_tracked_twitter_users()
+    with metrics.timed_eleanor_call('get_tracked_twitter_users'):
+        tracked_users = eleanor_twitter.get_tracked_twitter_users()
     return tracked_users
 
 
+class TrackedUsersCache(object):
+    """Set of tracked twitter usernames kept for ttl_secs before being pulled
+    from eleanor again. If a memcache client is given the list is shared
+    through memcache so a burst of lookups across workers costs a single
+    eleanor call per ttl"""
+
+    memcache_key = 'interns_tracked_twitter_users'
+
+    def __init__(self, ttl_secs, memcache_client=None):
+        self.ttl_secs = ttl_secs
+        self.memcacheClient = memcache_client
+        self.users = None
+        self.loaded_time = None
+
+    def is_fresh(self):
+        """
+        Check to see if the cached users can still be used
+        """
+        if self.users is None:
+            return False
+        return (time.time() - self.loaded_time) < self.ttl_secs
+
+    def load_users(self):
+        """
+        Fill the cache from memcache if available otherwise from eleanor
+        """
+        users = None
+        if self.memcacheClient is not None:
+            cached_users = self.memcacheClient.get(self.memcache_key)
+            if cached_users is not None:
+                users = json.loads(cached_users)
+        if users is None:
+            users = get_tracked_twitter_tl_users()
+            if self.memcacheClient is not None:
+                self.memcacheClient.set(
+                    self.memcache_key,
+                    json.dumps(list(users)),
+                    expire=int(self.ttl_secs)
+                )
+        self.users = set(users)
+        self.loaded_time = time.time()
+
+    def get_users(self):
+        """
+        Return the set of tracked usernames
+        """
+        if not self.is_fresh():
+            self.load_users()
+        return self.users
+
+    def add_user(self, username):
+        """
+        Record that username is now tracked and drop the shared copy so other
+        processes pick the user up on their next lookup
+        """
+        if self.users is not None:
+            self.users.add(username)
+        if self.memcacheClient is not None:
+            self.memcacheClient.delete(self.memcache_key)
+
+    def clear(self):
+        """
+        Drop the cached users so the next lookup pulls them again
+        """
+        self.users = None
+        self.loaded_time = None
+
+
+class TrackedUsersChangeLog(object):
+    """Numbered log in memcache of the twitter users interns starts or stops
+    tracking, so the scheduler can follow changes without pulling every
+    tracked user from eleanor. Entries expire after ttl_secs, a reader that
+    falls further behind has to pull the full list again"""
+
+    version_key = 'interns_tracked_users_version'
+    change_key_prefix = 'interns_tracked_users_change:'
+
+    def __init__(self, memcache_client, ttl_secs):
+        self.memcacheClient = memcache_client
+        self.ttl_secs = ttl_secs
+
+    def _change_key(self, version):
+        return '{0}{1}'.format(self.change_key_prefix, version)
+
+    def record(self, username, added=True):
+        """
+        Append that username was added (or removed) to the log
+        """
+        try:
+            self.memcacheClient.add(
+                self.version_key, '0', expire=0, noreply=False
+            )
+            version = self.memcacheClient.incr(
+                self.version_key, 1, noreply=False
+            )
+            self.memcacheClient.set(
+                self._change_key(version),
+                json.dumps({'username': username, 'added': added}),
+                expire=self.ttl_secs
+            )
+        except Exception as e:
+            logger.warning('Tracked users change log update failed: %s', e)
+
+    def current_version(self):
+        """
+        Return the version of the latest change
+        """
+        version = self.memcacheClient.get(self.version_key)
+        return int(version) if version is not None else 0
+
+    def changes_since(self, version, max_changes):
+        """
+        Return (version, changes) with the changes after version in order,
+        each a dict of username and added. Returns None if they can't all be
+        read (more than max_changes, expired or the log was lost) and the full
+        list has to be pulled instead
+        """
+        current = self.current_version()
+        if current == version:
+            return version, []
+        if current < version or current - version > max_changes:
+            return None
+        versions = range(version + 1, current + 1)
+        keys = [self._change_key(change) for change in versions]
+        entries = {}
+        for start in range(0, len(keys), 500):
+            entries.update(
+                self.memcacheClient.get_many(keys[start:start + 500])
+            )
+        changes = []
+        for change in versions:
+            entry = entries.get(self._change_key(change))
+            if entry is None:
+                # The latest changes may still be being written, anything
+                # missing before a later change is lost
+                if any(
+                        self._change_key(later) in entries
+                        for later in range(change + 1, current + 1)):
+                    return None
+                return change - 1, changes
+            changes.append(json.loads(entry))
+        return current, changes
+
+
+# pymemcache only connects on first use
+memcacheClient = LockedMemcacheClient(
+    MemCacheClient(
+        (interns_settings.memcache_host, interns_settings.memcache_port)
+    )
+)
+
+tracked_users_cache = TrackedUsersCache(
+    interns_settings.tracked_users_cache_ttl_secs,
+    memcacheClient if interns_settings.tracked_users_shared_cache else None
+)
+
+tracked_users_changes = TrackedUsersChangeLog(
+    memcacheClient, interns_settings.tracked_users_change_ttl_secs
+)
+
+
 def begin_tracking_twitter_user(username):
     """
     Add a twitter user to be tracked to the databse
@@ -25,13 +200,17 @@ def begin_tracking_twitter_user(username):
     username '@NASA' to be polled: add_tracked_twitter_tl_user('NASA')
     """
     logger.debug('Adding twitter user %s to be tracked', username)
-    eleanor_twitter.track_new_twitter_user(username)
+    with metrics.timed_eleanor_call('track_new_twitter_user'):
+        eleanor_twitter.track_new_twitter_user(username)
+    tracked_users_cache.add_user(username)
+    tracked_users_changes.record(username)
 
 
 def is_twitter_user_in_interns(screen_name):
     """
     Checks to see if a twitter user exists within the database. Returns True
-    if the screen_name is present in the database else returns False.
+    if the screen_name is present in the database else returns False. The
+    tracked users are cached for interns_settings.tracked_users_cache_ttl_secs
 
     For example checking to see if the user '@NASA' exists within the database
     the method would be called like so: is_twitter_user_in_interns('NASA')
@@ -39,30 +218,211 @@ def is_twitter_user_in_interns(screen_name):
     Arguments:
     screen_name -- Twitter user_name/screen_name to check for.
     """
-    screen_names = get_tracked_twitter_tl_users()
+    is_tracked = screen_name in tracked_users_cache.get_users()
     logger.debug(
         (
             'Twitter username %s  is currently being '
             'tracked by interns is: %s'
         ),
         screen_name,
-        screen_name in screen_names
+        is_tracked
     )
-    return screen_name in screen_names
+    return is_tracked
+
+
+class LastTweetIdCache(object):
+    """Latest ingested tweet id per twitter user, kept in memcache when a
+    client is given with a bounded in-process LRU used when memcache is not
+    configured or cannot be reached"""
+
+    memcache_key_prefix = 'interns_last_tweet_id:'
+
+    def __init__(self, max_size, memcache_client=None):
+        self.max_size = max_size
+        self.memcacheClient = memcache_client
+        self.local_ids = OrderedDict()
+        self.local_lock = threading.Lock()
+
+    def _memcache_key(self, screen_name):
+        return self.memcache_key_prefix + screen_name
+
+    def _get_local(self, screen_name):
+        with self.local_lock:
+            tweet_id = self.local_ids.pop(screen_name, None)
+            if tweet_id is not None:
+                self.local_ids[screen_name] = tweet_id
+        return tweet_id
+
+    def _set_local(self, screen_name, tweet_id):
+        with self.local_lock:
+            self.local_ids.pop(screen_name, None)
+            self.local_ids[screen_name] = tweet_id
+            while len(self.local_ids) > self.max_size:
+                self.local_ids.popitem(last=False)
+
+    def get(self, screen_name):
+        """
+        Return the cached latest tweet id for screen_name or None on a miss
+        """
+        if self.memcacheClient is not None:
+            try:
+                tweet_id = self.memcacheClient.get(
+                    self._memcache_key(screen_name)
+                )
+                if tweet_id is not None:
+                    return int(tweet_id)
+                return None
+            except Exception as e:
+                logger.warning(
+                    'Last tweet id memcache lookup failed, using local: %s', e
+                )
+        return self._get_local(screen_name)
+
+    def get_many(self, screen_names):
+        """
+        Return a dict of screen_name to cached latest tweet id for those of
+        screen_names that are cached, using a single memcache request
+        """
+        if self.memcacheClient is not None:
+            try:
+                cached_ids = self.memcacheClient.get_many(
+                    [self._memcache_key(name) for name in screen_names]
+                )
+                prefix_length = len(self.memcache_key_prefix)
+                return dict(
+                    (key[prefix_length:], int(tweet_id))
+                    for key, tweet_id in cached_ids.items()
+                )
+            except Exception as e:
+                logger.warning(
+                    'Last tweet id memcache lookup failed, using local: %s', e
+                )
+        last_ids = {}
+        for screen_name in screen_names:
+            tweet_id = self._get_local(screen_name)
+            if tweet_id is not None:
+                last_ids[screen_name] = tweet_id
+        return last_ids
+
+    def update(self, screen_name, tweet_id):
+        """
+        Record tweet_id as the latest for screen_name if it is newer than the
+        cached id
+        """
+        tweet_id = int(tweet_id)
+        current_id = self._get_local(screen_name)
+        if current_id is None or tweet_id > current_id:
+            self._set_local(screen_name, tweet_id)
+        if self.memcacheClient is not None:
+            try:
+                # Worst case a racing worker stores an older id and the next
+                # poll asks twitter for a few tweets that were already added
+                cached_id = self.memcacheClient.get(
+                    self._memcache_key(screen_name)
+                )
+                if cached_id is None or tweet_id > int(cached_id):
+                    self.memcacheClient.set(
+                        self._memcache_key(screen_name), str(tweet_id)
+                    )
+            except Exception as e:
+                logger.warning('Last tweet id memcache update failed: %s', e)
+
+
+last_tweet_id_cache = LastTweetIdCache(
+    interns_settings.last_tweet_id_cache_size,
+    memcacheClient if interns_settings.last_tweet_id_shared_cache else None
+)
+
+
+seen_tweet_filter = build_seen_tweet_filter(memcacheClient)
+
+tweet_spool = build_tweet_spool()
+
+user_activity = build_user_activity(memcacheClient)
 
 
 def last_twitter_user_entry_id(screen_name):
     """
     Returns the latest tweet id assocaited with screen_name otherwise returns
-    None.
+    None. Eleanor (or the database) is only asked when the id is not in
+    last_tweet_id_cache
 
     Arguments:
     screen_name -- Twitter user_name/screen_name to check for.
     """
-    last_entry_id = eleanor_twitter.get_username_last_tweet_id(screen_name)
+    last_entry_id = last_tweet_id_cache.get(screen_name)
+    if last_entry_id is not None:
+        return last_entry_id
+    if interns_settings.tweet_store == 'database':
+        # Imported here so storing tweets in eleanor doesn't need the database
+        from interns.clients import db_client
+        with metrics.timed_db_call('get_username_last_tweet_id'):
+            last_entry_id = db_client.get_username_last_tweet_id(screen_name)
+    else:
+        with metrics.timed_eleanor_call('get_username_last_tweet_id'):
+            last_entry_id = eleanor_twitter.get_username_last_tweet_id(
+                screen_name
+            )
+    if last_entry_id:
+        last_tweet_id_cache.update(screen_name, last_entry_id)
     return last_entry_id
 
 
+def _backfill_checkpoint_key(screen_name):
+    return 'interns_backfill_max_id:' + screen_name
+
+
+def get_backfill_checkpoint(screen_name):
+    """
+    Returns the tweet id an interrupted timeline backfill of screen_name should
+    resume from (as max_id) otherwise returns None
+
+    Arguments:
+    screen_name -- Twitter user_name/screen_name to check for.
+    """
+    try:
+        max_id = memcacheClient.get(_backfill_checkpoint_key(screen_name))
+    except Exception as e:
+        logger.warning('Backfill checkpoint lookup failed: %s', e)
+        return None
+    if max_id is None:
+        return None
+    return int(max_id)
+
+
+def set_backfill_checkpoint(screen_name, max_id):
+    """
+    Record that the timeline backfill of screen_name has stored everything
+    newer than max_id
+    """
+    try:
+        memcacheClient.set(_backfill_checkpoint_key(screen_name), str(max_id))
+    except Exception as e:
+        logger.warning('Backfill checkpoint update failed: %s', e)
+
+
+def clear_backfill_checkpoint(screen_name):
+    """
+    Record that the timeline backfill of screen_name is complete
+    """
+    try:
+        memcacheClient.delete(_backfill_checkpoint_key(screen_name))
+    except Exception as e:
+        logger.warning('Backfill checkpoint removal failed: %s', e)
+
+
+def build_tweet_data(tweet):
+    """
+    Converts a tweet into the dict that eleanor expects for tweet data
+
+    Arguments:
+    tweet -- The tweet object pulled from the twitter library. Some (very)
+    limited documentation is located here:
+    https://python-twitter.readthedocs.io/en/latest/twitter.html#twitter.models.Status
+    """
+    return TweetRecord.from_tweet(tweet).to_tweet_data()
+
+
 def insert_tweet_data(tweet):
     """
     Adds a tweet to the database
@@ -73,49 +433,149 @@ def insert_tweet_data(tweet):
     https://python-twitter.readthedocs.io/en/latest/twitter.html#twitter.models.Status
     """
     logger.debug('Making call to eleanor to add tweet data')
-    base_twitter_url = 'https://twitter.com/{0}/status/{1}'
-    source_url = base_twitter_url.format(tweet.user.screen_name, tweet.id_str)
-
-    user_mentions = [user.screen_name for user in tweet.user_mentions]
-    hashtags = [hashtag.text for hashtag in tweet.hashtags]
-    tweet_urls = [url.expanded_url for url in tweet.urls]
-
-    retweet_data = {}
-    if tweet.retweeted_status is not None:
-        retweet = tweet.retweeted_status
-        is_retweet = True
-        retweet_url = base_twitter_url.format(
-            retweet.user.screen_name,
-            tweet.id_str
+    tweet_data = build_tweet_data(tweet)
+    with metrics.timed_eleanor_call('add_tweet_data'):
+        eleanor_twitter.add_tweet_data(tweet_data)
+
+
+class TweetDataBatch(object):
+    """Buffers tweets as compact TweetRecords and stores a buffer at a time
+
+    The buffer is flushed once it holds max_size tweets or once the oldest
+    buffered tweet is older than max_age_secs. With the database tweet store a
+    flush is one bulk write. eleanor_client only adds one tweet per call, so
+    against eleanor a flush makes one add_tweet_data call per tweet. Failures
+    are reported per tweet as (tweet_id, error) pairs so one bad tweet does
+    not lose the rest of the buffer.
+
+    Tweets eleanor accepted are marked in seen_filter (a SeenTweetFilter) if
+    one is given, along with the originals of retweets. With
+    retweet_references, retweets of originals seen_filter has seen are sent as
+    references to the original's tweet id rather than copies of it.
+    """
+
+    def __init__(self, max_size=None, max_age_secs=None, seen_filter=None,
+                 retweet_references=False):
+        if max_size is None:
+            max_size = interns_settings.eleanor_batch_size
+        if max_age_secs is None:
+            max_age_secs = interns_settings.eleanor_batch_max_age_secs
+        self.max_size = max_size
+        self.max_age_secs = max_age_secs
+        self.seen_filter = seen_filter
+        self.retweet_references = (
+            retweet_references and seen_filter is not None
         )
-        retweet_data["user_name"] = retweet.user.screen_name
-        retweet_data["tweet_id"] = retweet.id_str
-        retweet_data["url"] = retweet_url
-        retweet_data["tweet_text"] = retweet.text
-        retweet_data["tweet_created"] = retweet.created_at
-        retweet_data["is_retweet"] = False
+        self.pending = []
+        self.oldest_pending_time = None
 
-        user_mentions = [user.screen_name for user in retweet.user_mentions]
-        retweet_data["user_mentions"] = user_mentions
+    def __len__(self):
+        return len(self.pending)
 
-        hashtags = [hashtag.text for hashtag in retweet.hashtags]
-        retweet_data["hashtags"] = hashtags
+    def should_flush(self):
+        """
+        Check to see if the buffer has hit either its size or age limit
+        """
+        if not self.pending:
+            return False
+        if len(self.pending) >= self.max_size:
+            return True
+        pending_age = time.time() - self.oldest_pending_time
+        return pending_age >= self.max_age_secs
 
-        tweet_urls = [url.expanded_url for url in retweet.urls]
-        retweet_data["tweet_urls"] = tweet_urls
-    else:
-        is_retweet = False
-
-    tweet_data = {
-        "user_name": tweet.user.screen_name,
-        "tweet_id": tweet.id_str,
-        "url": source_url,
-        "tweet_text": tweet.text,
-        "tweet_created": tweet.created_at,
-        "is_retweet": is_retweet,
-        "user_mentions": user_mentions,
-        "hashtags": hashtags,
-        "tweet_urls": tweet_urls,
-        "retweet_data": retweet_data
-    }
-    eleanor_twitter.add_tweet_data(tweet_data)
+    def add(self, tweet):
+        """
+        Convert and buffer a tweet, flushing if the buffer is due. Returns the
+        list of (tweet_id, error) failures from conversion or flushing
+
+        Arguments:
+        tweet -- The tweet object pulled from the twitter library
+        """
+        try:
+            record = TweetRecord.from_tweet(tweet)
+        except Exception as e:
+            return [(getattr(tweet, 'id_str', None), e)]
+        return self.add_record(record)
+
+    def add_record(self, record):
+        """
+        Buffer a TweetRecord, flushing if the buffer is due. Returns the list
+        of (tweet_id, error) failures from flushing
+        """
+        if not self.pending:
+            self.oldest_pending_time = time.time()
+        self.pending.append(record)
+        if self.should_flush():
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Send all buffered tweet data to eleanor, or write it straight to the
+        database when interns_settings.tweet_store is 'database'. Tweets are
+        sent to eleanor one at a time so the failing tweets can be reported
+        individually
+        """
+        records = self.pending
+        self.pending = []
+        self.oldest_pending_time = None
+        if not records:
+            return []
+        if interns_settings.tweet_store == 'database':
+            failures = self._write_to_database(records)
+            self._mark_seen(records, failures)
+            return failures
+        stored_ids = set()
+        if self.retweet_references:
+            stored_ids = self.seen_filter.seen_ids([
+                record.retweeted.tweet_id for record in records
+                if record.retweeted is not None
+            ])
+        batch = [
+            record.to_tweet_data(
+                record.retweeted is not None and
+                record.retweeted.tweet_id in stored_ids
+            )
+            for record in records
+        ]
+        failures = self._send(batch)
+        self._mark_seen(records, failures)
+        return failures
+
+    def _mark_seen(self, records, failures):
+        if self.seen_filter is not None:
+            failed_ids = set(tweet_id for tweet_id, _ in failures)
+            added_records = [
+                record for record in records
+                if str(record.tweet_id) not in failed_ids
+            ]
+            # Eleanor stores the original of an added retweet as well
+            self.seen_filter.mark_seen(
+                [record.tweet_id for record in added_records] + [
+                    record.retweeted.tweet_id for record in added_records
+                    if record.retweeted is not None
+                ]
+            )
+
+    def _write_to_database(self, records):
+        # Imported here so storing tweets in eleanor doesn't need the database
+        from interns.clients import db_client
+        logger.debug('Writing %s tweets to the database', len(records))
+        try:
+            with metrics.timed_db_call('write_records'):
+                db_client.tweet_writer.write_records(records)
+        except Exception as e:
+            return [(str(record.tweet_id), e) for record in records]
+        return []
+
+    def _send(self, batch):
+        # eleanor_client adds one tweet per call
+        logger.debug('Making calls to eleanor to add %s tweets', len(batch))
+        failures = []
+        for tweet_data in batch:
+            try:
+                with metrics.timed_eleanor_call('add_tweet_data'):
+                    eleanor_twitter.add_tweet_data(tweet_data)
+            except Exception as e:
+                failures.append((tweet_data['tweet_id'], e))
+        return failures
@@ -13,6 +13,13 @@ try:
     twitter_consumer_secret = creds_config.twitter_consumer_secret
     twitter_access_token_key = creds_config.twitter_access_token_key
     twitter_access_token_secret = creds_config.twitter_access_token_secret
+    # Optional extra twitter credential sets, a list of dicts with the keys
+    # of twitter_credentials below
+    extra_twitter_credentials = getattr(
+        creds_config, 'extra_twitter_credentials', []
+    )
+    # Optional database to write tweets to directly
+    database_url = getattr(creds_config, 'database_url', None)
 
 except ImportError:
     # Running in prod
@@ -35,3 +42,35 @@ except ImportError:
         'Twitter',
         'twitter_access_token_secret'
     )
+    # Any further sections named Twitter<suffix> (e.g. Twitter2) hold extra
+    # credential sets that are pooled with the main one
+    extra_twitter_credentials = []
+    for section in sorted(config.sections()):
+        if section == 'Twitter' or not section.startswith('Twitter'):
+            continue
+        extra_twitter_credentials.append({
+            'name': section,
+            'consumer_key': config.get(section, 'twitter_consumer_key'),
+            'consumer_secret': config.get(section, 'twitter_consumer_secret'),
+            'access_token_key': config.get(
+                section,
+                'twitter_access_token_key'
+            ),
+            'access_token_secret': config.get(
+                section,
+                'twitter_access_token_secret'
+            )
+        })
+
+    # Optional database to write tweets to directly
+    database_url = None
+    if config.has_option('Database', 'database_url'):
+        database_url = config.get('Database', 'database_url')
+
+twitter_credentials = [{
+    'name': 'Twitter',
+    'consumer_key': twitter_consumer_key,
+    'consumer_secret': twitter_consumer_secret,
+    'access_token_key': twitter_access_token_key,
+    'access_token_secret': twitter_access_token_secret
+}] + extra_twitter_credentials
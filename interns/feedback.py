@@ -0,0 +1,174 @@
+"""Rate limit feedback from the workers to the scheduler
+
+After each twitter timeline poll a worker reports what twitter said of the
+credential set's budget (the remaining requests and reset time of the last
+response, or that the request was refused as over the limit) on a queue of
+the celery broker. The scheduler drains the queue and brings the shared token
+buckets in line with the reports, so it dispatches at the rate twitter
+actually allows rather than by its own count alone.
+"""
+import time
+
+from kombu import Connection, Exchange, Queue
+
+from interns.settings import interns_settings
+from interns.utils import get_celery_logger
+
+logger = get_celery_logger(__name__)
+
+
+def make_report(bucket_name, remaining=None, reset=None, rate_limited=False):
+    """
+    Return a report of the timeline budget of the credential set whose token
+    bucket is bucket_name
+    """
+    return {
+        'bucket': bucket_name,
+        'remaining': remaining,
+        'reset': reset,
+        'rate_limited': rate_limited,
+        'reported_at': time.time()
+    }
+
+
+def _simple_queue(connection, queue_name, ttl_secs):
+    # Both ends must declare the queue with the same arguments
+    feedback_queue = Queue(
+        queue_name,
+        Exchange(queue_name, type='direct', durable=False),
+        routing_key=queue_name,
+        durable=False,
+        queue_arguments={'x-message-ttl': int(ttl_secs * 1000)}
+    )
+    return connection.SimpleQueue(feedback_queue)
+
+
+class FeedbackPublisher(object):
+    """Publishes reports from the workers through the broker connection pool
+    of a celery app, a report that cannot be published is logged and dropped.
+    The pool is only taken from the app on the first publish so each forked
+    worker process uses its own"""
+
+    def __init__(self, app, queue_name, ttl_secs):
+        self.app = app
+        self.queue_name = queue_name
+        self.ttl_secs = ttl_secs
+        self.connection_pool = None
+
+    def publish(self, report):
+        """
+        Put report on the feedback queue
+        """
+        try:
+            if self.connection_pool is None:
+                self.connection_pool = self.app.pool
+            with self.connection_pool.acquire(block=True) as connection:
+                feedback_queue = _simple_queue(
+                    connection, self.queue_name, self.ttl_secs
+                )
+                try:
+                    feedback_queue.put(report, serializer='json')
+                finally:
+                    feedback_queue.close()
+        except Exception as e:
+            logger.warning('Unable to publish rate limit feedback: %s', e)
+
+
+class FeedbackConsumer(object):
+    """Drains reports for the scheduler, reconnecting to the broker after a
+    failure"""
+
+    def __init__(self, broker_url, queue_name, ttl_secs):
+        self.broker_url = broker_url
+        self.queue_name = queue_name
+        self.ttl_secs = ttl_secs
+        self.connection = None
+        self.feedback_queue = None
+
+    def _connect(self):
+        self.connection = Connection(self.broker_url)
+        self.feedback_queue = _simple_queue(
+            self.connection, self.queue_name, self.ttl_secs
+        )
+
+    def close(self):
+        """Close the broker connection"""
+        if self.connection is not None:
+            try:
+                self.feedback_queue.close()
+                self.connection.release()
+            finally:
+                self.connection = None
+                self.feedback_queue = None
+
+    def drain(self, max_reports):
+        """
+        Return up to max_reports reports without waiting for more
+        """
+        reports = []
+        if self.connection is None:
+            self._connect()
+        try:
+            while len(reports) < max_reports:
+                try:
+                    message = self.feedback_queue.get(block=False)
+                except self.feedback_queue.Empty:
+                    break
+                reports.append(message.payload)
+                message.ack()
+        except Exception:
+            self.close()
+            raise
+        return reports
+
+
+def apply_report(report, buckets, now=None):
+    """
+    Apply report to its bucket out of buckets (a dict of bucket name to
+    interns.rate_limiting.TokenBucket), returns False if it was not applied
+    """
+    if now is None:
+        now = time.time()
+    bucket = buckets.get(report.get('bucket'))
+    if bucket is None:
+        return False
+    reset = report.get('reset')
+    if report.get('rate_limited'):
+        if reset is None or reset <= now:
+            # Without a reset time the bucket's own window is taken to be
+            # used up, or a whole window if it has none
+            reset = now + (bucket.seconds_until_refill() or bucket.window_secs)
+        bucket.sync_remaining(0, reset)
+        return True
+    if report.get('remaining') is None or reset is None:
+        return False
+    bucket.sync_remaining(report['remaining'], reset)
+    return True
+
+
+def build_feedback_publisher(app):
+    """
+    Build the FeedbackPublisher of celery app configured in interns_settings,
+    returns None if rate limit feedback is disabled
+    """
+    if not interns_settings.rate_limit_feedback_enabled:
+        return None
+    return FeedbackPublisher(
+        app,
+        interns_settings.rate_limit_feedback_queue,
+        interns_settings.rate_limit_feedback_ttl_secs
+    )
+
+
+def build_feedback_consumer(broker_url):
+    """
+    Build the FeedbackConsumer configured in interns_settings, returns None
+    if rate limit feedback is disabled
+    """
+    if not interns_settings.rate_limit_feedback_enabled:
+        return None
+    return FeedbackConsumer(
+        broker_url,
+        interns_settings.rate_limit_feedback_queue,
+        interns_settings.rate_limit_feedback_ttl_secs
+    )
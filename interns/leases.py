@@ -0,0 +1,282 @@
+"""Time bounded leases for splitting work between scheduler instances"""
+import os
+import json
+import time
+import fcntl
+import bisect
+import hashlib
+import zlib
+
+from pymemcache.client.base import Client as MemCacheClient
+
+from interns.settings import interns_settings
+from interns.utils import LockedMemcacheClient
+
+
+class MemcacheLeaseBackend(object):
+    """Keeps leases in memcache, shared by every instance on every node. A
+    lease is a key holding its owner that expires unless renewed, add and cas
+    make taking and renewing one atomic"""
+
+    def __init__(self, memcache_client=None):
+        if memcache_client is None:
+            memcache_client = LockedMemcacheClient(
+                MemCacheClient(
+                    (
+                        interns_settings.memcache_host,
+                        interns_settings.memcache_port
+                    )
+                )
+            )
+        self.memcacheClient = memcache_client
+
+    def acquire(self, key, owner, lease_secs):
+        """
+        Take or renew the lease at key for owner, returns False if another
+        owner holds it
+        """
+        if self.memcacheClient.add(
+                key, owner, expire=lease_secs, noreply=False):
+            return True
+        value, cas_token = self.memcacheClient.gets(key)
+        if value is None:
+            return self.memcacheClient.add(
+                key, owner, expire=lease_secs, noreply=False
+            )
+        if value.decode('utf-8') != owner:
+            return False
+        return bool(self.memcacheClient.cas(
+            key, owner, cas_token, expire=lease_secs, noreply=False
+        ))
+
+    def release(self, key, owner):
+        """Give up the lease at key if owner holds it"""
+        value = self.memcacheClient.get(key)
+        if value is not None and value.decode('utf-8') == owner:
+            self.memcacheClient.delete(key, noreply=False)
+
+    def holders(self, keys):
+        """Return a dict of key to owner for the leases at keys that are
+        held"""
+        held = self.memcacheClient.get_many(keys)
+        return dict(
+            (key, owner.decode('utf-8')) for key, owner in held.items()
+        )
+
+
+class FileLockLeaseBackend(object):
+    """Keeps leases in a json file guarded by flock. Safe across processes on a
+    single node, meant for tests and single machine installs"""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = interns_settings.lease_file
+        self.path = path
+        lock_dir = os.path.dirname(path)
+        if lock_dir and not os.path.exists(lock_dir):
+            os.makedirs(lock_dir)
+
+    def _update(self, update):
+        """Call update with the live leases under a file lock, writing back
+        the leases it returns"""
+        with open(self.path, 'a+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                lock_file.seek(0)
+                contents = lock_file.read()
+                leases = json.loads(contents) if contents else {}
+                now = time.time()
+                leases = dict(
+                    (k, v) for k, v in leases.items() if v[1] > now
+                )
+                result = update(leases, now)
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write(json.dumps(leases))
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def acquire(self, key, owner, lease_secs):
+        """
+        Take or renew the lease at key for owner, returns False if another
+        owner holds it
+        """
+        def take(leases, now):
+            if key in leases and leases[key][0] != owner:
+                return False
+            leases[key] = (owner, now + lease_secs)
+            return True
+        return self._update(take)
+
+    def release(self, key, owner):
+        """Give up the lease at key if owner holds it"""
+        def give_up(leases, now):
+            # pylint: disable=unused-argument
+            if key in leases and leases[key][0] == owner:
+                del leases[key]
+        self._update(give_up)
+
+    def holders(self, keys):
+        """Return a dict of key to owner for the leases at keys that are
+        held"""
+        def read(leases, now):
+            # pylint: disable=unused-argument
+            return dict(
+                (key, leases[key][0]) for key in keys if key in leases
+            )
+        return self._update(read)
+
+
+class HashRing(object):
+    """Consistent hash ring, adding or removing a member only moves the keys
+    on the ring next to its points"""
+
+    def __init__(self, members, replicas=100):
+        self.points = []
+        self.owners = []
+        ring = sorted(
+            (self._hash('{0}#{1}'.format(member, replica)), member)
+            for member in members
+            for replica in range(replicas)
+        )
+        for point, member in ring:
+            self.points.append(point)
+            self.owners.append(member)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        """Return the member owning key, None if the ring has no members"""
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, self._hash(key))
+        return self.owners[index % len(self.owners)]
+
+
+class ShardLeases(object):
+    """Splits keys (e.g. tracked usernames) between scheduler instances
+
+    Keys are hashed into number_of_shards fixed shards, and shards are spread
+    over the live instances with a HashRing. An instance is live while it
+    holds one of max_instances member leases. It only works on a shard while
+    it holds that shard's lease, so a shard moved to another instance is not
+    worked on by both: the new owner can only take the lease once the old one
+    has released it or died and let it expire. heartbeat must be called well
+    within lease_secs to keep the leases.
+    """
+
+    def __init__(self, name, instance_id, number_of_shards, max_instances,
+                 lease_secs, backend):
+        self.name = name
+        self.instance_id = instance_id
+        self.number_of_shards = number_of_shards
+        self.max_instances = max_instances
+        self.lease_secs = lease_secs
+        self.backend = backend
+        self.member_key = None
+        self.members = []
+        self.shards = frozenset()
+        self.renewed_at = 0
+
+    def _member_keys(self):
+        return [
+            '{0}:member:{1}'.format(self.name, slot)
+            for slot in range(self.max_instances)
+        ]
+
+    def _shard_key(self, shard):
+        return '{0}:shard:{1}'.format(self.name, shard)
+
+    def shard_of(self, key):
+        """Return the shard key falls in"""
+        return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % (
+            self.number_of_shards
+        )
+
+    def owns(self, key):
+        """Check to see if this instance holds the shard of key"""
+        return self.shard_of(key) in self.shards
+
+    def _renew_membership(self):
+        if self.member_key is not None:
+            if self.backend.acquire(
+                    self.member_key, self.instance_id, self.lease_secs):
+                return True
+            self.member_key = None
+        for member_key in self._member_keys():
+            if self.backend.acquire(
+                    member_key, self.instance_id, self.lease_secs):
+                self.member_key = member_key
+                return True
+        return False
+
+    def heartbeat(self):
+        """
+        Renew this instance's leases, rebalance the shards over the live
+        instances and return the shards this instance now holds
+        """
+        try:
+            if not self._renew_membership():
+                self.release_all()
+                return self.shards
+            self.members = sorted(
+                set(self.backend.holders(self._member_keys()).values())
+            )
+            ring = HashRing(self.members)
+            held = set()
+            for shard in range(self.number_of_shards):
+                shard_key = self._shard_key(shard)
+                if ring.owner(str(shard)) == self.instance_id:
+                    if self.backend.acquire(
+                            shard_key, self.instance_id, self.lease_secs):
+                        held.add(shard)
+                elif shard in self.shards:
+                    self.backend.release(shard_key, self.instance_id)
+        except Exception:
+            # Once the leases could have expired another instance may have
+            # taken the shards over
+            if time.time() - self.renewed_at >= self.lease_secs:
+                self.shards = frozenset()
+                self.member_key = None
+            raise
+        self.shards = frozenset(held)
+        self.renewed_at = time.time()
+        return self.shards
+
+    def release_all(self):
+        """Give up every lease, e.g. when shutting down"""
+        for shard in self.shards:
+            self.backend.release(self._shard_key(shard), self.instance_id)
+        self.shards = frozenset()
+        if self.member_key is not None:
+            self.backend.release(self.member_key, self.instance_id)
+            self.member_key = None
+
+
+def get_shard_leases(name, instance_id=None):
+    """
+    Build ShardLeases for name using the backend set by
+    interns_settings.lease_backend, either 'memcache' or 'file'. The
+    instance_id defaults to the host name and pid
+    """
+    if interns_settings.lease_backend == 'memcache':
+        backend = MemcacheLeaseBackend()
+    elif interns_settings.lease_backend == 'file':
+        backend = FileLockLeaseBackend()
+    else:
+        raise ValueError(
+            'Unknown lease backend {0}'.format(interns_settings.lease_backend)
+        )
+    if instance_id is None:
+        instance_id = '{0}:{1}'.format(os.uname()[1], os.getpid())
+    return ShardLeases(
+        name,
+        instance_id,
+        interns_settings.scheduler_shards,
+        interns_settings.scheduler_max_instances,
+        interns_settings.scheduler_lease_secs,
+        backend
+    )
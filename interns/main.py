@@ -1,24 +1,120 @@
-"""Main entry point for interns scheduling service. Currently written to only
-be sinle threaded and single instanced. If this is changed the limitation
-checks will also need to be re-written
+"""Main entry point for interns scheduling service. Each registered source's
+job runner (interns.tasks_scheduling.registry) runs in its own processes, which
+the scheduler restarts with a backoff when they exit so one source stalling or
+crashing leaves the others running. Several twitter processes or instances
+can run at once with scheduler_sharding_enabled, tracked users are then split
+between them by shard leases (interns.leases). Twitter API limits are drawn
+from the shared token bucket in interns.rate_limiting so they hold across
+instances
 """
+import time
 import signal
-from time import sleep
 from multiprocessing import Process, Queue
 
+# Importing the job modules registers their runners
+# pylint: disable=unused-import
 from interns.tasks_scheduling.twitter import jobs
+from interns.tasks_scheduling import registry
 from interns.settings import interns_settings
-from interns import utils
+from interns import utils, metrics
 
 
 logger = utils.get_scheduler_logger(__name__)
 
 
+class JobRunnerProcess(object):
+    """One supervised process of a job runner, restarted when it exits"""
+
+    def __init__(self, runner, log_queue):
+        self.runner = runner
+        self.log_queue = log_queue
+        self.job_queue = None
+        self.process = None
+        self.started_at = None
+        self.restart_at = 0
+        self.backoff_secs = 0
+
+    def start(self):
+        """Start the runner in a new process with a new job queue"""
+        self.job_queue = Queue()
+        self.process = Process(
+            target=self.runner.target, args=(self.job_queue, self.log_queue)
+        )
+        self.process.daemon = True
+        self.process.start()
+        self.started_at = time.time()
+        logger.info(
+            'Started %s job runner process %s',
+            self.runner.source,
+            self.process.pid
+        )
+
+    def is_alive(self):
+        """Check to see if the process is running"""
+        return self.process is not None and self.process.is_alive()
+
+    def check(self, now):
+        """
+        Restart the process if it has exited and its backoff has passed,
+        returns True if it is running afterwards
+        """
+        if self.is_alive():
+            return True
+        if self.process is not None:
+            # Exited since the last check
+            uptime = now - self.started_at
+            if uptime >= interns_settings.job_runner_stable_secs:
+                self.backoff_secs = 0
+            self.backoff_secs = min(
+                max(
+                    self.backoff_secs * 2,
+                    interns_settings.job_runner_restart_backoff_secs
+                ),
+                interns_settings.job_runner_max_restart_backoff_secs
+            )
+            logger.warning(
+                '%s job runner process %s exited with code %s, restarting in '
+                '%s seconds',
+                self.runner.source,
+                self.process.pid,
+                self.process.exitcode,
+                self.backoff_secs
+            )
+            self.process = None
+            self.restart_at = now + self.backoff_secs
+        if now < self.restart_at:
+            return False
+        if self.started_at is not None:
+            metrics.job_runner_restarts.inc(source=self.runner.source)
+        self.start()
+        return True
+
+    def stop(self):
+        """Ask the process to shut down, see join"""
+        if self.is_alive():
+            self.job_queue.put(interns_settings.process_poison)
+
+    def join(self, timeout):
+        """Wait up to timeout for the process, terminating it if still alive"""
+        if self.process is None:
+            return
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning(
+                '%s job runner process %s did not shut down, terminating it',
+                self.runner.source,
+                self.process.pid
+            )
+            self.process.terminate()
+            self.process.join()
+
+
 class Scheduler(object):
     """Class for running scheduled jobs"""
 
     def __init__(self):
         self.service_running = True
+        self.runner_processes = {}
         self.run_scheduler()
 
     def signal_handler(self, signum, frame):
@@ -26,31 +122,59 @@ class Scheduler(object):
         # pylint: disable=unused-argument
         self.service_running = False
 
+    def supervise(self, log_queue):
+        """
+        Bring every source up to its number of job runner processes and
+        restart the ones that have exited
+        """
+        now = time.time()
+        for source, count in registry.runner_process_counts().items():
+            processes = self.runner_processes.setdefault(source, [])
+            while len(processes) < count:
+                processes.append(
+                    JobRunnerProcess(registry.job_runners[source], log_queue)
+                )
+            for runner_process in processes[count:]:
+                runner_process.stop()
+                runner_process.join(interns_settings.job_runner_shutdown_secs)
+            del processes[count:]
+            alive = 0
+            for runner_process in processes:
+                if runner_process.check(now):
+                    alive += 1
+            metrics.job_runner_processes.set(alive, source=source)
+
     def run_scheduler(self):
         """
         The main entry point for the interns scheduling service, starts and
         maintains all of the various timing jobs
         """
         logger.info('Starting interns scheduler')
+        metrics.registry.start_textfile_writer('scheduler')
         logging_queue = Queue()
         workerLogger = utils.MultiProcessLogger(logging_queue, logger)
-        twitter_jobs_queue = Queue()
-        twitter_jobs_worker = Process(
-            target=jobs.TwitterJobs, args=(twitter_jobs_queue, logging_queue)
-        )
-        twitter_jobs_worker.daemon = True
-        twitter_jobs_worker.start()
+        workerLogger.start_listener()
+        signal.signal(signal.SIGTERM, self.signal_handler)
         try:
             while self.service_running:
-                # Check to see if the process was killed
-                signal.signal(signal.SIGTERM, self.signal_handler)
-                # Some call to check if the service should keep running
-                workerLogger.write_log_messages()
-                sleep(0.5)
+                self.supervise(logging_queue)
+                # Log messages are written by the listener thread meanwhile
+                time.sleep(interns_settings.job_runner_check_secs)
         finally:
             logger.info('Shutting down interns scheduler')
-            twitter_jobs_queue.put(interns_settings.process_poison)
-            twitter_jobs_worker.join()
+            runner_processes = [
+                runner_process
+                for processes in self.runner_processes.values()
+                for runner_process in processes
+            ]
+            for runner_process in runner_processes:
+                runner_process.stop()
+            for runner_process in runner_processes:
+                runner_process.join(interns_settings.job_runner_shutdown_secs)
+            workerLogger.stop_listener()
+            logger.info(
+                'Dropped %s log messages', workerLogger.dropped_messages
+            )
 
 if __name__ == '__main__':
     Scheduler()
@@ -0,0 +1,336 @@
+"""Counters, gauges and latency histograms exported in the Prometheus text
+format
+
+Each process keeps its own metrics and writes them to a textfile (for the node
+exporter textfile collector) every interns_settings.metrics_write_interval_secs
+from a background thread, so recording a value only costs a lock and an add.
+"""
+import os
+import re
+import time
+import errno
+import atexit
+import bisect
+import threading
+from contextlib import contextmanager
+
+from interns.settings import interns_settings
+
+
+default_latency_buckets = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+textfile_pattern = re.compile(r'^interns_.+_(\d+)\.prom(?:\.\d+\.tmp)?$')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, value) for name, value in sorted(labels)
+    ) + '}'
+
+
+class Counter(object):
+    """Value that only goes up, optionally split by label values"""
+
+    metric_type = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the counter for labels"""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        """Return (name, labels, value) for every label combination"""
+        with self.lock:
+            return [
+                (self.name, key, value) for key, value in self.values.items()
+            ]
+
+
+class Gauge(Counter):
+    """Value that can be set to anything"""
+
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the gauge for labels to value"""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(object):
+    """Distribution of observed values, e.g. call latencies in seconds"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, buckets=default_latency_buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = {}
+        self.sums = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Record value for labels"""
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(key)
+            if counts is None:
+                counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+                self.sums[key] = 0
+            counts[index] += 1
+            self.sums[key] += value
+
+    def samples(self):
+        """Return (name, labels, value) for the buckets, sum and count of
+        every label combination"""
+        samples = []
+        with self.lock:
+            for key, counts in self.counts.items():
+                cumulative = 0
+                for upper_bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((
+                        self.name + '_bucket',
+                        key + (('le', repr(float(upper_bound))),),
+                        cumulative
+                    ))
+                cumulative += counts[-1]
+                samples.append((
+                    self.name + '_bucket', key + (('le', '+Inf'),), cumulative
+                ))
+                samples.append((self.name + '_sum', key, self.sums[key]))
+                samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+
+class Registry(object):
+    """All of the metrics of a process"""
+
+    def __init__(self):
+        self.metrics = []
+        self.writer = None
+
+    def register(self, metric):
+        """Add metric to the registry and return it"""
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description):
+        """Create and register a Counter"""
+        return self.register(Counter(name, description))
+
+    def gauge(self, name, description):
+        """Create and register a Gauge"""
+        return self.register(Gauge(name, description))
+
+    def histogram(self, name, description, buckets=default_latency_buckets):
+        """Create and register a Histogram"""
+        return self.register(Histogram(name, description, buckets))
+
+    def render(self, labels=()):
+        """Return every metric in the Prometheus text format, adding labels
+        (name, value pairs) to every sample"""
+        labels = tuple(labels)
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {0} {1}'.format(
+                metric.name, metric.description
+            ))
+            lines.append('# TYPE {0} {1}'.format(
+                metric.name, metric.metric_type
+            ))
+            for name, sample_labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(
+                    name, _format_labels(sample_labels + labels), value
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path, labels=()):
+        """Write the metrics to path, replacing it in one step so a reader
+        never sees a partial file"""
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.render(labels))
+        os.rename(temp_path, path)
+
+    def start_textfile_writer(self, process_role):
+        """
+        Start a daemon thread writing the metrics of this process, labelled
+        with its pid and process_role, to interns_<process_role>_<pid>.prom in
+        interns_settings.metrics_textfile_dir every
+        interns_settings.metrics_write_interval_secs. The file is removed when
+        the process exits and files left by processes that are gone are
+        removed. Does nothing if metrics are disabled or a writer is already
+        running in this process
+        """
+        if not interns_settings.metrics_enabled:
+            return
+        pid = os.getpid()
+        if self.writer is not None and self.writer[0] == pid:
+            return
+        textfile_dir = interns_settings.metrics_textfile_dir
+        if not os.path.exists(textfile_dir):
+            os.makedirs(textfile_dir)
+        remove_dead_textfiles(textfile_dir)
+        path = os.path.join(
+            textfile_dir, 'interns_{0}_{1}.prom'.format(process_role, pid)
+        )
+        labels = (('pid', pid), ('role', process_role))
+
+        def write_periodically():
+            while True:
+                try:
+                    self.write_textfile(path, labels)
+                except (IOError, OSError):
+                    pass
+                time.sleep(interns_settings.metrics_write_interval_secs)
+
+        def remove_textfile():
+            # Forked children inherit the handler
+            if os.getpid() != pid:
+                return
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        writer_thread = threading.Thread(target=write_periodically)
+        writer_thread.daemon = True
+        writer_thread.start()
+        atexit.register(remove_textfile)
+        self.writer = (pid, writer_thread)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def remove_dead_textfiles(textfile_dir):
+    """
+    Remove the metrics textfiles in textfile_dir of processes that are no
+    longer running, e.g. celery workers killed without running exit handlers,
+    so the collector stops exporting their last values
+    """
+    for filename in os.listdir(textfile_dir):
+        match = textfile_pattern.match(filename)
+        if match is None or _is_running(int(match.group(1))):
+            continue
+        try:
+            os.remove(os.path.join(textfile_dir, filename))
+        except OSError:
+            pass
+
+registry = Registry()
+
+twitter_calls = registry.counter(
+    'interns_twitter_calls_total',
+    'Twitter API calls made, by call and result'
+)
+twitter_call_seconds = registry.histogram(
+    'interns_twitter_call_seconds',
+    'Twitter API call latency in seconds, by call'
+)
+eleanor_calls = registry.counter(
+    'interns_eleanor_calls_total',
+    'Eleanor calls made, by call and result'
+)
+eleanor_call_seconds = registry.histogram(
+    'interns_eleanor_call_seconds',
+    'Eleanor call latency in seconds, by call'
+)
+db_calls = registry.counter(
+    'interns_db_calls_total',
+    'Database calls made, by call and result'
+)
+db_call_seconds = registry.histogram(
+    'interns_db_call_seconds',
+    'Database call latency in seconds, by call'
+)
+tasks_enqueued = registry.counter(
+    'interns_tasks_enqueued_total',
+    'Celery tasks queued by the scheduler, by task'
+)
+job_runner_processes = registry.gauge(
+    'interns_job_runner_processes',
+    'Job runner processes alive in the scheduler, by source'
+)
+job_runner_restarts = registry.counter(
+    'interns_job_runner_restarts_total',
+    'Job runner processes restarted after exiting, by source'
+)
+twitter_rate_limited = registry.counter(
+    'interns_twitter_rate_limited_total',
+    'Twitter requests refused as over the rate limit, by credentials'
+)
+rate_limit_reports = registry.counter(
+    'interns_rate_limit_reports_total',
+    'Rate limit reports from workers applied by the scheduler'
+)
+rate_limit_requests_left = registry.gauge(
+    'interns_twitter_timeline_requests_left',
+    'Twitter timeline requests left in the current window'
+)
+rate_limit_sleep_seconds = registry.gauge(
+    'interns_twitter_timeline_sleep_seconds',
+    'Seconds the scheduler waits between twitter timeline requests'
+)
+log_queue_depth = registry.gauge(
+    'interns_log_queue_depth',
+    'Log messages waiting in the multiprocess log queue'
+)
+log_messages_dropped = registry.counter(
+    'interns_log_messages_dropped_total',
+    'Log messages dropped because the log queue was full'
+)
+
+
+@contextmanager
+def timed_call(calls, call_seconds, call):
+    """
+    Count a call and record its latency, e.g.:
+
+    with timed_call(twitter_calls, twitter_call_seconds, 'get_timeline'):
+        timeline_tweets = api_client.get_timeline_tweets(screen_name)
+    """
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        calls.inc(call=call, result='error')
+        call_seconds.observe(time.time() - start, call=call)
+        raise
+    calls.inc(call=call, result='ok')
+    call_seconds.observe(time.time() - start, call=call)
+
+
+def timed_twitter_call(call):
+    """Count a twitter API call and record its latency"""
+    return timed_call(twitter_calls, twitter_call_seconds, call)
+
+
+def timed_eleanor_call(call):
+    """Count an eleanor call and record its latency"""
+    return timed_call(eleanor_calls, eleanor_call_seconds, call)
+
+
+def timed_db_call(call):
+    """Count a database call and record its latency"""
+    return timed_call(db_calls, db_call_seconds, call)
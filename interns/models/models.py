@@ -3,7 +3,7 @@ import enum
 from sqlalchemy import Column, Integer, String, Text, DateTime, Enum
 from sqlalchemy.orm import relationship
 
-from base import Base
+from interns.models.base import Base
 
 
 class AllowedSources(enum.Enum):
@@ -1,10 +1,11 @@
 from sqlalchemy import (
-    Column, Integer, String, Text, DateTime, ForeignKey, BigInteger, Boolean
+    Column, Integer, String, Text, DateTime, ForeignKey, BigInteger, Boolean,
+    Index
 )
 
 from sqlalchemy.orm import relationship
 
-from base import Base
+from interns.models.base import Base
 
 
 class TwitterSource(Base):
@@ -12,10 +13,10 @@ class TwitterSource(Base):
 
     id = Column(Integer, primary_key=True)
     text_source_id = Column(
-        Integer, ForeignKey('text_source.id'), nullable=False
+        Integer, ForeignKey('text_source.id'), nullable=False, index=True
     )
     retweet_source_id = Column(
-        Integer, ForeignKey('twitter_source.id'), nullable=True
+        Integer, ForeignKey('twitter_source.id'), nullable=True, index=True
     )
     tweeter_user_name = Column(String)
     tweet_id = Column(BigInteger, unique=True)
@@ -41,16 +42,41 @@ class TwitterSource(Base):
     )
 
 
+# Latest tweets of a user, e.g. their last tweet id, from the index alone
+Index(
+    'ix_twitter_source_user_name_tweet_id',
+    TwitterSource.tweeter_user_name,
+    TwitterSource.tweet_id.desc()
+)
+
+
+class Hashtag(Base):
+    __tablename__ = 'hashtag'
+
+    id = Column(Integer, primary_key=True)
+    hashtag = Column(String, unique=True, nullable=False)
+
+
+class TwitterUserName(Base):
+    __tablename__ = 'twitter_user_name'
+
+    id = Column(Integer, primary_key=True)
+    user_name = Column(String, unique=True, nullable=False)
+
+
 class TweetHashtags(Base):
     __tablename__ = 'tweet_hashtags'
 
     id = Column(Integer, primary_key=True)
     twitter_source_id = Column(
-        Integer, ForeignKey('twitter_source.id'), nullable=False
+        Integer, ForeignKey('twitter_source.id'), nullable=False, index=True
+    )
+    hashtag_id = Column(
+        Integer, ForeignKey('hashtag.id'), nullable=False, index=True
     )
-    hashtag = Column(String)
 
     twitter_source = relationship('TwitterSource', back_populates='hashtags')
+    hashtag_entry = relationship('Hashtag')
 
 
 class TweetURLs(Base):
@@ -58,7 +84,7 @@ class TweetURLs(Base):
 
     id = Column(Integer, primary_key=True)
     twitter_source_id = Column(
-        Integer, ForeignKey('twitter_source.id'), nullable=False
+        Integer, ForeignKey('twitter_source.id'), nullable=False, index=True
     )
     url = Column(String)
 
@@ -70,11 +96,15 @@ class TweetUserMentions(Base):
 
     id = Column(Integer, primary_key=True)
     twitter_source_id = Column(
-        Integer, ForeignKey('twitter_source.id'), nullable=False
+        Integer, ForeignKey('twitter_source.id'), nullable=False, index=True
+    )
+    user_name_id = Column(
+        Integer, ForeignKey('twitter_user_name.id'), nullable=False,
+        index=True
     )
-    user_name = Column(String)
 
     twitter_source = relationship('TwitterSource', back_populates='mentions')
+    user_name_entry = relationship('TwitterUserName')
 
 
 class PolledTimelineUsers(Base):
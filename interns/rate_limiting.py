@@ -0,0 +1,314 @@
+"""Shared API request budgets for the interns scheduler and workers"""
+import os
+import json
+import math
+import time
+import fcntl
+
+from pymemcache.client.base import Client as MemCacheClient
+
+from interns.settings import interns_settings
+from interns.utils import LockedMemcacheClient
+
+
+class MemcacheBucketBackend(object):
+    """Keeps token bucket counters in memcache so every scheduler and worker
+    on every node draws from the same budget. add/incr/decr are atomic on the
+    memcache server so no locking is needed beyond sharing the client between
+    threads"""
+
+    def __init__(self, memcache_client=None):
+        if memcache_client is None:
+            memcache_client = LockedMemcacheClient(
+                MemCacheClient(
+                    (
+                        interns_settings.memcache_host,
+                        interns_settings.memcache_port
+                    )
+                )
+            )
+        self.memcacheClient = memcache_client
+
+    def incr(self, key, amount, expire_secs):
+        """Add amount to the counter at key and return the new value"""
+        self.memcacheClient.add(key, '0', expire=expire_secs, noreply=False)
+        value = self.memcacheClient.incr(key, amount, noreply=False)
+        if value is None:
+            # The key expired between the add and the incr
+            self.memcacheClient.add(
+                key, str(amount), expire=expire_secs, noreply=False
+            )
+            value = amount
+        return int(value)
+
+    def decr(self, key, amount):
+        """Subtract amount from the counter at key"""
+        self.memcacheClient.decr(key, amount, noreply=False)
+
+    def get(self, key):
+        """Return the current value of the counter at key"""
+        value = self.memcacheClient.get(key)
+        if value is None:
+            return 0
+        return int(value)
+
+    def add(self, key, value, expire_secs):
+        """
+        Store value at key unless there is a value already, returns the value
+        at key afterwards
+        """
+        expire = int(math.ceil(expire_secs))
+        if self.memcacheClient.add(key, value, expire=expire, noreply=False):
+            return value
+        stored = self.read(key)
+        if stored is None:
+            # The key expired between the add and the read
+            self.memcacheClient.set(key, value, expire=expire, noreply=False)
+            return value
+        return stored
+
+    def set(self, key, value, expire_secs):
+        """Store value at key"""
+        self.memcacheClient.set(
+            key, value, expire=int(math.ceil(expire_secs)), noreply=False
+        )
+
+    def read(self, key):
+        """Return the value stored at key, None if there is none"""
+        value = self.memcacheClient.get(key)
+        if value is None or isinstance(value, str):
+            return value
+        return value.decode('utf-8')
+
+
+class FileLockBucketBackend(object):
+    """Keeps token bucket counters in a json file guarded by flock. Safe across
+    processes on a single node, meant for tests and single machine installs"""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = interns_settings.rate_limit_file
+        self.path = path
+        lock_dir = os.path.dirname(path)
+        if lock_dir and not os.path.exists(lock_dir):
+            os.makedirs(lock_dir)
+
+    def _update(self, update):
+        """
+        Call update with the unexpired entries (a dict of key to a (value,
+        expires) pair) and the time under a file lock, then write the entries
+        back. Returns what update returns
+        """
+        with open(self.path, 'a+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                lock_file.seek(0)
+                contents = lock_file.read()
+                entries = json.loads(contents) if contents else {}
+                now = time.time()
+                entries = dict(
+                    (k, v) for k, v in entries.items() if v[1] > now
+                )
+                result = update(entries, now)
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write(json.dumps(entries))
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def incr(self, key, amount, expire_secs):
+        """Add amount to the counter at key and return the new value"""
+        def add_amount(entries, now):
+            value, expires = entries.get(key, (0, now + expire_secs))
+            entries[key] = (int(value) + amount, expires)
+            return int(value) + amount
+        return self._update(add_amount)
+
+    def decr(self, key, amount):
+        """Subtract amount from the counter at key"""
+        def subtract_amount(entries, now):
+            # pylint: disable=unused-argument
+            if key in entries:
+                value, expires = entries[key]
+                entries[key] = (int(value) - amount, expires)
+        self._update(subtract_amount)
+
+    def get(self, key):
+        """Return the current value of the counter at key"""
+        value = self.read(key)
+        if value is None:
+            return 0
+        return int(value)
+
+    def add(self, key, value, expire_secs):
+        """
+        Store value at key unless there is a value already, returns the value
+        at key afterwards
+        """
+        def add_value(entries, now):
+            if key not in entries:
+                entries[key] = (value, now + expire_secs)
+            return entries[key][0]
+        return self._update(add_value)
+
+    def set(self, key, value, expire_secs):
+        """Store value at key"""
+        def set_value(entries, now):
+            entries[key] = (value, now + expire_secs)
+        self._update(set_value)
+
+    def read(self, key):
+        """Return the value stored at key, None if there is none"""
+        def read_value(entries, now):
+            # pylint: disable=unused-argument
+            return entries[key][0] if key in entries else None
+        return self._update(read_value)
+
+
+class TokenBucket(object):
+    """Token bucket that is refilled to capacity at the end of every window
+
+    Refilling once per window rather than continuously matches how twitter
+    counts requests (e.g. 180 per 15 minutes), and like twitter's a window
+    starts with the first request after the previous window ended rather than
+    on a fixed clock. So the bucket can never hand out more tokens within one
+    of the API's windows than it will accept, and sync_remaining lines the
+    window up with the API's when it reports its reset time. Tokens are
+    counted by the backend so any number of processes can share a bucket.
+    """
+
+    def __init__(self, name, capacity, window_secs, backend):
+        self.name = name
+        self.capacity = capacity
+        self.window_secs = window_secs
+        self.backend = backend
+
+    def _start_key(self):
+        # Holds the start of the current window, expiring when it ends
+        return '{0}:window'.format(self.name)
+
+    def _key(self, window_start):
+        return '{0}:{1}'.format(self.name, window_start)
+
+    def _window_start(self, start_new=False):
+        """
+        Return the start of the current window as stored by the backend, with
+        start_new a window is started now if there is none, otherwise None is
+        returned
+        """
+        if start_new:
+            return self.backend.add(
+                self._start_key(),
+                '{0:.3f}'.format(time.time()),
+                self.window_secs
+            )
+        return self.backend.read(self._start_key())
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, returns True if they were available and
+        False (without taking any) if not
+        """
+        key = self._key(self._window_start(start_new=True))
+        used = self.backend.incr(key, tokens, self.window_secs * 2)
+        if used > self.capacity:
+            self.backend.decr(key, tokens)
+            return False
+        return True
+
+    def tokens_left(self):
+        """Return the number of tokens left in the current window"""
+        window_start = self._window_start()
+        if window_start is None:
+            return self.capacity
+        used = self.backend.get(self._key(window_start))
+        return max(0, self.capacity - used)
+
+    def seconds_until_refill(self):
+        """Return the number of seconds until the bucket is refilled"""
+        window_start = self._window_start()
+        if window_start is None:
+            return 0
+        return max(0, float(window_start) + self.window_secs - time.time())
+
+    def sync_remaining(self, remaining, reset):
+        """
+        Bring the bucket in line with the API reporting remaining requests
+        until reset (seconds since the epoch). The current window is moved to
+        end at reset with the requests the API has counted used up, so with
+        none remaining the bucket is empty until reset and full again after.
+        Tokens are never given back within a window
+        """
+        now = time.time()
+        if reset <= now:
+            return
+        window_start = '{0:.3f}'.format(reset - self.window_secs)
+        used = self.capacity - max(0, remaining)
+        if self._window_start() == window_start:
+            excess = self.tokens_left() - max(0, remaining)
+            if excess > 0:
+                self.backend.incr(
+                    self._key(window_start), excess, self.window_secs * 2
+                )
+            return
+        # Count the used tokens before the window moves so no acquire can see
+        # the API's window empty
+        self.backend.set(
+            self._key(window_start), str(max(0, used)), self.window_secs * 2
+        )
+        self.backend.set(self._start_key(), window_start, reset - now)
+
+
+class TokenBucketPool(object):
+    """Several token buckets (e.g. one per API credential set) used as one
+    budget. Tokens are taken from whichever bucket has the most left"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    @property
+    def capacity(self):
+        """Total tokens per window across all buckets"""
+        return sum(bucket.capacity for bucket in self.buckets)
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens from the least used bucket and return that bucket, returns
+        None if no bucket has enough tokens left
+        """
+        by_tokens_left = sorted(
+            self.buckets,
+            key=lambda bucket: bucket.tokens_left(),
+            reverse=True
+        )
+        for bucket in by_tokens_left:
+            if bucket.try_acquire(tokens):
+                return bucket
+        return None
+
+    def tokens_left(self):
+        """Return the number of tokens left across all buckets"""
+        return sum(bucket.tokens_left() for bucket in self.buckets)
+
+    def seconds_until_refill(self):
+        """Return the number of seconds until the next bucket is refilled"""
+        return min(bucket.seconds_until_refill() for bucket in self.buckets)
+
+
+def get_token_bucket(name, capacity, window_secs):
+    """
+    Build a token bucket using the backend set by
+    interns_settings.rate_limit_backend, either 'memcache' or 'file'
+    """
+    if interns_settings.rate_limit_backend == 'memcache':
+        backend = MemcacheBucketBackend()
+    elif interns_settings.rate_limit_backend == 'file':
+        backend = FileLockBucketBackend()
+    else:
+        raise ValueError(
+            'Unknown rate limit backend {0}'.format(
+                interns_settings.rate_limit_backend
+            )
+        )
+    return TokenBucket(name, capacity, window_secs, backend)
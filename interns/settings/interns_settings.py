@@ -5,6 +5,30 @@ rabbitmq_host = '192.168.2.104'
 rabbitmq_port = '5672'
 
 process_poison = 'bon voyage'
+# Longest time the scheduler process blocks before checking for shutdown
+scheduler_wait_secs = 1
+# Job runner processes per source (see interns.tasks_scheduling.registry),
+# sources not listed run one. More than one twitter process needs sharding
+job_runner_processes = {'twitter': 1}
+# How often the scheduler checks its job runner processes are alive
+job_runner_check_secs = 1
+# Waits before restarting a job runner process that exited, doubling up to the
+# max while it keeps exiting within job_runner_stable_secs of starting
+job_runner_restart_backoff_secs = 1
+job_runner_max_restart_backoff_secs = 300
+job_runner_stable_secs = 60
+# Longest wait for a job runner process to exit at shutdown
+job_runner_shutdown_secs = 10
+
+# Longest time a process blocks on a full log queue before dropping a message
+log_queue_put_timeout = 0.1
+# Most log messages written per drain of the log queue
+log_drain_batch_size = 500
+
+# Each process writes its metrics for the node exporter textfile collector
+metrics_enabled = True
+metrics_textfile_dir = '/var/lib/interns/metrics'
+metrics_write_interval_secs = 15
 
 memcache_host = '192.168.2.104'
 memcache_port = 11211
@@ -12,3 +36,118 @@ memcache_port = 11211
 twitter_timeline_req_left = 180
 twitter_timeline_requests = 180
 twitter_timeline_reset_time = 0
+twitter_timeline_window_secs = 900
+# Tweets asked for per timeline request, twitter serves at most 200
+twitter_timeline_page_size = 200
+
+# Where the shared twitter request budget is kept, 'memcache' or 'file'
+rate_limit_backend = 'memcache'
+rate_limit_file = '/var/run/interns/rate_limits.json'
+
+# Workers report what twitter says of each credential set's timeline budget,
+# and requests it refuses as over the limit, to the scheduler through this
+# queue on the celery broker. Reports not taken within the ttl are dropped
+rate_limit_feedback_enabled = True
+rate_limit_feedback_queue = 'interns_rate_limit_feedback'
+rate_limit_feedback_ttl_secs = 60
+# Most reports the scheduler applies before queueing its next job
+rate_limit_feedback_batch_size = 100
+
+# Shortest time between polls of the same twitter user
+twitter_user_min_poll_secs = 60
+# How far ahead of its start time a job may be queued with a countdown
+twitter_dispatch_lookahead_secs = 30
+# Poll users more often the more they tweet, between the min and max poll
+# intervals, by splitting the timeline request budget between them. Workers
+# keep each user's tweet rate as an exponentially weighted moving average with
+# this half life in memcache
+twitter_adaptive_polling_enabled = True
+twitter_user_max_poll_secs = 6 * 60 * 60
+twitter_activity_halflife_secs = 24 * 60 * 60
+twitter_activity_ttl_secs = 30 * 24 * 60 * 60
+# How often the scheduler works the poll intervals out again from the rates
+twitter_poll_intervals_refresh_secs = 60
+
+# Split tracked users between several scheduler instances. Users are hashed
+# into scheduler_shards shards which the live instances (up to
+# scheduler_max_instances) lease from each other
+scheduler_sharding_enabled = False
+scheduler_shards = 64
+scheduler_max_instances = 16
+# Leases not renewed for this long are taken over by the other instances
+scheduler_lease_secs = 30
+scheduler_heartbeat_secs = 10
+# Where the leases are kept, 'memcache' or 'file'
+lease_backend = 'memcache'
+lease_file = '/var/run/interns/leases.json'
+
+# How long the tracked twitter users list is cached before asking eleanor
+tracked_users_cache_ttl_secs = 60
+# Share the tracked twitter users list between processes through memcache
+tracked_users_shared_cache = True
+# The scheduler picks up users interns starts tracking from a change log in
+# memcache every tracked_users_sync_secs, and pulls the full list from eleanor
+# every tracked_users_full_sync_secs to catch changes made elsewhere
+tracked_users_sync_secs = 5
+tracked_users_full_sync_secs = 60 * 60
+tracked_users_change_ttl_secs = 24 * 60 * 60
+# A scheduler further behind the change log than this pulls the full list
+tracked_users_max_changes = 10000
+
+# Number of last tweet ids per twitter user kept in process
+last_tweet_id_cache_size = 10000
+# Share last tweet ids between processes through memcache
+last_tweet_id_shared_cache = True
+
+# Most twitter users polled by a single task, 1 queues a task per user
+twitter_poll_batch_size = 1
+# Most twitter users polled at the same time by one worker process
+twitter_fetch_concurrency = 16
+
+# Skip tweets already sent to eleanor, e.g. when timeline pages overlap. The
+# filter's bloom filters use at most seen_tweets_memory_bytes and skip a new
+# tweet at seen_tweets_error_rate
+seen_tweets_filter_enabled = True
+seen_tweets_memory_bytes = 4 * 1024 * 1024
+seen_tweets_error_rate = 0.0001
+# Share seen tweet ids between processes through memcache
+seen_tweets_shared = True
+seen_tweets_ttl_secs = 3 * 24 * 60 * 60
+# Send retweets of originals eleanor already has as references to the
+# original's tweet id, needs the seen tweets filter and an eleanor that
+# accepts retweet_data marked is_reference
+retweet_references_enabled = False
+
+# Tweets are written to an on disk spool and sent to eleanor by a replayer
+# thread in each worker, so eleanor being slow or down doesn't lose tweets
+spool_enabled = True
+spool_dir = '/var/spool/interns/tweets'
+spool_segment_max_bytes = 4 * 1024 * 1024
+# Longest time spooled tweets wait before their segment can be replayed
+spool_segment_max_age_secs = 5
+# Flush every append to disk, survives power loss at the cost of latency
+spool_fsync = False
+spool_compress = True
+spool_mmap_reads = False
+spool_replay_poll_secs = 1
+# Replayer waits after eleanor failures, doubling up to the max
+spool_replay_backoff_secs = 1
+spool_replay_max_backoff_secs = 300
+
+# Where tweets are stored, 'eleanor' or 'database' to write them straight to
+# the interns database (the database_url of the creds, otherwise this one)
+tweet_store = 'eleanor'
+database_url = 'sqlite:////var/lib/interns/interns.db'
+# Most rows per executemany or IN query when writing to the database
+db_write_chunk_size = 500
+# Tries of a write that collides with another writer storing the same tweets
+db_write_attempts = 3
+
+# Tweets posted longer ago than this are moved from the database to columnar
+# segment files by python -m interns.archive
+archive_after_days = 90
+archive_dir = '/var/lib/interns/archive'
+archive_segment_rows = 100000
+
+eleanor_batch_size = 100
+eleanor_batch_max_age_secs = 5
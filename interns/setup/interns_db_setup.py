@@ -1,3 +1,5 @@
+from sqlalchemy import inspect, text
+
 from interns.models import models, twitter_models
 from interns.models.base import Base
 
@@ -5,7 +7,84 @@ from interns.clients.db_client import engine
 from interns.utils import get_logger
 
 logger = get_logger(__name__)
+
+# Tables whose strings moved to a dictionary table: (table, old string column,
+# new id column, dictionary table, dictionary string column)
+dictionary_migrations = (
+    ('tweet_hashtags', 'hashtag', 'hashtag_id', 'hashtag', 'hashtag'),
+    (
+        'tweet_user_mentions', 'user_name', 'user_name_id',
+        'twitter_user_name', 'user_name'
+    ),
+)
+
+
+def migrate_dictionary_column(conn, table, old_column, id_column,
+                              dictionary_table, dictionary_column):
+    """
+    Move the strings of table.old_column into dictionary_table and point
+    table.id_column at them. On Postgres old_column is then dropped and
+    id_column made not null, other databases keep the unused column
+    """
+    columns = [column['name'] for column in inspect(conn).get_columns(table)]
+    if old_column not in columns:
+        return
+    logger.info(
+        'Moving %s.%s to %s', table, old_column, dictionary_table
+    )
+    if id_column not in columns:
+        conn.execute(text(
+            'ALTER TABLE {0} ADD COLUMN {1} INTEGER '
+            'REFERENCES {2} (id)'.format(table, id_column, dictionary_table)
+        ))
+    conn.execute(text(
+        'INSERT INTO {0} ({1}) SELECT DISTINCT {2} FROM {3} '
+        'WHERE {2} IS NOT NULL AND {2} NOT IN '
+        '(SELECT {1} FROM {0})'.format(
+            dictionary_table, dictionary_column, old_column, table
+        )
+    ))
+    conn.execute(text(
+        'UPDATE {0} SET {1} = (SELECT id FROM {2} '
+        'WHERE {2}.{3} = {0}.{4}) WHERE {1} IS NULL'.format(
+            table, id_column, dictionary_table, dictionary_column, old_column
+        )
+    ))
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text(
+            'DELETE FROM {0} WHERE {1} IS NULL'.format(table, id_column)
+        ))
+        conn.execute(text(
+            'ALTER TABLE {0} ALTER COLUMN {1} SET NOT NULL'.format(
+                table, id_column
+            )
+        ))
+        conn.execute(text(
+            'ALTER TABLE {0} DROP COLUMN {1}'.format(table, old_column)
+        ))
+
+
+def create_missing_indexes(conn):
+    """
+    Create the indexes of the models that tables made by an earlier version
+    of interns don't have
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = set(
+            index['name'] for index in inspector.get_indexes(table.name)
+        )
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info('Creating index %s', index.name)
+                index.create(conn)
+
+
 logger.info('Setting up database for interns')
 
 Base.metadata.create_all(engine)
 
+with engine.begin() as connection:
+    for migration in dictionary_migrations:
+        migrate_dictionary_column(connection, *migration)
+    create_missing_indexes(connection)
@@ -1,12 +1,20 @@
 """Celery tasks for inters workers"""
 from celery import Celery
+from celery.signals import (
+    worker_ready,
+    worker_shutdown,
+    worker_process_init,
+    worker_process_shutdown
+)
 
-from interns.settings import celeryconfig
+from interns.settings import celeryconfig, interns_settings
 from interns.clients.twitter import (
     utils as twitter_utils,
     client as twitter_client
 )
+from interns.clients.twitter.fetcher import ConcurrentTimelineFetcher
 from interns.utils import get_celery_logger
+from interns import metrics, feedback
 
 logger = get_celery_logger(__name__)
 
@@ -14,6 +22,41 @@ logger = get_celery_logger(__name__)
 app = Celery('tasks')
 app.config_from_object(celeryconfig)
 
+rate_limit_publisher = feedback.build_feedback_publisher(app)
+
+
+@worker_process_init.connect
+def start_metrics_writer(**kwargs):
+    """
+    Export the metrics of each worker process
+    """
+    # pylint: disable=unused-argument
+    metrics.registry.start_textfile_writer('worker')
+
+
+@worker_ready.connect
+@worker_process_init.connect
+def start_spool_replayer(**kwargs):
+    """
+    Send tweets spooled by this worker (and by workers that died) to eleanor.
+    Pool processes are only initialised by the prefork pool, other pools run
+    tasks in the worker process itself
+    """
+    # pylint: disable=unused-argument
+    if twitter_client.spool_replayer is not None:
+        twitter_client.spool_replayer.start()
+
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def close_tweet_spool(**kwargs):
+    """
+    Seal the worker's spool segment so it is replayed by the other workers
+    """
+    # pylint: disable=unused-argument
+    if twitter_utils.tweet_spool is not None:
+        twitter_utils.tweet_spool.close()
+
 
 # This may no longer be necessary with eleanor owning db access
 @app.task
@@ -22,24 +65,150 @@ def track_twitter_user(username):
     When given a username start polling their timeline for tweet data
     """
     logger.info('Adding twitter user %s to tracked users', username)
+    is_new_user = not twitter_utils.is_twitter_user_in_interns(username)
     twitter_utils.begin_tracking_twitter_user(username)
-    if not twitter_utils.is_twitter_user_in_interns(username):
+    if is_new_user:
         get_user_timeline_tweets(username)
 
 
-@app.task
-def get_user_timeline_tweets(username):
+def report_rate_limits(credential_name, api_client, rate_limited=False):
     """
-    Pull the tweets from username's timeline
+    Tell the scheduler what twitter said of credential_name's timeline budget
     """
-    logger.info('Polling twitter user %s for timeline tweets', username)
-    last_tweet_id = twitter_utils.last_twitter_user_entry_id(username)
+    if rate_limited:
+        metrics.twitter_rate_limited.inc(credentials=credential_name)
+    if rate_limit_publisher is None:
+        return
+    rate_limit_publisher.publish(
+        twitter_client.timeline_rate_limit_report(
+            credential_name, api_client, rate_limited
+        )
+    )
+
+
+def poll_timeline(username, last_tweet_id, api_client, credential_name):
+    """
+    Pull the tweets newer than last_tweet_id (looked up if None) from
+    username's timeline, backfilling it if no tweets are stored yet
+    """
+    if last_tweet_id is None:
+        last_tweet_id = twitter_utils.last_tweet_id_cache.get(username)
+    # A backfill only records the user's last tweet id once it completes, so
+    # only users without one can have a backfill to carry on with
+    if last_tweet_id is None:
+        if twitter_utils.get_backfill_checkpoint(username) is not None:
+            twitter_client.get_new_user_timeline_tweets(
+                username, logger, api_client, credential_name
+            )
+            return
+        last_tweet_id = twitter_utils.last_twitter_user_entry_id(username)
     if last_tweet_id:
         twitter_client.get_user_timeline_tweets(
-            username, last_tweet_id, logger
+            username, last_tweet_id, logger, api_client
         )
     else:
-        twitter_client.get_new_user_timeline_tweets(username, logger)
+        twitter_client.get_new_user_timeline_tweets(
+            username, logger, api_client, credential_name
+        )
+
+
+def poll_user_timeline(username, credential_name=None, last_tweet_id=None):
+    """
+    Pull and store the tweets from username's timeline. If the scheduler has
+    already reserved a request it passes the credential_name it was taken
+    from, otherwise a request is taken from the least used twitter credential
+    set. A last_tweet_id known by the caller saves looking it up. Users with
+    an unfinished timeline backfill carry on with it. Returns False without
+    polling if no request is left or if twitter refuses it as over the rate
+    limit, either way the remaining budget is reported to the scheduler
+    """
+    if credential_name is not None:
+        api_client = twitter_client.client_pool.get_client(credential_name)
+    else:
+        credential_name, api_client = (
+            twitter_client.client_pool.acquire_timeline_client()
+        )
+    if api_client is None:
+        return False
+    logger.info(
+        'Polling twitter user %s for timeline tweets with credentials %s',
+        username,
+        credential_name
+    )
+    try:
+        poll_timeline(username, last_tweet_id, api_client, credential_name)
+    except Exception as e:
+        if not twitter_client.is_rate_limit_error(e):
+            raise
+        logger.warning(
+            'Twitter rate limited credentials %s polling user %s',
+            credential_name,
+            username
+        )
+        report_rate_limits(credential_name, api_client, rate_limited=True)
+        return False
+    report_rate_limits(credential_name, api_client)
+    return True
+
+
+@app.task
+def get_user_timeline_tweets(username, credential_name=None):
+    """
+    Pull the tweets from username's timeline. If no twitter request is left
+    the task is requeued for when the budget refills
+    """
+    if not poll_user_timeline(username, credential_name):
+        countdown = twitter_client.timeline_rate_bucket.seconds_until_refill()
+        logger.info(
+            'Twitter timeline budget used up, retrying user %s in %s seconds',
+            username,
+            countdown
+        )
+        get_user_timeline_tweets.apply_async(
+            args=[username], countdown=countdown
+        )
+
+
+@app.task
+def get_users_timeline_tweets(usernames, since_ids=None, credential_name=None):
+    """
+    Pull the tweets from the timelines of all of usernames, polling up to
+    interns_settings.twitter_fetch_concurrency users at the same time.
+    since_ids maps usernames to the last tweet id already stored for them if
+    the caller knows it. If the scheduler has reserved a request for every
+    user it passes the credential_name they were taken from. Users that could
+    not be polled because no twitter request was left are requeued together
+    for when the budget refills
+    """
+    if since_ids is None:
+        since_ids = {}
+
+    def poll_user(username):
+        return poll_user_timeline(
+            username, credential_name, since_ids.get(username)
+        )
+
+    fetcher = ConcurrentTimelineFetcher(
+        poll_user, interns_settings.twitter_fetch_concurrency
+    )
+    results, errors = fetcher.fetch(usernames)
+    for username, e in errors.items():
+        logger.error(
+            'Error attempting to poll twitter user %s: %s', username, e
+        )
+    requeue_usernames = [
+        username for username, polled in results.items() if not polled
+    ]
+    if requeue_usernames:
+        countdown = twitter_client.timeline_rate_bucket.seconds_until_refill()
+        logger.info(
+            'Twitter timeline budget used up, retrying %s users in %s seconds',
+            len(requeue_usernames),
+            countdown
+        )
+        get_users_timeline_tweets.apply_async(
+            args=[requeue_usernames], countdown=countdown
+        )
 
 if __name__ == '__main__':
     app.start()
@@ -0,0 +1,39 @@
+"""Registry of the job runners the interns scheduler supervises
+
+A job runner schedules the polling jobs of one source (one of
+interns.models.models.AllowedSources). It is called in its own process with
+its job queue and the log queue, runs until a poison pill is put on the job
+queue and may exit early, e.g. when it has nothing to poll, after which the
+scheduler starts it again.
+"""
+from collections import namedtuple
+
+from interns.settings import interns_settings
+
+JobRunner = namedtuple('JobRunner', ['source', 'target', 'max_processes'])
+
+job_runners = {}
+
+
+def register_job_runner(source, target, max_processes=None):
+    """
+    Register target as the job runner of source, an AllowedSources member.
+    max_processes is a function returning the most processes of the runner
+    that may run at once, by default one
+    """
+    job_runners[source.name] = JobRunner(
+        source.name, target, max_processes or (lambda: 1)
+    )
+
+
+def runner_process_counts():
+    """
+    Return a dict of source name to the number of job runner processes to
+    run, from interns_settings.job_runner_processes (one per registered
+    source by default) capped at what each runner allows
+    """
+    counts = {}
+    for source, runner in job_runners.items():
+        wanted = interns_settings.job_runner_processes.get(source, 1)
+        counts[source] = max(0, min(wanted, runner.max_processes()))
+    return counts
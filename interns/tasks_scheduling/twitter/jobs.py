@@ -4,19 +4,42 @@ import Queue
 
 from interns.tasks import tasks as intern_tasks
 
+from interns.tasks_scheduling import registry
 from interns.tasks_scheduling.twitter import utils as twitter_utils
-from interns.settings import interns_settings
-from interns import utils
+from interns.clients.twitter import client as twitter_client
+from interns.clients.twitter import utils as twitter_client_utils
+from interns.settings import interns_settings, celeryconfig
+from interns.models.models import AllowedSources
+from interns import utils, metrics, leases, feedback
 
 
 class TwitterJobs(object):
     """Class for handling the scheduling of interns twitter polling"""
 
-    def __init__(self, job_queue, log_queue):
+    def __init__(self, job_queue, log_queue, run=True):
+        """
+        Sets up the scheduler and, unless run is False, runs it until a poison
+        pill is put on job_queue
+        """
         self.logger = utils.MultiProcessLogger(log_queue)
         self.logger.info(__name__, 'Starting twitter job scheduler')
+        metrics.registry.start_textfile_writer('twitter_jobs')
         self.job_queue = job_queue
         self.running = True
+        self.shard_leases = None
+        if interns_settings.scheduler_sharding_enabled:
+            self.shard_leases = leases.get_shard_leases('interns_twitter_jobs')
+            self.shard_leases.heartbeat()
+            self.logger.info(
+                __name__,
+                'Twitter scheduler {0} holds {1} shards'.format(
+                    self.shard_leases.instance_id,
+                    len(self.shard_leases.shards)
+                )
+            )
+        self.next_heartbeat = (
+            time.time() + interns_settings.scheduler_heartbeat_secs
+        )
 #        try:
 #            self.twitterLimits = twitter_utils.TwitterLimits(
 #                multi_proc_logger=self.logger
@@ -27,105 +50,514 @@ class TwitterJobs(object):
 #                'Twitter limits update failed with error: ' + e
 #            )
 #        sleep_secs = self.twitterLimits.get_sleep_between_jobs()
-        self.twitterTimedLimits = twitter_utils.TwitterLimitsTimer(self.logger)
+        self.twitterTimedLimits = twitter_utils.TwitterLimitsTimer(
+            self.logger,
+            reqs_window_secs=interns_settings.twitter_timeline_window_secs,
+            number_of_reqs=interns_settings.twitter_timeline_requests,
+            token_bucket=twitter_client.timeline_rate_bucket
+        )
         self.twitterTimedLimits.calculate_limits()
         sleep_secs = self.twitterTimedLimits.sleep_time
         self.last_execution_time = time.time() - sleep_secs
+        self.rate_limit_feedback = feedback.build_feedback_consumer(
+            celeryconfig.BROKER_URL
+        )
         self.logger.debug(
             __name__,
             'Starting last execution time was: {0}'.format(
                 self.last_execution_time
             )
         )
-        self.tracked_twitter_users = (
+        self.tracked_users_version = self.read_tracked_users_version()
+        self.tracked_twitter_users = set(
             twitter_utils.get_tracked_twitter_usernames(self.logger)
         )
+        self.next_tracked_users_sync = (
+            time.time() + interns_settings.tracked_users_sync_secs
+        )
+        self.next_full_tracked_users_sync = (
+            time.time() + interns_settings.tracked_users_full_sync_secs
+        )
         self.logger.debug(
             __name__,
             'Starting tracked twitter users are: {0}'.format(
                 self.tracked_twitter_users
             )
         )
-        self.twitter_user_index = 0
+        self.poll_intervals = {}
+        self.next_intervals_refresh = 0
+        self.user_deadlines = twitter_utils.UserDeadlines()
+        start_time = time.time()
+        for username in self.owned_users():
+            self.user_deadlines.push(username, start_time)
 
-        if len(self.tracked_twitter_users) == 0:
-            self.logger.debug(
-                __name__, 'No tracked twitter users, shutting down'
-            )
-            self.running = False
+        if run:
+            self.run()
 
+    def run(self):
+        """
+        Queue jobs as they come due until a poison pill is put on the job queue
+        """
+        wait_secs = 0
         while self.running:
             try:
-                if not self.job_queue.empty():
-                    try:
-                        poison_check = self.job_queue.get_nowait()
-                    except Queue.Empty:
-                        poison_check = None
-                    if poison_check == interns_settings.process_poison:
-                        self.logger.info(
-                            __name__,
-                            'Shutting down twitter job scheduler'
-                        )
-                        self.running = False
-                        continue
-                self.execute_next_job()
+                if self.shard_leases is not None:
+                    wait_secs = min(wait_secs, self.renew_shards())
+                wait_secs = min(wait_secs, self.sync_tracked_users())
+                # Blocking on the job queue doubles as the wait until the next
+                # job is due, a poison pill wakes the scheduler immediately
+                try:
+                    poison_check = self.job_queue.get(True, wait_secs)
+                except Queue.Empty:
+                    poison_check = None
+                if poison_check == interns_settings.process_poison:
+                    self.logger.info(
+                        __name__,
+                        'Shutting down twitter job scheduler'
+                    )
+                    self.running = False
+                    if self.shard_leases is not None:
+                        self.shard_leases.release_all()
+                    if self.rate_limit_feedback is not None:
+                        self.rate_limit_feedback.close()
+                    continue
+                self.apply_rate_limit_feedback()
+                wait_secs = self.execute_next_job()
             except Exception as e:
                 self.logger.error(
                     __name__,
-                    'Interns twitter scheduler failed with: ' + e
+                    'Interns twitter scheduler failed with: {0}'.format(e)
                 )
+                wait_secs = self.twitterTimedLimits.sleep_time
+
+    def apply_rate_limit_feedback(self):
+        """
+        Bring the shared twitter request budgets in line with what the workers
+        report twitter said of them, slowing the dispatch rate when twitter
+        has fewer requests left than counted
+        """
+        if self.rate_limit_feedback is None:
+            return
+        try:
+            reports = self.rate_limit_feedback.drain(
+                interns_settings.rate_limit_feedback_batch_size
+            )
+        except Exception as e:
+            self.logger.warning(
+                __name__,
+                'Reading rate limit feedback failed with: {0}'.format(e)
+            )
+            return
+        buckets = twitter_client.client_pool.buckets
+        for report in reports:
+            if not feedback.apply_report(report, buckets):
+                continue
+            metrics.rate_limit_reports.inc()
+            if report.get('rate_limited'):
+                self.logger.warning(
+                    __name__,
+                    'Twitter rate limited credentials {0} until {1}'.format(
+                        report['bucket'], report.get('reset')
+                    )
+                )
+
+    def owned_users(self):
+        """
+        Return the tracked users this scheduler polls, all of them unless
+        sharding is enabled
+        """
+        if self.shard_leases is None:
+            return list(self.tracked_twitter_users)
+        return [
+            username for username in self.tracked_twitter_users
+            if self.shard_leases.owns(username)
+        ]
+
+    def renew_shards(self):
+        """
+        Renew the shard leases when due and add or remove users from
+        user_deadlines as shards move between scheduler instances. Returns the
+        number of seconds until the next renewal
+        """
+        now = time.time()
+        if now < self.next_heartbeat:
+            return self.next_heartbeat - now
+        previous_shards = self.shard_leases.shards
+        try:
+            self.shard_leases.heartbeat()
+        except Exception as e:
+            self.logger.error(
+                __name__, 'Renewing shard leases failed with: {0}'.format(e)
+            )
+        self.next_heartbeat = now + interns_settings.scheduler_heartbeat_secs
+        if self.shard_leases.shards != previous_shards:
+            self.logger.info(
+                __name__,
+                (
+                    'Twitter scheduler now holds {0} of {1} shards across {2} '
+                    'instances'
+                ).format(
+                    len(self.shard_leases.shards),
+                    self.shard_leases.number_of_shards,
+                    len(self.shard_leases.members)
+                )
+            )
+            owned_users = set(self.owned_users())
+            for username in self.user_deadlines:
+                if username not in owned_users:
+                    self.user_deadlines.remove(username)
+            # The previous owner may have queued a job for a user up to the
+            # dispatch lookahead ahead, so a taken over user waits a full poll
+            # interval
+            for username in owned_users:
+                if username not in self.user_deadlines:
+                    self.user_deadlines.push(
+                        username,
+                        now + interns_settings.twitter_user_min_poll_secs
+                    )
+        return interns_settings.scheduler_heartbeat_secs
+
+    def pacing_secs(self):
+        """
+        Return the seconds to leave between this scheduler's requests, the
+        request budget is shared so each of several instances takes its part
+        """
+        sleep_secs = self.twitterTimedLimits.sleep_time
+        if self.shard_leases is not None:
+            sleep_secs *= max(1, len(self.shard_leases.members))
+        return sleep_secs
+
+    def refresh_poll_intervals(self):
+        """
+        Work out each owned user's poll interval again from the tweet rates
+        the workers have recorded, when due
+        """
+        now = time.time()
+        user_activity = twitter_client_utils.user_activity
+        if user_activity is None or now < self.next_intervals_refresh:
+            return
+        self.next_intervals_refresh = (
+            now + interns_settings.twitter_poll_intervals_refresh_secs
+        )
+        usernames = list(self.user_deadlines)
+        requests_per_sec = (
+            self.twitterTimedLimits.number_of_reqs_per_window /
+            float(self.twitterTimedLimits.reqs_window_time)
+        )
+        if self.shard_leases is not None:
+            requests_per_sec /= max(1, len(self.shard_leases.members))
+        self.poll_intervals = twitter_utils.allocate_poll_intervals(
+            usernames,
+            user_activity.rates(usernames),
+            requests_per_sec,
+            interns_settings.twitter_user_min_poll_secs,
+            interns_settings.twitter_user_max_poll_secs
+        )
+        self.logger.debug(
+            __name__,
+            'Updated poll intervals of {0} twitter users'.format(
+                len(self.poll_intervals)
+            )
+        )
+
+    def poll_interval(self, username):
+        """
+        Return the seconds to wait between polls of username
+        """
+        return self.poll_intervals.get(
+            username, interns_settings.twitter_user_min_poll_secs
+        )
+
+    def read_tracked_users_version(self):
+        """
+        Return the version of the tracked users change log, None if it could
+        not be read
+        """
+        try:
+            return twitter_client_utils.tracked_users_changes.current_version()
+        except Exception as e:
+            self.logger.warning(
+                __name__,
+                'Reading tracked users version failed with: {0}'.format(e)
+            )
+            return None
+
+    def apply_tracked_user_changes(self, added, removed, first_poll_time):
+        """
+        Start and stop scheduling users in place, leaving every other user's
+        next poll where it was. Added users this scheduler owns are first
+        polled at first_poll_time
+        """
+        for username in removed:
+            self.tracked_twitter_users.discard(username)
+            self.poll_intervals.pop(username, None)
+            if username in self.user_deadlines:
+                self.user_deadlines.remove(username)
+        for username in added:
+            self.tracked_twitter_users.add(username)
+            if username in self.user_deadlines:
+                continue
+            if (self.shard_leases is not None and
+                    not self.shard_leases.owns(username)):
+                continue
+            self.user_deadlines.push(username, first_poll_time)
+        if added or removed:
+            self.logger.info(
+                __name__,
+                'Tracked twitter users: {0} added, {1} removed'.format(
+                    len(added), len(removed)
+                )
+            )
 
     def update_tracked_users(self):
         """
-        Get tracked twitter usernames
+        Pull every tracked twitter username and apply the differences
         """
         self.logger.debug(__name__, 'Updating tracked twitter users')
-        self.tracked_twitter_users = (
-            twitter_utils.get_tracked_twitter_usernames()
+        # Read first so changes made during the pull are applied again
+        version = self.read_tracked_users_version()
+        usernames = set(
+            twitter_utils.get_tracked_twitter_usernames(self.logger)
+        )
+        self.apply_tracked_user_changes(
+            usernames - self.tracked_twitter_users,
+            self.tracked_twitter_users - usernames,
+            time.time()
+        )
+        self.tracked_users_version = version
+        self.next_full_tracked_users_sync = (
+            time.time() + interns_settings.tracked_users_full_sync_secs
         )
 
-    def get_user_timeline_tweets(self, username):
+    def sync_tracked_users(self):
         """
-        Pull the timeline tweets from username
+        Apply the tracked users changes since the last sync when due, pulling
+        the full list when the change log can't be followed or a full sync is
+        due. While the change log's version can't be read the full list is
+        only pulled on the full sync schedule. Returns the number of seconds
+        until the next sync
         """
+        now = time.time()
+        if now < self.next_tracked_users_sync:
+            return self.next_tracked_users_sync - now
+        self.next_tracked_users_sync = (
+            now + interns_settings.tracked_users_sync_secs
+        )
+        try:
+            changes = None
+            full_sync_due = now >= self.next_full_tracked_users_sync
+            if self.tracked_users_version is None and not full_sync_due:
+                # The change log couldn't be read at the last full sync (e.g.
+                # memcache was down), until it can the full sync schedule
+                # alone keeps the users up to date. Once it can the changes
+                # missed meanwhile are unknown so the full list is pulled
+                if self.read_tracked_users_version() is None:
+                    return interns_settings.tracked_users_sync_secs
+                full_sync_due = True
+            if not full_sync_due:
+                changes = (
+                    twitter_client_utils.tracked_users_changes.changes_since(
+                        self.tracked_users_version,
+                        interns_settings.tracked_users_max_changes
+                    )
+                )
+            if changes is None:
+                self.update_tracked_users()
+            else:
+                self.tracked_users_version, entries = changes
+                # Only a user's latest change counts
+                latest = dict(
+                    (entry['username'], entry['added']) for entry in entries
+                )
+                # Users added through interns have had their first poll
+                # queued by the track_twitter_user task
+                self.apply_tracked_user_changes(
+                    set(
+                        username for username, added in latest.items()
+                        if added and username not in self.tracked_twitter_users
+                    ),
+                    set(
+                        username for username, added in latest.items()
+                        if not added
+                    ),
+                    now + interns_settings.twitter_user_min_poll_secs
+                )
+        except Exception as e:
+            self.logger.error(
+                __name__,
+                'Syncing tracked twitter users failed with: {0}'.format(e)
+            )
+        return interns_settings.tracked_users_sync_secs
+
+    def get_user_timeline_tweets(self, username, start_time, credential_name):
+        """
+        Queue the job to pull the timeline tweets from username with the
+        twitter credentials a request was reserved from, the job will not be
+        started by a worker before start_time
+        """
+        countdown = max(0, start_time - time.time())
         self.logger.info(
             __name__,
-            'Queueing job get timeline tweets for username {0}'.format(
-                username
-            )
+            (
+                'Queueing job get timeline tweets for username {0} '
+                'with countdown {1}'
+            ).format(username, countdown)
+        )
+        intern_tasks.get_user_timeline_tweets.apply_async(
+            args=[username],
+            kwargs={'credential_name': credential_name},
+            countdown=countdown
+        )
+        metrics.tasks_enqueued.inc(task='get_user_timeline_tweets')
+
+    def get_users_timeline_tweets(self, usernames, start_time,
+                                  credential_name):
+        """
+        Queue a single job to pull the timeline tweets of all of usernames with
+        the twitter credentials their requests were reserved from, the job
+        will not be started by a worker before start_time
+        """
+        countdown = max(0, start_time - time.time())
+        since_ids = twitter_client_utils.last_tweet_id_cache.get_many(
+            usernames
+        )
+        self.logger.info(
+            __name__,
+            (
+                'Queueing job get timeline tweets for {0} usernames '
+                'with countdown {1}'
+            ).format(len(usernames), countdown)
         )
-        intern_tasks.get_user_timeline_tweets.delay(username)
-        self.twitterTimedLimits.decrement_api_reqs()
+        intern_tasks.get_users_timeline_tweets.apply_async(
+            args=[usernames],
+            kwargs={
+                'since_ids': since_ids,
+                'credential_name': credential_name
+            },
+            countdown=countdown
+        )
+        metrics.tasks_enqueued.inc(task='get_users_timeline_tweets')
 
     def execute_next_job(self):
         """
-        Determines and runs the next fetch job, takes care of sleeping between
-        jobs
+        Queues the next fetch job if it is due and returns the number of
+        seconds until the next job will be due
         """
-        self.logger.debug(__name__, 'Updating twitter API limits')
+        if not len(self.user_deadlines):
+            # Nothing to poll until users are added or shards move here
+            return interns_settings.scheduler_wait_secs
+        self.refresh_poll_intervals()
+        if interns_settings.twitter_poll_batch_size > 1:
+            return self.execute_next_batch_job()
         self.twitterTimedLimits.calculate_limits()
-        sleep_secs = self.twitterTimedLimits.sleep_time
+        sleep_secs = self.pacing_secs()
 #        self.twitterLimits.update_limits()
 #        sleep_secs = self.twitterLimits.get_sleep_between_jobs()
+        username, due_time = self.user_deadlines.peek()
+        start_time = max(due_time, self.last_execution_time + sleep_secs)
+        dispatch_time = (
+            start_time - interns_settings.twitter_dispatch_lookahead_secs
+        )
+        now = time.time()
+        if now < dispatch_time:
+            return dispatch_time - now
+
+        reserved_bucket = self.twitterTimedLimits.decrement_api_reqs()
+        if not reserved_bucket:
+            self.logger.debug(
+                __name__,
+                'Twitter request budget used up, waiting for refill'
+            )
+            return self.twitterTimedLimits.sleep_time
         self.logger.debug(
             __name__,
             'Updated time to sleep between twitter jobs to {0} seconds'.format(
                 sleep_secs
             )
         )
-        time_to_execute = (
-            (time.time() - self.last_execution_time) >= sleep_secs
+        self.user_deadlines.pop()
+        # Without a shared bucket there is no credential to hand over and the
+        # worker picks one itself
+        credential_name = getattr(reserved_bucket, 'name', None)
+        self.get_user_timeline_tweets(username, start_time, credential_name)
+        self.last_execution_time = start_time
+        self.user_deadlines.push(
+            username, start_time + self.poll_interval(username)
         )
-        self.logger.debug(
-            __name__,
-            'time_to_execute is currently {0}'.format(time_to_execute)
-        )
-        if time_to_execute:
-            if self.twitter_user_index >= len(self.tracked_twitter_users):
-                self.twitter_user_index = 0
-            username = self.tracked_twitter_users[self.twitter_user_index]
-            self.get_user_timeline_tweets(username)
-            self.last_execution_time = time.time()
-            self.twitter_user_index += 1
-        else:
-            time.sleep(time.time() - self.last_execution_time)
+        return 0
+
+    def execute_next_batch_job(self):
+        """
+        Queues one job for the users that are due, up to
+        interns_settings.twitter_poll_batch_size of them and no more than the
+        remaining twitter requests, and returns the number of seconds until
+        the next job will be due
+        """
+        self.twitterTimedLimits.calculate_limits()
+        sleep_secs = self.pacing_secs()
+        _, due_time = self.user_deadlines.peek()
+        start_time = max(due_time, self.last_execution_time + sleep_secs)
+        dispatch_time = (
+            start_time - interns_settings.twitter_dispatch_lookahead_secs
+        )
+        now = time.time()
+        if now < dispatch_time:
+            return dispatch_time - now
+
+        batch_size = min(
+            interns_settings.twitter_poll_batch_size,
+            max(1, self.twitterTimedLimits.reqs_left)
+        )
+        # Only users due by the time the job starts go in the batch
+        due_users = []
+        while len(due_users) < batch_size and len(self.user_deadlines):
+            username, due_time = self.user_deadlines.peek()
+            if due_time > start_time:
+                break
+            due_users.append(self.user_deadlines.pop())
+        batch_size = len(due_users)
+
+        # A batch must come from one credential set so shrink it until one
+        # has enough requests left
+        reserved_bucket = None
+        while batch_size > 0:
+            reserved_bucket = self.twitterTimedLimits.decrement_api_reqs(
+                batch_size
+            )
+            if reserved_bucket:
+                break
+            batch_size //= 2
+        for username, due_time in due_users[batch_size:]:
+            self.user_deadlines.push(username, due_time)
+        if not reserved_bucket:
+            self.logger.debug(
+                __name__,
+                'Twitter request budget used up, waiting for refill'
+            )
+            return self.twitterTimedLimits.sleep_time
+
+        usernames = [username for username, _ in due_users[:batch_size]]
+        credential_name = getattr(reserved_bucket, 'name', None)
+        self.get_users_timeline_tweets(usernames, start_time, credential_name)
+        # The batch uses up batch_size request slots of the pacing
+        self.last_execution_time = start_time + sleep_secs * (batch_size - 1)
+        for username in usernames:
+            self.user_deadlines.push(
+                username, start_time + self.poll_interval(username)
+            )
+        return 0
+
+
+def max_twitter_job_processes():
+    """
+    Several twitter job processes only split the users between them when
+    sharding is enabled, otherwise each would poll every user
+    """
+    if interns_settings.scheduler_sharding_enabled:
+        return interns_settings.scheduler_max_instances
+    return 1
+
+
+registry.register_job_runner(
+    AllowedSources.twitter, TwitterJobs, max_twitter_job_processes
+)
@@ -1,10 +1,13 @@
 """Utilities for twitter task scheduling"""
+import math
+import heapq
+import itertools
 from datetime import datetime, timedelta
 
 from pymemcache.client.base import Client as MemCacheClient
 
 from interns.settings import interns_settings
-from interns import utils
+from interns import utils, metrics
 from interns.clients.twitter.client import twitterClient
 
 from eleanor_client.endpoints import twitter as eleanor_twitter
@@ -148,9 +151,11 @@ class TwitterLimitsTimer(object):
     the limits are know quantities"""
 
     def __init__(self, multi_proc_logger, start_time=None,
-                 reqs_window_secs=900, number_of_reqs=180):
+                 reqs_window_secs=900, number_of_reqs=180, token_bucket=None):
         """Takes a start_time (utc datetime object) and uses it as the baseline for
-        calculating number of twitter requests"""
+        calculating number of twitter requests. If a shared token_bucket
+        (interns.rate_limiting.TokenBucket) is given the limits are taken from
+        it instead so multiple schedulers and workers share one budget"""
         if start_time is None:
             start_time = datetime.utcnow()
         self.reqs_window_start = start_time
@@ -159,22 +164,42 @@ class TwitterLimitsTimer(object):
         self.reqs_left = number_of_reqs
         self.sleep_time = reqs_window_secs / number_of_reqs
         self.logger = multi_proc_logger
+        self.token_bucket = token_bucket
+        self.rollover_time = start_time + timedelta(seconds=reqs_window_secs)
 
     def calculate_limits(self):
         """Calculate limits with current limits data"""
-        rollover_time = self.reqs_window_start + timedelta(
-            seconds=self.reqs_window_time
-        )
         now = datetime.utcnow()
-        if now > rollover_time:
-            self.reqs_window_start = rollover_time
-            self.reqs_left = self.number_of_reqs_per_window
+        if self.token_bucket is not None:
+            self.number_of_reqs_per_window = self.token_bucket.capacity
+            self.reqs_left = self.token_bucket.tokens_left()
+            time_until_rollover = timedelta(
+                seconds=self.token_bucket.seconds_until_refill()
+            )
+            rollover_time = now + time_until_rollover
+        else:
+            rollover_time = self.reqs_window_start + timedelta(
+                seconds=self.reqs_window_time
+            )
+            while now > rollover_time:
+                self.reqs_window_start = rollover_time
+                self.reqs_left = self.number_of_reqs_per_window
+                rollover_time = self.reqs_window_start + timedelta(
+                    seconds=self.reqs_window_time
+                )
+            time_until_rollover = rollover_time - now
 
-        time_until_rollover = rollover_time - now
+        secs_until_rollover = max(0, time_until_rollover.total_seconds())
         if self.reqs_left <= 0:
-            self.sleep_time = time_until_rollover.seconds
+            self.sleep_time = secs_until_rollover
         else:
-            self.sleep_time = time_until_rollover.seconds / self.reqs_left
+            self.sleep_time = secs_until_rollover / self.reqs_left
+        self.rollover_time = rollover_time
+        metrics.rate_limit_requests_left.set(self.reqs_left)
+        metrics.rate_limit_sleep_seconds.set(self.sleep_time)
+
+    def log_limits(self):
+        """Write the current limits to the debug log"""
         self.logger.debug(
             __name__,
             'Total twitter timeline requests allowed is: {0}'.format(
@@ -196,15 +221,146 @@ class TwitterLimitsTimer(object):
         self.logger.debug(
             __name__,
             'Twitter timeline request reset time is: {0}'.format(
-                rollover_time.isoformat()
+                self.rollover_time.isoformat()
             )
         )
 
-    def decrement_api_reqs(self):
-        """Call this method directly before or after making an api request to
-        count the request and calculate the new limits"""
+    def decrement_api_reqs(self, reqs=1):
+        """Call this method directly before making reqs api requests to count
+        them and calculate the new limits. With a shared token bucket this
+        returns the result of its try_acquire (the bucket the requests were
+        taken from for a TokenBucketPool), a false value means not enough
+        requests were left and the requests should not be made"""
+        if self.token_bucket is not None:
+            acquired = self.token_bucket.try_acquire(reqs)
+            self.calculate_limits()
+            self.log_limits()
+            return acquired
         self.calculate_limits()
-        self.reqs_left -= 1
+        self.reqs_left -= reqs
+        self.log_limits()
+        return True
+
+
+class UserDeadlines(object):
+    """Heap of the next time each tracked user is due to be polled
+
+    Rescheduling or removing a user is O(log n), removed entries are marked and
+    skipped lazily when they reach the top of the heap.
+    """
+
+    removed = '<removed-user>'
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, username):
+        return username in self.entries
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def push(self, username, due_time):
+        """
+        Add username to be polled no earlier than due_time (seconds since the
+        epoch), replacing any existing deadline for the user
+        """
+        if username in self.entries:
+            self.remove(username)
+        entry = [due_time, next(self.counter), username]
+        self.entries[username] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, username):
+        """
+        Stop tracking the deadline for username
+        """
+        entry = self.entries.pop(username)
+        entry[-1] = self.removed
+
+    def _discard_removed(self):
+        while self.heap and self.heap[0][-1] == self.removed:
+            heapq.heappop(self.heap)
+
+    def peek(self):
+        """
+        Return (username, due_time) for the user due soonest without removing
+        it, returns None if there are no users
+        """
+        self._discard_removed()
+        if not self.heap:
+            return None
+        due_time, _, username = self.heap[0]
+        return username, due_time
+
+    def pop(self):
+        """
+        Remove and return (username, due_time) for the user due soonest
+        """
+        self._discard_removed()
+        due_time, _, username = heapq.heappop(self.heap)
+        del self.entries[username]
+        return username, due_time
+
+
+def allocate_poll_intervals(usernames, rates, requests_per_sec,
+                            min_poll_secs, max_poll_secs):
+    """
+    Split requests_per_sec between usernames and return a dict of username to
+    the seconds between its polls. Polls are given in proportion to the
+    square root of each user's tweet rate (from rates, users without one are
+    taken to tweet at the average rate), which leaves the fewest tweets
+    waiting to be polled overall, and every interval is kept between
+    min_poll_secs and max_poll_secs
+    """
+    if not usernames:
+        return {}
+    average_rate = (
+        sum(rates.values()) / len(rates) if rates else 0.0
+    )
+    weights = dict(
+        (username, math.sqrt(max(0.0, rates.get(username, average_rate))))
+        for username in usernames
+    )
+    min_frequency = 1.0 / max_poll_secs
+    max_frequency = (
+        1.0 / min_poll_secs if min_poll_secs > 0 else float('inf')
+    )
+    frequencies = {}
+    free_users = set(usernames)
+    budget = requests_per_sec
+    # Users pushed past a bound are fixed at it and the rest of the budget is
+    # split again between the others
+    while free_users:
+        total_weight = sum(weights[username] for username in free_users)
+        clamped = {}
+        for username in free_users:
+            if total_weight > 0:
+                share = budget * weights[username] / total_weight
+            else:
+                share = budget / len(free_users)
+            if share < min_frequency:
+                clamped[username] = min_frequency
+            elif share > max_frequency:
+                clamped[username] = max_frequency
+            else:
+                frequencies[username] = share
+        if not clamped:
+            break
+        for username, frequency in clamped.items():
+            frequencies[username] = frequency
+            free_users.discard(username)
+            budget -= frequency
+        budget = max(0.0, budget)
+    return dict(
+        (username, 1.0 / frequency)
+        for username, frequency in frequencies.items()
+    )
 
 
 def get_tracked_twitter_usernames(mp_logger=None):
@@ -4,10 +4,14 @@ import logging
 import logging.config
 import time
 import subprocess
+import threading
 import Queue
 
 from celery.utils.log import get_task_logger
 
+from interns.settings import interns_settings
+from interns import metrics
+
 
 def get_scheduler_logger(module_name):
     """Get the scheduler logger using time.gmtime"""
@@ -79,6 +83,26 @@ def logging_dir_check(directory):
         os.makedirs(logging_dir)
 
 
+class LockedMemcacheClient(object):
+    """Wraps a pymemcache client so it can be shared between threads
+
+    A pymemcache client holds a single socket, so every call made through this
+    wrapper holds a lock for the length of the call.
+    """
+
+    def __init__(self, memcache_client):
+        self.memcacheClient = memcache_client
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        client_method = getattr(self.memcacheClient, name)
+
+        def locked_method(*args, **kwargs):
+            with self.lock:
+                return client_method(*args, **kwargs)
+        return locked_method
+
+
 class MultiProcessCheckingLogger(object):
     """Logger for using where a module may be used by a MP process
 
@@ -155,6 +179,16 @@ class MultiProcessLogger(object):
     process writing to logs.
     """
 
+    log_levels = {
+        'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warning': logging.WARNING,
+        'error': logging.ERROR,
+        'critical': logging.CRITICAL
+    }
+
+    listener_stop = 'stop listener'
+
     def __init__(self, queue, logger=None):
         """
         There should only be one instance of this instance that has a logger
@@ -163,15 +197,39 @@ class MultiProcessLogger(object):
         self.queue = queue
         self.logger = logger
         self.timeline_requests = []
+        # Messages this instance could not queue since its last report
+        self.unreported_drops = 0
+        # Messages reported dropped by all instances, counted by the writer
+        self.dropped_messages = 0
+        self.listener = None
 
     def put_message_in_queue(self, level, msg, logger_name):
         """Adds logging message to logging queue"""
         try:
-            self.queue.put_nowait([level, msg, logger_name])
+            if self.unreported_drops:
+                self.queue.put(
+                    [
+                        'warning',
+                        'Dropped {0} log messages'.format(
+                            self.unreported_drops
+                        ),
+                        __name__,
+                        self.unreported_drops
+                    ],
+                    True,
+                    interns_settings.log_queue_put_timeout
+                )
+                self.unreported_drops = 0
+            self.queue.put(
+                [level, msg, logger_name, 0],
+                True,
+                interns_settings.log_queue_put_timeout
+            )
         except Queue.Full:
             # So this is non optimal *but* in this instance I'm valuing
-            # service stability over information available.
-            pass
+            # service stability over information available. The drop is
+            # reported with the next message that fits in the queue
+            self.unreported_drops += 1
 
     def debug(self, logger_name, msg):
         """
@@ -203,28 +261,84 @@ class MultiProcessLogger(object):
         """
         self.put_message_in_queue('critical', msg, logger_name)
 
-    def write_log_messages(self):
+    def write_log_message(self, log_info):
+        """
+        Write a single queued log message out with the supplied logger. The
+        record carries the name of the logger that queued it, the supplied
+        logger itself is left untouched
+        """
+        level, msg, logger_name, dropped = log_info
+        if dropped:
+            self.dropped_messages += dropped
+            metrics.log_messages_dropped.inc(dropped)
+        level_no = self.log_levels[level]
+        if self.logger.isEnabledFor(level_no):
+            record = self.logger.makeRecord(
+                logger_name, level_no, '(unknown file)', 0, msg, None, None
+            )
+            self.logger.handle(record)
+
+    def write_log_messages(self, timeout=None):
         """
-        Check the queue for log messages and write them out using the supplied
-        logger. If this is called and a logger was not supplised in
-        initialization or self.logger is None an AttributeError will be raised
+        Check the queue for log messages and write out everything that is
+        waiting, up to interns_settings.log_drain_batch_size messages, using
+        the supplied logger. If a timeout (in seconds) is given this blocks
+        until a message arrives or the timeout passes. Returns False if the
+        listener stop message was read otherwise True. If this is called and a
+        logger was not supplised in initialization or self.logger is None an
+        AttributeError will be raised
         """
         if self.logger is None:
             raise AttributeError(
                 'A logger was not supplied and writing logs was attempted'
             )
-        if not self.queue.empty():
-            log_info = self.queue.get_nowait()
-            level = log_info[0]
-            msg = log_info[1]
-            self.logger.name = log_info[2]
-            if level == 'debug':
-                self.logger.debug(msg)
-            elif level == 'info':
-                self.logger.info(msg)
-            elif level == 'warning':
-                self.logger.warning(msg)
-            elif level == 'error':
-                self.logger.error(msg)
-            elif level == 'critical':
-                self.logger.critical(msg)
+        try:
+            if timeout is None:
+                log_info = self.queue.get_nowait()
+            else:
+                log_info = self.queue.get(True, timeout)
+        except Queue.Empty:
+            return True
+        try:
+            metrics.log_queue_depth.set(self.queue.qsize())
+        except NotImplementedError:
+            # qsize isn't available on every platform
+            pass
+        messages_written = 0
+        while log_info != self.listener_stop:
+            self.write_log_message(log_info)
+            messages_written += 1
+            if messages_written >= interns_settings.log_drain_batch_size:
+                return True
+            try:
+                log_info = self.queue.get_nowait()
+            except Queue.Empty:
+                return True
+        return False
+
+    def listen(self):
+        """
+        Write log messages as they arrive until stop_listener is called
+        """
+        while self.write_log_messages(
+                timeout=interns_settings.scheduler_wait_secs):
+            pass
+
+    def start_listener(self):
+        """
+        Start a daemon thread that drains the queue as fast as it fills
+        """
+        self.listener = threading.Thread(target=self.listen)
+        self.listener.daemon = True
+        self.listener.start()
+
+    def stop_listener(self):
+        """
+        Stop the listener thread once it has written every message queued
+        before this call
+        """
+        if self.listener is None:
+            return
+        self.queue.put(self.listener_stop)
+        self.listener.join()
+        self.listener = None
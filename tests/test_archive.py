@@ -0,0 +1,88 @@
+"""Tests for interns.archive"""
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from interns.benchmarks import fakes
+
+fakes.install_fakes(fakes.FakeEleanorTwitter())
+
+# pylint: disable=wrong-import-position
+from sqlalchemy import create_engine, event, select
+
+from interns import archive
+from interns.models.base import Base
+from interns.clients import db_client
+from interns.clients.twitter.records import TweetRecord, RetweetedRecord
+
+posted = 'Tue Oct 18 14:13:20 +0000 2016'
+
+
+def make_record(user_name, tweet_id, retweeted=None):
+    return TweetRecord(
+        user_name, tweet_id, 'text of {0}'.format(tweet_id), posted, [], [],
+        [], retweeted
+    )
+
+
+def enforce_foreign_keys(dbapi_connection, connection_record):
+    # pylint: disable=unused-argument
+    dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+
+class TweetCompactorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite://')
+        event.listen(self.engine, 'connect', enforce_foreign_keys)
+        Base.metadata.create_all(self.engine)
+        self.compactor = archive.TweetCompactor(
+            self.engine, self.archive_dir, 100, 2
+        )
+        self.cutoff = datetime.datetime(2017, 1, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def write(self, records):
+        db_client.BulkTweetWriter(self.engine).write_records(records)
+
+    def stored_tweet_ids(self):
+        table = db_client.twitter_source_table
+        with self.engine.connect() as conn:
+            return sorted(
+                row[0] for row in conn.execute(select([table.c.tweet_id]))
+            )
+
+    def archived_tweet_ids(self):
+        return sorted(
+            row[0]
+            for row in archive.scan_archive(['tweet_id'], self.archive_dir)
+        )
+
+    def test_original_of_kept_back_retweet_stays(self):
+        original = RetweetedRecord('a', 100, 'text of 100', posted)
+        self.write([make_record('a', 500), make_record('b', 200, original)])
+        self.assertEqual(self.compactor.compact(self.cutoff), 0)
+        self.assertEqual(self.stored_tweet_ids(), [100, 200, 500])
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    def test_unreferenced_old_tweets_are_archived(self):
+        original = RetweetedRecord('a', 100, 'text of 100', posted)
+        self.write([
+            make_record('a', 50),
+            make_record('a', 500),
+            make_record('b', 150, original),
+            make_record('b', 200, original),
+            make_record('b', 300)
+        ])
+        self.assertEqual(self.compactor.compact(self.cutoff), 4)
+        self.assertEqual(self.stored_tweet_ids(), [300, 500])
+        self.assertEqual(self.archived_tweet_ids(), [50, 100, 150, 200])
+
+
+if __name__ == '__main__':
+    unittest.main()
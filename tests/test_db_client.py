@@ -0,0 +1,142 @@
+"""Tests for interns.clients.db_client"""
+import unittest
+
+from interns.benchmarks import fakes
+
+fakes.install_fakes(fakes.FakeEleanorTwitter())
+
+# pylint: disable=wrong-import-position
+from sqlalchemy import create_engine, select, func
+
+from interns.models.base import Base
+from interns.clients import db_client
+from interns.clients.twitter.records import TweetRecord, RetweetedRecord
+
+
+def make_record(tweet_id, user_name='tweeter', hashtags=(), mentions=(),
+                retweeted=None):
+    return TweetRecord(
+        user_name,
+        tweet_id,
+        'text of {0}'.format(tweet_id),
+        'Tue Oct 18 14:13:20 +0000 2016',
+        list(mentions),
+        list(hashtags),
+        ['https://example.com/{0}'.format(tweet_id)],
+        retweeted
+    )
+
+
+class RacingTweetWriter(db_client.BulkTweetWriter):
+    """Misses the stored tweets on its first lookup, as if another writer
+    stored them after the lookup"""
+
+    missed_lookups = 1
+
+    def _existing_source_ids(self, conn, tweet_ids):
+        if self.missed_lookups:
+            self.missed_lookups -= 1
+            return {}
+        return super(RacingTweetWriter, self)._existing_source_ids(
+            conn, tweet_ids
+        )
+
+
+class BulkTweetWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.writer = db_client.BulkTweetWriter(self.engine, chunk_size=2)
+
+    def count(self, table):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select([func.count()]).select_from(table)
+            ).scalar()
+
+    def source_rows(self):
+        table = db_client.twitter_source_table
+        with self.engine.connect() as conn:
+            rows = conn.execute(select([
+                table.c.id, table.c.tweet_id, table.c.retweet_source_id,
+                table.c.is_retweet
+            ]))
+            return dict((row.tweet_id, row) for row in rows)
+
+    def test_duplicates_are_stored_once(self):
+        records = [
+            make_record(1, hashtags=['space'], mentions=['nasa']),
+            make_record(2, hashtags=['space', 'launch'], mentions=['nasa']),
+            make_record(1, hashtags=['space'], mentions=['nasa'])
+        ]
+        self.assertEqual(self.writer.write_records(records), 2)
+        self.assertEqual(self.count(db_client.twitter_source_table), 2)
+        self.assertEqual(self.count(db_client.text_source_table), 2)
+        self.assertEqual(self.count(db_client.hashtag_table), 2)
+        self.assertEqual(self.count(db_client.hashtags_table), 3)
+        self.assertEqual(self.count(db_client.user_name_table), 1)
+        self.assertEqual(self.count(db_client.mentions_table), 2)
+
+    def test_retweets_link_to_their_original(self):
+        original = RetweetedRecord(
+            'original', 10, 'original text', 'Tue Oct 18 14:00:00 +0000 2016'
+        )
+        records = [
+            make_record(11, hashtags=['space'], retweeted=original),
+            make_record(12, user_name='other', retweeted=original)
+        ]
+        self.assertEqual(self.writer.write_records(records), 3)
+        rows = self.source_rows()
+        self.assertFalse(rows[10].is_retweet)
+        self.assertIsNone(rows[10].retweet_source_id)
+        for tweet_id in (11, 12):
+            self.assertTrue(rows[tweet_id].is_retweet)
+            self.assertEqual(rows[tweet_id].retweet_source_id, rows[10].id)
+        # A retweet's hashtags belong to the original
+        hashtags = db_client.hashtags_table
+        with self.engine.connect() as conn:
+            source_ids = [
+                row[0] for row in conn.execute(
+                    select([hashtags.c.twitter_source_id])
+                )
+            ]
+        self.assertEqual(source_ids, [rows[10].id])
+
+    def test_second_write_is_idempotent(self):
+        original = RetweetedRecord(
+            'original', 20, 'original text', 'Tue Oct 18 14:00:00 +0000 2016'
+        )
+        records = [
+            make_record(21, hashtags=['space'], mentions=['nasa']),
+            make_record(22, retweeted=original)
+        ]
+        self.assertEqual(self.writer.write_records(records), 3)
+        before = self.source_rows()
+        self.assertEqual(self.writer.write_records(records), 0)
+        self.assertEqual(self.source_rows(), before)
+        self.assertEqual(self.count(db_client.text_source_table), 3)
+        self.assertEqual(self.count(db_client.hashtags_table), 1)
+        self.assertEqual(self.count(db_client.urls_table), 2)
+        # A retweet of a stored original links to the stored row
+        self.assertEqual(
+            self.writer.write_records([make_record(23, retweeted=original)]),
+            1
+        )
+        self.assertEqual(
+            self.source_rows()[23].retweet_source_id, before[20].id
+        )
+
+    def test_collision_with_another_writer_is_retried(self):
+        self.assertEqual(self.writer.write_records([make_record(30)]), 1)
+        racing_writer = RacingTweetWriter(self.engine)
+        self.assertEqual(
+            racing_writer.write_records([make_record(30), make_record(31)]),
+            1
+        )
+        self.assertEqual(sorted(self.source_rows()), [30, 31])
+        self.assertEqual(self.count(db_client.text_source_table), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+"""Tests for interns.leases"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from interns import leases
+
+
+class FakeClock(object):
+    """Stands in for the time module in interns.leases"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class CasMemcacheClient(object):
+    """Memcache client keeping values and cas tokens in a dict. With
+    racing_writes set that many cas calls find the value was changed by
+    another client since it was read"""
+
+    def __init__(self):
+        self.values = {}
+        self.versions = 0
+        self.racing_writes = 0
+
+    def _store(self, key, value):
+        self.versions += 1
+        self.values[key] = (value.encode('utf-8'), self.versions)
+
+    def add(self, key, value, expire=0, noreply=True):
+        # pylint: disable=unused-argument
+        if key in self.values:
+            return False
+        self._store(key, value)
+        return True
+
+    def get(self, key):
+        return self.gets(key)[0]
+
+    def gets(self, key):
+        return self.values.get(key, (None, None))
+
+    def get_many(self, keys):
+        return dict(
+            (key, self.values[key][0]) for key in keys if key in self.values
+        )
+
+    def cas(self, key, value, cas, expire=0, noreply=True):
+        # pylint: disable=unused-argument
+        if self.racing_writes:
+            self.racing_writes -= 1
+            self._store(key, self.values[key][0].decode('utf-8'))
+        if key not in self.values or self.values[key][1] != cas:
+            return False
+        self._store(key, value)
+        return True
+
+    def delete(self, key, noreply=True):
+        # pylint: disable=unused-argument
+        self.values.pop(key, None)
+
+
+class HashRingTest(unittest.TestCase):
+
+    keys = [str(key) for key in range(1000)]
+
+    def owners(self, members):
+        ring = leases.HashRing(members)
+        return dict((key, ring.owner(key)) for key in self.keys)
+
+    def test_empty_ring_has_no_owner(self):
+        self.assertIsNone(leases.HashRing([]).owner('1'))
+
+    def test_keys_are_spread_over_members(self):
+        owners = self.owners(['a', 'b', 'c'])
+        self.assertEqual(set(owners.values()), set(['a', 'b', 'c']))
+
+    def test_joining_member_only_takes_keys(self):
+        before = self.owners(['a', 'b', 'c'])
+        after = self.owners(['a', 'b', 'c', 'd'])
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertEqual(set(after[key] for key in moved), set(['d']))
+
+    def test_leaving_member_only_gives_up_its_keys(self):
+        before = self.owners(['a', 'b', 'c'])
+        after = self.owners(['a', 'c'])
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertEqual(set(before[key] for key in moved), set(['b']))
+
+
+class ShardLeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.clock = FakeClock(1000000.0)
+        self.real_time = leases.time
+        leases.time = self.clock
+        backend = leases.FileLockLeaseBackend(
+            os.path.join(self.tmp_dir, 'leases.json')
+        )
+        self.first = leases.ShardLeases('jobs', 'first', 16, 4, 30, backend)
+        self.second = leases.ShardLeases('jobs', 'second', 16, 4, 30, backend)
+
+    def tearDown(self):
+        leases.time = self.real_time
+        shutil.rmtree(self.tmp_dir)
+
+    def test_single_instance_holds_every_shard(self):
+        self.assertEqual(self.first.heartbeat(), frozenset(range(16)))
+        self.assertTrue(self.first.owns('some_user'))
+
+    def test_shards_move_only_once_released(self):
+        self.first.heartbeat()
+        # The first instance still holds the second's shards of the ring
+        self.assertEqual(self.second.heartbeat(), frozenset())
+        self.clock.now += 10
+        first_shards = self.first.heartbeat()
+        self.assertTrue(0 < len(first_shards) < 16)
+        second_shards = self.second.heartbeat()
+        self.assertEqual(first_shards & second_shards, frozenset())
+        self.assertEqual(first_shards | second_shards, frozenset(range(16)))
+
+    def test_expired_leases_are_taken_over(self):
+        self.first.heartbeat()
+        self.second.heartbeat()
+        # The first instance dies without releasing its leases
+        self.clock.now += 29
+        self.assertEqual(self.second.heartbeat(), frozenset())
+        self.clock.now += 2
+        self.assertEqual(self.second.heartbeat(), frozenset(range(16)))
+        self.assertEqual(self.second.members, ['second'])
+
+    def test_release_all_hands_shards_over(self):
+        self.first.heartbeat()
+        self.first.release_all()
+        self.assertEqual(self.first.shards, frozenset())
+        self.assertEqual(self.second.heartbeat(), frozenset(range(16)))
+
+
+class MemcacheLeaseBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.memcache_client = CasMemcacheClient()
+        self.backend = leases.MemcacheLeaseBackend(self.memcache_client)
+
+    def test_lease_is_held_by_one_owner(self):
+        self.assertTrue(self.backend.acquire('shard:1', 'first', 30))
+        self.assertTrue(self.backend.acquire('shard:1', 'first', 30))
+        self.assertFalse(self.backend.acquire('shard:1', 'second', 30))
+        self.assertEqual(
+            self.backend.holders(['shard:1', 'shard:2']),
+            {'shard:1': 'first'}
+        )
+
+    def test_renewal_fails_when_cas_fails(self):
+        self.assertTrue(self.backend.acquire('shard:1', 'first', 30))
+        self.memcache_client.racing_writes = 1
+        self.assertFalse(self.backend.acquire('shard:1', 'first', 30))
+        self.assertTrue(self.backend.acquire('shard:1', 'first', 30))
+
+    def test_release_only_by_owner(self):
+        self.backend.acquire('shard:1', 'first', 30)
+        self.backend.release('shard:1', 'second')
+        self.assertEqual(
+            self.backend.holders(['shard:1']), {'shard:1': 'first'}
+        )
+        self.backend.release('shard:1', 'first')
+        self.assertTrue(self.backend.acquire('shard:1', 'second', 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
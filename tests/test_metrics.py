@@ -0,0 +1,47 @@
+"""Tests for interns.metrics"""
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from interns import metrics
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.registry = metrics.Registry()
+        self.calls = self.registry.counter('calls_total', 'Calls made')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_process_labels_are_added_to_every_sample(self):
+        self.calls.inc(call='get')
+        self.calls.inc(2)
+        lines = self.registry.render(
+            (('pid', 42), ('role', 'worker'))
+        ).splitlines()
+        self.assertIn('calls_total{pid="42",role="worker"} 2', lines)
+        self.assertIn(
+            'calls_total{call="get",pid="42",role="worker"} 1', lines
+        )
+
+    def test_textfiles_of_dead_processes_are_removed(self):
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        filenames = [
+            'interns_worker_{0}.prom'.format(exited.pid),
+            'interns_worker_{0}.prom'.format(os.getpid()),
+            'other_{0}.prom'.format(exited.pid)
+        ]
+        for filename in filenames:
+            open(os.path.join(self.tmp_dir, filename), 'w').close()
+        metrics.remove_dead_textfiles(self.tmp_dir)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), filenames[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""Tests for interns.rate_limiting"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from interns import rate_limiting
+
+
+class FakeClock(object):
+    """Stands in for the time module in interns.rate_limiting"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.clock = FakeClock(1000000.0)
+        self.real_time = rate_limiting.time
+        rate_limiting.time = self.clock
+        self.bucket = rate_limiting.TokenBucket(
+            'timeline',
+            3,
+            900,
+            rate_limiting.FileLockBucketBackend(
+                os.path.join(self.tmp_dir, 'buckets.json')
+            )
+        )
+
+    def tearDown(self):
+        rate_limiting.time = self.real_time
+        shutil.rmtree(self.tmp_dir)
+
+    def drain(self):
+        taken = 0
+        while self.bucket.try_acquire():
+            taken += 1
+        return taken
+
+    def test_window_starts_at_first_acquire(self):
+        self.assertEqual(self.bucket.tokens_left(), 3)
+        self.assertEqual(self.bucket.seconds_until_refill(), 0)
+        self.clock.now += 899
+        self.assertEqual(self.drain(), 3)
+        # An epoch aligned window would have refilled a second later
+        self.clock.now += 1
+        self.assertFalse(self.bucket.try_acquire())
+        self.assertEqual(self.bucket.seconds_until_refill(), 899)
+        self.clock.now += 899
+        self.assertEqual(self.drain(), 3)
+
+    def test_sync_remaining_uses_excess_tokens(self):
+        self.assertTrue(self.bucket.try_acquire())
+        reset = self.clock.now + 900
+        self.bucket.sync_remaining(1, reset)
+        self.assertEqual(self.bucket.tokens_left(), 1)
+        # Tokens are never given back within a window
+        self.bucket.sync_remaining(3, reset)
+        self.assertEqual(self.bucket.tokens_left(), 1)
+
+    def test_sync_remaining_blocks_only_until_reset(self):
+        self.assertTrue(self.bucket.try_acquire())
+        reset = self.clock.now + 60
+        self.bucket.sync_remaining(0, reset)
+        self.assertFalse(self.bucket.try_acquire())
+        self.assertEqual(self.bucket.seconds_until_refill(), 60)
+        self.clock.now = reset
+        self.assertEqual(self.bucket.tokens_left(), 3)
+        self.assertEqual(self.drain(), 3)
+
+    def test_sync_remaining_realigns_window_to_reset(self):
+        self.assertTrue(self.bucket.try_acquire())
+        self.clock.now += 100
+        reset = self.clock.now + 300
+        self.bucket.sync_remaining(2, reset)
+        self.assertEqual(self.bucket.tokens_left(), 2)
+        self.assertEqual(self.bucket.seconds_until_refill(), 300)
+        self.clock.now = reset
+        self.assertEqual(self.drain(), 3)
+
+    def test_sync_remaining_ignores_past_reset(self):
+        self.bucket.sync_remaining(0, self.clock.now - 1)
+        self.assertEqual(self.bucket.tokens_left(), 3)
+
+
+class TokenBucketPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        backend = rate_limiting.FileLockBucketBackend(
+            os.path.join(self.tmp_dir, 'buckets.json')
+        )
+        self.pool = rate_limiting.TokenBucketPool([
+            rate_limiting.TokenBucket('first', 2, 900, backend),
+            rate_limiting.TokenBucket('second', 1, 900, backend)
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_acquires_from_every_bucket(self):
+        names = [self.pool.try_acquire().name for _ in range(3)]
+        self.assertEqual(sorted(names), ['first', 'first', 'second'])
+        self.assertIsNone(self.pool.try_acquire())
+        self.assertEqual(self.pool.tokens_left(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+"""Tests for interns.tasks_scheduling.twitter.utils"""
+import unittest
+
+from interns.benchmarks import fakes
+
+fakes.install_fakes(fakes.FakeEleanorTwitter())
+
+# pylint: disable=wrong-import-position
+from interns.tasks_scheduling.twitter import utils
+
+
+class UserDeadlinesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.deadlines = utils.UserDeadlines()
+        self.deadlines.push('a', 10)
+        self.deadlines.push('b', 20)
+        self.deadlines.push('c', 30)
+
+    def pop_all(self):
+        popped = []
+        while self.deadlines.peek() is not None:
+            popped.append(self.deadlines.pop())
+        return popped
+
+    def test_pops_in_deadline_order(self):
+        self.assertEqual(self.deadlines.peek(), ('a', 10))
+        self.assertEqual(
+            self.pop_all(), [('a', 10), ('b', 20), ('c', 30)]
+        )
+        self.assertEqual(len(self.deadlines), 0)
+
+    def test_rescheduled_user_is_popped_at_new_deadline_only(self):
+        self.deadlines.push('a', 25)
+        self.deadlines.push('c', 5)
+        self.assertEqual(len(self.deadlines), 3)
+        self.assertEqual(
+            self.pop_all(), [('c', 5), ('b', 20), ('a', 25)]
+        )
+
+    def test_removed_user_is_never_popped(self):
+        self.deadlines.remove('a')
+        self.assertNotIn('a', self.deadlines)
+        self.assertEqual(self.deadlines.peek(), ('b', 20))
+        self.assertEqual(self.pop_all(), [('b', 20), ('c', 30)])
+
+    def test_removed_user_can_be_pushed_again(self):
+        self.deadlines.remove('b')
+        self.deadlines.push('b', 40)
+        self.assertEqual(
+            self.pop_all(), [('a', 10), ('c', 30), ('b', 40)]
+        )
+
+
+class AllocatePollIntervalsTest(unittest.TestCase):
+
+    usernames = ['quiet', 'steady', 'busy']
+    rates = {'quiet': 0.0001, 'steady': 0.01, 'busy': 1.0}
+
+    def polls_per_sec(self, intervals):
+        return sum(1.0 / interval for interval in intervals.values())
+
+    def test_no_users(self):
+        self.assertEqual(
+            utils.allocate_poll_intervals([], self.rates, 1.0, 1, 3600), {}
+        )
+
+    def test_budget_is_split_by_square_root_of_rate(self):
+        intervals = utils.allocate_poll_intervals(
+            self.usernames, self.rates, 1.0, 0.1, 100000
+        )
+        self.assertAlmostEqual(self.polls_per_sec(intervals), 1.0)
+        self.assertAlmostEqual(
+            intervals['quiet'] / intervals['steady'], 10.0
+        )
+        self.assertAlmostEqual(intervals['steady'] / intervals['busy'], 10.0)
+
+    def test_users_are_polled_at_most_every_min_poll_secs(self):
+        intervals = utils.allocate_poll_intervals(
+            self.usernames, self.rates, 0.3, 5, 100000
+        )
+        self.assertAlmostEqual(intervals['busy'], 5)
+        # The budget the busy user could not use goes to the others
+        self.assertAlmostEqual(self.polls_per_sec(intervals), 0.3)
+        self.assertAlmostEqual(intervals['steady'], 11.0)
+        self.assertAlmostEqual(intervals['quiet'], 110.0)
+
+    def test_users_are_polled_at_least_every_max_poll_secs(self):
+        intervals = utils.allocate_poll_intervals(
+            self.usernames, self.rates, 0.01, 1, 1000
+        )
+        self.assertAlmostEqual(intervals['quiet'], 1000)
+        self.assertAlmostEqual(self.polls_per_sec(intervals), 0.01)
+        for interval in intervals.values():
+            self.assertLessEqual(interval, 1000)
+
+    def test_max_poll_secs_wins_over_budget(self):
+        intervals = utils.allocate_poll_intervals(
+            self.usernames, self.rates, 0.0001, 1, 1000
+        )
+        for interval in intervals.values():
+            self.assertAlmostEqual(interval, 1000)
+
+    def test_zero_min_poll_secs_leaves_polls_uncapped(self):
+        intervals = utils.allocate_poll_intervals(
+            self.usernames, self.rates, 100.0, 0, 3600
+        )
+        self.assertAlmostEqual(self.polls_per_sec(intervals), 100.0)
+        self.assertLess(intervals['busy'], 0.1)
+
+    def test_unmeasured_users_get_the_average_rate(self):
+        rates = {'quiet': 0.0, 'busy': 1.0}
+        intervals = utils.allocate_poll_intervals(
+            ['quiet', 'busy', 'new'], rates, 1.0, 0.01, 100000
+        )
+        self.assertAlmostEqual(
+            intervals['new'], intervals['busy'] * 2 ** 0.5
+        )
+        self.assertAlmostEqual(intervals['quiet'], 100000)
+
+    def test_no_measured_rates_split_the_budget_evenly(self):
+        intervals = utils.allocate_poll_intervals(
+            self.usernames, {}, 0.3, 1, 3600
+        )
+        for interval in intervals.values():
+            self.assertAlmostEqual(interval, 10.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+"""Tests for interns.clients.twitter.spool"""
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from interns.clients.twitter import spool
+from interns.clients.twitter.records import TweetRecord
+
+
+def make_records(*tweet_ids):
+    return [
+        TweetRecord(
+            'tweeter', tweet_id, 'text of {0}'.format(tweet_id),
+            'Tue Oct 18 14:13:20 +0000 2016', [], [], [], None
+        )
+        for tweet_id in tweet_ids
+    ]
+
+
+def exited_pid():
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    return exited.pid
+
+
+class FakeEleanor(object):
+    """Stands in for send_tweet_records, going down after up_for_calls"""
+
+    def __init__(self, up_for_calls=None, rejected_ids=()):
+        self.up_for_calls = up_for_calls
+        self.rejected_ids = set(rejected_ids)
+        self.sent_ids = []
+
+    def send_records(self, records):
+        if self.up_for_calls is not None:
+            if not self.up_for_calls:
+                raise IOError('Connection refused')
+            self.up_for_calls -= 1
+        failures = []
+        for record in records:
+            if record.tweet_id in self.rejected_ids:
+                failures.append((str(record.tweet_id), ValueError('Bad')))
+            else:
+                self.sent_ids.append(record.tweet_id)
+        return failures
+
+
+class TweetSpoolTest(unittest.TestCase):
+
+    mmap_reads = False
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.spool = spool.TweetSpool(
+            self.spool_dir, 1024 * 1024, 3600, mmap_reads=self.mmap_reads
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def spooled_ids(self, segment_path):
+        return [
+            [record.tweet_id for record in records]
+            for _, records in self.spool.read_segment(segment_path)
+        ]
+
+    def test_only_sealed_segments_are_claimed(self):
+        self.spool.append(make_records(1, 2))
+        self.spool.seal_if_due()
+        self.assertEqual(self.spool.sealed_segments(), [])
+        self.spool.close()
+        segment_path, = self.spool.sealed_segments()
+        claimed_path = self.spool.claim(segment_path)
+        self.assertTrue(claimed_path.endswith(spool.claim_suffix))
+        self.assertEqual(self.spooled_ids(claimed_path), [[1, 2]])
+        # Another replayer is too late
+        self.assertIsNone(self.spool.claim(segment_path))
+        self.assertEqual(self.spool.sealed_segments(), [])
+
+    def test_segment_is_sealed_once_big_enough(self):
+        self.spool.segment_max_bytes = 1
+        self.spool.append(make_records(1))
+        self.spool.append(make_records(2))
+        self.assertEqual(len(self.spool.sealed_segments()), 2)
+
+    def test_abandoned_segments_are_sealed_again(self):
+        dead_pid = exited_pid()
+        open_name = '0000000000001-{0}-1.open'.format(dead_pid)
+        claimed_name = '0000000000002-{0}-1.seg.{1}.claim'.format(
+            os.getpid(), dead_pid
+        )
+        live_name = '0000000000003-{0}-1.open'.format(os.getpid())
+        for file_name in (open_name, claimed_name, live_name):
+            open(os.path.join(self.spool_dir, file_name), 'w').close()
+        self.spool.recover_abandoned()
+        self.assertEqual(
+            [os.path.basename(path) for path in self.spool.sealed_segments()],
+            [
+                '0000000000001-{0}-1.seg'.format(dead_pid),
+                '0000000000002-{0}-1.seg'.format(os.getpid())
+            ]
+        )
+        self.assertTrue(
+            os.path.exists(os.path.join(self.spool_dir, live_name))
+        )
+
+    def test_torn_frame_is_dropped(self):
+        self.spool.append(make_records(1))
+        self.spool.append(make_records(2, 3))
+        segment_path = self.spool.segment_path
+        self.spool.close()
+        segment_path = segment_path[:-len(spool.open_suffix)] + '.seg'
+        with open(segment_path, 'rb+') as segment:
+            segment.truncate(os.path.getsize(segment_path) - 1)
+        self.assertEqual(self.spooled_ids(segment_path), [[1]])
+
+    def test_corrupt_frame_is_dropped(self):
+        self.spool.append(make_records(1))
+        self.spool.append(make_records(2))
+        segment_path = self.spool.segment_path
+        with open(segment_path, 'rb+') as segment:
+            segment.seek(-1, os.SEEK_END)
+            last_byte = segment.read(1)
+            segment.seek(-1, os.SEEK_END)
+            segment.write(b'\x00' if last_byte == b'\xff' else b'\xff')
+        self.assertEqual(self.spooled_ids(segment_path), [[1]])
+
+
+class MmapTweetSpoolTest(TweetSpoolTest):
+
+    mmap_reads = True
+
+
+class SpoolReplayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.spool = spool.TweetSpool(self.spool_dir, 1024 * 1024, 3600)
+        self.spool.append(make_records(1, 2))
+        self.spool.append(make_records(3))
+        self.spool.append(make_records(4, 5))
+        self.spool.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def replayer(self, eleanor):
+        return spool.SpoolReplayer(self.spool, eleanor.send_records, 1, 1, 1)
+
+    def test_segment_is_removed_once_replayed(self):
+        eleanor = FakeEleanor()
+        self.assertEqual(self.replayer(eleanor).replay_once(), 1)
+        self.assertEqual(eleanor.sent_ids, [1, 2, 3, 4, 5])
+        self.assertEqual(os.listdir(self.spool_dir), [spool.dead_dir_name])
+
+    def test_replay_resumes_after_last_sent_frame(self):
+        eleanor = FakeEleanor(up_for_calls=2)
+        self.assertRaises(
+            spool.EleanorUnavailable, self.replayer(eleanor).replay_once
+        )
+        self.assertEqual(eleanor.sent_ids, [1, 2, 3])
+        self.assertEqual(len(self.spool.sealed_segments()), 1)
+        eleanor.up_for_calls = None
+        self.assertEqual(self.replayer(eleanor).replay_once(), 1)
+        self.assertEqual(eleanor.sent_ids, [1, 2, 3, 4, 5])
+        self.assertEqual(os.listdir(self.spool_dir), [spool.dead_dir_name])
+
+    def test_rejected_tweets_are_moved_to_dead(self):
+        eleanor = FakeEleanor(rejected_ids=[3])
+        self.assertEqual(self.replayer(eleanor).replay_once(), 1)
+        self.assertEqual(eleanor.sent_ids, [1, 2, 4, 5])
+        dead_segment, = os.listdir(self.spool.dead_directory)
+        dead_records = self.spool.read_segment(
+            os.path.join(self.spool.dead_directory, dead_segment)
+        )
+        self.assertEqual(
+            [record.tweet_id for _, records in dead_records
+             for record in records],
+            [3]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+"""Tests for following the tracked twitter users through the change log"""
+import Queue
+import unittest
+
+from interns.benchmarks import fakes
+
+fakes.install_fakes(fakes.FakeEleanorTwitter())
+
+# pylint: disable=wrong-import-position
+from interns.settings import interns_settings
+from interns.clients.twitter import utils as twitter_client_utils
+from interns.tasks_scheduling.twitter import jobs
+
+
+class TrackedUsersChangeLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.memcache_client = fakes.FakeMemcacheClient()
+        self.change_log = twitter_client_utils.TrackedUsersChangeLog(
+            self.memcache_client, 3600
+        )
+        self.change_log.record('a')
+        self.change_log.record('b')
+        self.change_log.record('a', added=False)
+
+    def test_changes_are_read_in_order(self):
+        self.assertEqual(self.change_log.current_version(), 3)
+        self.assertEqual(
+            self.change_log.changes_since(0, 10),
+            (3, [
+                {'username': 'a', 'added': True},
+                {'username': 'b', 'added': True},
+                {'username': 'a', 'added': False}
+            ])
+        )
+        self.assertEqual(
+            self.change_log.changes_since(2, 10),
+            (3, [{'username': 'a', 'added': False}])
+        )
+        self.assertEqual(self.change_log.changes_since(3, 10), (3, []))
+
+    def test_too_many_changes_need_a_full_sync(self):
+        self.assertIsNone(self.change_log.changes_since(0, 2))
+
+    def test_lost_log_needs_a_full_sync(self):
+        # memcache restarted and the version counted up again from 0
+        self.memcache_client.values.clear()
+        self.change_log.record('c')
+        self.assertIsNone(self.change_log.changes_since(3, 10))
+
+    def test_evicted_change_needs_a_full_sync(self):
+        self.memcache_client.delete(self.change_log.change_key_prefix + '2')
+        self.assertIsNone(self.change_log.changes_since(0, 10))
+        self.assertEqual(
+            self.change_log.changes_since(2, 10),
+            (3, [{'username': 'a', 'added': False}])
+        )
+
+    def test_change_being_written_is_read_later(self):
+        # The version is taken before the change is written
+        self.memcache_client.incr(self.change_log.version_key, 1)
+        self.assertEqual(
+            self.change_log.changes_since(2, 10),
+            (3, [{'username': 'a', 'added': False}])
+        )
+
+
+class SyncTrackedUsersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.real_settings = dict(
+            (name, getattr(interns_settings, name))
+            for name in ('metrics_enabled', 'spool_enabled')
+        )
+        interns_settings.metrics_enabled = False
+        interns_settings.spool_enabled = False
+        self.memcache_client = fakes.FakeMemcacheClient()
+        self.real_change_log = twitter_client_utils.tracked_users_changes
+        twitter_client_utils.tracked_users_changes = (
+            twitter_client_utils.TrackedUsersChangeLog(
+                self.memcache_client, 3600
+            )
+        )
+        self.eleanor = jobs.twitter_utils.eleanor_twitter
+        self.eleanor.tracked_users = ['a', 'b']
+        self.real_pull = self.eleanor.get_tracked_twitter_users
+        self.pulls = 0
+        self.eleanor.get_tracked_twitter_users = self.counted_pull
+        self.twitter_jobs = jobs.TwitterJobs(
+            Queue.Queue(), Queue.Queue(), run=False
+        )
+        self.pulls = 0
+
+    def tearDown(self):
+        del self.eleanor.get_tracked_twitter_users
+        twitter_client_utils.tracked_users_changes = self.real_change_log
+        for name, value in self.real_settings.items():
+            setattr(interns_settings, name, value)
+
+    def counted_pull(self):
+        self.pulls += 1
+        return self.real_pull()
+
+    def track(self, username, added=True):
+        if added:
+            self.eleanor.tracked_users.append(username)
+        else:
+            self.eleanor.tracked_users.remove(username)
+        twitter_client_utils.tracked_users_changes.record(username, added)
+
+    def sync(self, full_sync_due=False):
+        self.twitter_jobs.next_tracked_users_sync = 0
+        if full_sync_due:
+            self.twitter_jobs.next_full_tracked_users_sync = 0
+        self.twitter_jobs.sync_tracked_users()
+
+    def test_changes_are_applied_without_a_full_sync(self):
+        self.track('c')
+        self.track('a', added=False)
+        self.sync()
+        self.assertEqual(self.pulls, 0)
+        self.assertEqual(
+            self.twitter_jobs.tracked_twitter_users, set(['b', 'c'])
+        )
+        self.assertNotIn('a', self.twitter_jobs.user_deadlines)
+        self.assertIn('c', self.twitter_jobs.user_deadlines)
+        self.assertEqual(self.twitter_jobs.tracked_users_version, 2)
+
+    def test_evicted_change_falls_back_to_a_full_sync(self):
+        self.track('c')
+        self.track('d')
+        self.memcache_client.delete(
+            twitter_client_utils.tracked_users_changes.change_key_prefix + '1'
+        )
+        self.sync()
+        self.assertEqual(self.pulls, 1)
+        self.assertEqual(
+            self.twitter_jobs.tracked_twitter_users, set(['a', 'b', 'c', 'd'])
+        )
+        self.assertEqual(self.twitter_jobs.tracked_users_version, 2)
+
+    def test_unreadable_log_waits_for_the_full_sync_schedule(self):
+        self.memcache_client.error_rate = 1
+        self.sync(full_sync_due=True)
+        self.assertEqual(self.pulls, 1)
+        self.assertIsNone(self.twitter_jobs.tracked_users_version)
+        self.track('c')
+        self.sync()
+        self.assertEqual(self.pulls, 1)
+        # The changes made while the log was unreadable are unknown
+        self.memcache_client.error_rate = 0
+        self.sync()
+        self.assertEqual(self.pulls, 2)
+        self.assertIn('c', self.twitter_jobs.tracked_twitter_users)
+        self.assertEqual(self.twitter_jobs.tracked_users_version, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()